@@ -0,0 +1,32 @@
+"""
+ASGI config for avalon project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with any ASGI server, e.g.
+
+    uvicorn avalon.asgi:application
+
+The status views are then async and the long polls (status/wait/) only cost a
+suspended coroutine each, so a single process can hold thousands of idle
+clients (see the bench_idle_pollers management command). The other views are
+still run in a thread by Django. The admission control (AVALON_ADMISSION) works
+in the event loop too, but leave AVALON_METRICS, AVALON_PROFILE_DIR and
+AVALON_TRACE_FILE unset: those middlewares are synchronous, so Django runs
+every request through them in the one thread it keeps for synchronous code,
+where a parked long poll holds up all the other requests.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "avalon.settings")
+os.environ.setdefault("AVALON_ASYNC_POLLING", "1")
+
+application = get_asgi_application()
+
+from avalon_game.warmup import warm_up
+warm_up()
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -19,13 +21,27 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.9/howto/deployment/checklist/
 
+# Production profile: no debug mode (which logs every query), templates
+#   compiled once per process, persistent database connections and secure
+#   cookies. Compare the two with the bench_render management command.
+AVALON_PRODUCTION = os.environ.get('AVALON_PRODUCTION', '') == '1'
+
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 's!&2oe*ppw36!n05#33089hb6-d%+(q1fianz*ejvsl4*kzyox'
+#   The access codes (see avalon_game/codes.py) and the anonymization of the
+#   request traces depend on it, so production has no default.
+SECRET_KEY = os.environ.get('AVALON_SECRET_KEY')
+if not SECRET_KEY:
+    if AVALON_PRODUCTION:
+        raise ImproperlyConfigured("AVALON_SECRET_KEY must be set when "
+                                   "AVALON_PRODUCTION=1.")
+    SECRET_KEY = 's!&2oe*ppw36!n05#33089hb6-d%+(q1fianz*ejvsl4*kzyox'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = not AVALON_PRODUCTION
 
-ALLOWED_HOSTS = []
+# comma-separated, e.g. "avalon.example.com"
+ALLOWED_HOSTS = [host for host in
+                 os.environ.get('AVALON_ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -36,7 +52,11 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
 ]
 
-MIDDLEWARE_CLASSES = [
+MIDDLEWARE = [
+    'avalon_game.tracing.TraceMiddleware',
+    'avalon_game.metrics.MetricsMiddleware',
+    'avalon_game.profiling.ProfilingMiddleware',
+    'avalon_game.admission.AdmissionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -59,6 +79,15 @@ TEMPLATES = [
     },
 ]
 
+if AVALON_PRODUCTION:
+    # instead of reading and compiling every template of the base.html ->
+    #   game.html -> in_game.html -> ... chain on each render
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader',
+         ['django.template.loaders.app_directories.Loader']),
+    ]
+
 WSGI_APPLICATION = 'avalon.wsgi.application'
 
 
@@ -67,15 +96,53 @@ WSGI_APPLICATION = 'avalon.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # django.db.backends.sqlite3 using BEGIN IMMEDIATE (see the module)
+        'ENGINE': 'avalon.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
         'ATOMIC_REQUESTS': True,
         'OPTIONS': {
             'timeout': 60, # longer database timeout
-        }
+        },
+        'TEST': {
+            # in-memory test databases fail instead of waiting for locks,
+            #   which breaks the multi-threaded tests
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
+# Spread games across this many databases games0.sqlite3, games1.sqlite3, ...
+#   (see avalon_game/sharding.py). 0 keeps everything in the default database.
+AVALON_GAME_SHARDS = int(os.environ.get('AVALON_GAME_SHARDS', '0'))
+# Number of game databases to configure; set it to the old number of shards
+#   while running rebalance_shards after reducing AVALON_GAME_SHARDS.
+AVALON_GAME_SHARD_DATABASES = int(os.environ.get(
+    'AVALON_GAME_SHARD_DATABASES', str(AVALON_GAME_SHARDS)))
+
+for i in range(AVALON_GAME_SHARD_DATABASES):
+    DATABASES['games%d' % i] = {
+        'ENGINE': 'avalon.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'games%d.sqlite3' % i),
+        'OPTIONS': {
+            'timeout': 60,
+        },
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_games%d.sqlite3' % i),
+        },
+    }
+if AVALON_GAME_SHARDS:
+    # a request only locks the database of its game instead
+    DATABASES['default']['ATOMIC_REQUESTS'] = False
+
+if AVALON_PRODUCTION:
+    # seconds to keep database connections open between requests, instead of
+    #   reconnecting on every poll
+    for database in DATABASES.values():
+        database['CONN_MAX_AGE'] = int(os.environ.get('AVALON_CONN_MAX_AGE',
+                                                      '300'))
+
+DATABASE_ROUTERS = ['avalon_game.sharding.GameShardRouter']
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.9/topics/i18n/
@@ -95,3 +162,111 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.9/howto/static-files/
 
 STATIC_URL = '/static/'
+# where collectstatic puts the static files to serve
+STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+
+if AVALON_PRODUCTION:
+    # hashed names and precompressed copies, cached by browsers for good (see
+    #   avalon_game/assets.py); needs collectstatic after every deploy
+    STATICFILES_STORAGE = 'avalon_game.assets.CompressedManifestStorage'
+
+# Serve STATIC_ROOT from Django (see avalon_game/assets.py) instead of a
+#   front-end server.
+AVALON_SERVE_STATIC = os.environ.get('AVALON_SERVE_STATIC',
+                                     '1' if AVALON_PRODUCTION else '') == '1'
+
+
+# Security
+
+if AVALON_PRODUCTION:
+    # The pages post the token from their forms (the AJAX requests too, see
+    #   game.html), so no script needs to read the cookie. There are no
+    #   sessions.
+    CSRF_COOKIE_HTTPONLY = True
+    # set AVALON_HTTPS=0 if the site isn't served over HTTPS
+    CSRF_COOKIE_SECURE = os.environ.get('AVALON_HTTPS', '1') == '1'
+
+
+# Avalon
+
+# Token required to access the admin-only endpoints (e.g. the history export).
+#   Those endpoints are disabled if it is not set.
+AVALON_ADMIN_TOKEN = os.environ.get('AVALON_ADMIN_TOKEN')
+
+# Collect per-view request metrics and serve them at /metrics/ (see
+#   avalon_game/metrics.py).
+AVALON_METRICS = os.environ.get('AVALON_METRICS', '') == '1'
+
+# Profile requests and dump the results to this directory (see
+#   avalon_game/profiling.py). Profiling is disabled if it is not set.
+AVALON_PROFILE_DIR = os.environ.get('AVALON_PROFILE_DIR')
+# fraction of requests to run under cProfile
+AVALON_PROFILE_SAMPLE_RATE = float(os.environ.get('AVALON_PROFILE_SAMPLE_RATE',
+                                                  '0.01'))
+# requests slower than this are always dumped
+AVALON_PROFILE_SLOW_MS = int(os.environ.get('AVALON_PROFILE_SLOW_MS', '500'))
+# seconds between stack samples of requests not run under cProfile
+AVALON_PROFILE_INTERVAL = 0.005
+AVALON_PROFILE_MAX_DUMPS = 200
+
+# Append anonymized request traces to this file (see avalon_game/tracing.py
+#   and the replay_traffic management command). Disabled if it is not set.
+AVALON_TRACE_FILE = os.environ.get('AVALON_TRACE_FILE')
+
+# Serve the status, game and observe pages from a live-state store instead of
+#   the database (see avalon_game/livestate.py):
+#   'avalon_game.livestate.LocalStore' (single process only) or
+#   'avalon_game.livestate.CacheStore' (the 'live_state' cache).
+AVALON_LIVE_STATE = os.environ.get('AVALON_LIVE_STATE')
+# maximum number of games kept by LocalStore
+AVALON_LIVE_STATE_MAX_GAMES = 1000
+# seconds between writing back Player.last_accessed
+AVALON_LIVE_STATE_FLUSH_INTERVAL = 2
+
+# Use the async status views (set by avalon/asgi.py).
+AVALON_ASYNC_POLLING = os.environ.get('AVALON_ASYNC_POLLING', '') == '1'
+# seconds a long poll (status/wait/) waits for the game to change
+AVALON_LONG_POLL_TIMEOUT = 25
+# seconds between checks whether a game waited on has changed
+AVALON_LONG_POLL_INTERVAL = 0.5
+# upper bound in seconds of the delay between status polls the server
+#   recommends to clients (see poll_interval() in avalon_game/views.py)
+AVALON_POLL_MAX_INTERVAL = 60
+# Check every materialized status served (see materialize_status() in
+#   avalon_game/views.py) against the status computed from the game. Slow;
+#   for tests.
+AVALON_VERIFY_STATUS = os.environ.get('AVALON_VERIFY_STATUS', '') == '1'
+
+# Shed status polls while the server is overloaded, answering them with the
+#   last known status (see avalon_game/admission.py). Actions are always
+#   admitted.
+AVALON_ADMISSION = os.environ.get('AVALON_ADMISSION', '') == '1'
+# overloaded while more requests than this are in flight in a process...
+AVALON_ADMISSION_MAX_IN_FLIGHT = int(os.environ.get(
+    'AVALON_ADMISSION_MAX_IN_FLIGHT', '16'))
+# ... or for AVALON_ADMISSION_WINDOW seconds after a query took longer than
+#   this (mostly waiting for the database lock)
+AVALON_ADMISSION_MAX_DB_WAIT_MS = int(os.environ.get(
+    'AVALON_ADMISSION_MAX_DB_WAIT_MS', '500'))
+AVALON_ADMISSION_WINDOW = 10
+# seconds shed clients are told to wait before polling again
+AVALON_ADMISSION_RETRY_AFTER = 5
+
+# Compile the templates and build the URL resolver when a server process
+#   starts instead of on its first requests (see avalon_game/warmup.py and
+#   the bench_startup management command).
+AVALON_WARM_UP = os.environ.get('AVALON_WARM_UP', '1' if AVALON_PRODUCTION
+                                else '') == '1'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # shared by all processes on this machine; use memcached or similar if
+    #   there is more than one
+    'live_state': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'live_state_cache'),
+        'TIMEOUT': 3 * 60 * 60,
+    },
+}
@@ -0,0 +1,28 @@
+"""SQLite backend which takes the write lock at the start of transactions.
+
+Django starts transactions with a plain BEGIN, so a transaction only asks for
+the write lock at its first write. If two transactions have both read before
+either writes, SQLite cannot let the second one wait (the first needs it to
+release its read lock to commit) and fails it immediately with "database is
+locked" instead of honoring the timeout. Starting every transaction with
+BEGIN IMMEDIATE makes concurrent requests wait for each other instead, which
+is what allows running multi-threaded workers.
+
+Every request which uses a transaction (ATOMIC_REQUESTS) writes anyway
+(at least Player.last_accessed), so this does not serialize anything that
+was not already serialized.
+
+The database is also switched to write-ahead logging so the status polls
+(which run outside of transactions) can keep reading while a request writes.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
+
+    def get_new_connection(self, conn_params):
+        conn = super(DatabaseWrapper, self).get_new_connection(conn_params)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
@@ -14,8 +14,18 @@ Including another URLconf
     2. Import the include() function: from django.conf.urls import url, include
     3. Add a URL to urlpatterns:  url(r'^blog/', include(blog_urls))
 """
+import re
+
+from django.conf import settings
 from django.conf.urls import include, url
 
+from avalon_game.assets import serve_static
+
 urlpatterns = [
     url(r'^', include('avalon_game.urls')),
 ]
+
+if settings.AVALON_SERVE_STATIC:
+    urlpatterns.insert(0, url(r'^%s(?P<path>.+)$'
+                              % re.escape(settings.STATIC_URL.lstrip('/')),
+                              serve_static, name='static'))
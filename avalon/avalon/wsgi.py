@@ -14,3 +14,6 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "avalon.settings")
 
 application = get_wsgi_application()
+
+from avalon_game.warmup import warm_up
+warm_up()
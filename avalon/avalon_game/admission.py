@@ -0,0 +1,264 @@
+"""Opt-in admission control: shedding status polls under load.
+
+While the database is contended, every request waits for the SQLite lock (up
+to the database timeout), and the status polls, which are most of the
+requests, tie up the workers the actions (votes, missions, ...) need.
+AdmissionMiddleware is only installed if settings.AVALON_ADMISSION is set.
+It tracks the number of requests in flight and the slowest database query of
+each request, and considers the server overloaded while
+
+ * more than AVALON_ADMISSION_MAX_IN_FLIGHT requests are in flight, or
+ * a query took longer than AVALON_ADMISSION_MAX_DB_WAIT_MS in the last
+   AVALON_ADMISSION_WINDOW seconds (with BEGIN IMMEDIATE, see
+   avalon/sqlite3, waiting for the lock shows up as a slow query).
+
+While overloaded, the status polls (SHED_VIEWS) are answered without running
+their view: with the last status this process served at that URL if it has
+one (as a 304 if the client already has it or something newer), otherwise
+with a 503. Either way with a Retry-After header, which the polling script in
+game.html waits for. Everything else, in particular every POST, is always
+admitted.
+
+Shed requests are counted in the avalon_shed_requests_total metric (see
+metrics.py), by view and by whether a stale status was served.
+
+The middleware is async-capable: under ASGI (avalon/asgi.py) it stays in the
+event loop, so a parked long poll doesn't hold a thread, and the slowest
+query is tracked through a context variable, which follows the request into
+the threads its database access runs in.
+"""
+from collections import OrderedDict
+import asyncio
+import contextvars
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.utils.http import parse_etags
+
+from .metrics import REGISTRY
+
+# low-priority views: only polling the status, which is polled again anyway
+SHED_VIEWS = ('status', 'observe_status', 'status_wait', 'observe_status_wait')
+
+# long polls, which wait for the game to change without holding a thread
+#   (see avalon/asgi.py), so they don't count as in flight
+LONG_POLL_VIEWS = ('status_wait', 'observe_status_wait')
+
+# number of status URLs whose last response is kept for shed requests
+MAX_REMEMBERED = 10000
+
+REGISTRY.describe('avalon_shed_requests_total', 'counter',
+                  'Status polls answered without running their view while '
+                  'overloaded, by URL name and response (stale status or '
+                  'unavailable).')
+REGISTRY.describe('avalon_admission_overloaded', 'gauge',
+                  'Whether status polls are being shed, by reason.')
+
+
+def _etag_seq(etag):
+    """The event sequence number in an ETag of the status views (see
+    _status_etag() in views.py), or None."""
+    try:
+        return int(etag.strip('"').split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+class SlowestQuery(object):
+    """execute_wrapper() which records the duration of the slowest query."""
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time = max(self.time, time.perf_counter() - start)
+
+
+# the SlowestQuery of the request being handled
+_request_query = contextvars.ContextVar('avalon_request_query', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    query = _request_query.get()
+    if query is None:
+        return execute(sql, params, many, context)
+    return query(execute, sql, params, many, context)
+
+
+def _install_query_recorder(sender=None, connection=None, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class AdmissionState(object):
+    """The load of this process and the last status served at each URL."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        # time.monotonic() of the last query slower than the threshold
+        self.last_slow_query = None
+        # path -> (ETag, body, X-Poll-Interval)
+        self.statuses = OrderedDict()
+
+    def overloaded(self):
+        """Why the server is overloaded ('in_flight' or 'db_wait'), or
+        None."""
+        with self.lock:
+            if self.in_flight > settings.AVALON_ADMISSION_MAX_IN_FLIGHT:
+                return 'in_flight'
+            if self.last_slow_query is not None\
+                    and time.monotonic() - self.last_slow_query\
+                        < settings.AVALON_ADMISSION_WINDOW:
+                return 'db_wait'
+        return None
+
+    def remember(self, path, response):
+        with self.lock:
+            self.statuses[path] = (response['ETag'], response.content,
+                                   response.get('X-Poll-Interval'))
+            self.statuses.move_to_end(path)
+            if len(self.statuses) > MAX_REMEMBERED:
+                self.statuses.popitem(last=False)
+
+    def remembered(self, path):
+        with self.lock:
+            return self.statuses.get(path)
+
+    def gauges(self):
+        reason = self.overloaded()
+        for name in ('db_wait', 'in_flight'):
+            yield ('avalon_admission_overloaded', {'reason': name},
+                   int(reason == name))
+
+
+STATE = AdmissionState()
+
+
+def gauges():
+    """The gauges for the metrics view (none if admission control is off)."""
+    if settings.AVALON_ADMISSION:
+        return STATE.gauges()
+    return ()
+
+
+class AdmissionMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.AVALON_ADMISSION:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        # every connection records its queries for the request it runs in,
+        #   including those already open in this thread
+        connection_created.connect(_install_query_recorder,
+                                   dispatch_uid='avalon_admission')
+        for connection in connections.all():
+            _install_query_recorder(connection=connection)
+        if asyncio.iscoroutinefunction(get_response):
+            # have the handler await __call__() and process_view() in the
+            #   event loop instead of running them in a thread (like
+            #   django.utils.deprecation.MiddlewareMixin)
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            self.process_view = self._async_process_view
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        query = SlowestQuery()
+        token = _request_query.set(query)
+        self.admit()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_query.reset(token)
+            self.done(request, query)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        query = SlowestQuery()
+        token = _request_query.set(query)
+        self.admit()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_query.reset(token)
+            self.done(request, query)
+        return self.process_response(request, response)
+
+    def admit(self):
+        with STATE.lock:
+            STATE.in_flight += 1
+
+    def done(self, request, query):
+        with STATE.lock:
+            if not getattr(request, '_avalon_long_poll', False):
+                STATE.in_flight -= 1
+            if query.time * 1000 > settings.AVALON_ADMISSION_MAX_DB_WAIT_MS:
+                STATE.last_slow_query = time.monotonic()
+
+    def process_response(self, request, response):
+        if getattr(request, '_avalon_sheddable', False)\
+                and response.status_code == 200 and 'ETag' in response:
+            STATE.remember(request.path, response)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        return self.shed_view(request)
+
+    async def _async_process_view(self, request, view_func, view_args,
+                                  view_kwargs):
+        # doesn't block: only the in-memory state
+        return self.shed_view(request)
+
+    def shed_view(self, request):
+        """The response to a sheddable request while overloaded, or None to
+        run the view."""
+        match = request.resolver_match
+        if match.url_name not in SHED_VIEWS\
+                or request.method not in ('GET', 'HEAD'):
+            return None
+        request._avalon_sheddable = True
+        if match.url_name in LONG_POLL_VIEWS:
+            with STATE.lock:
+                STATE.in_flight -= 1
+            request._avalon_long_poll = True
+        if STATE.overloaded() is None:
+            return None
+        return self.shed(request, match.url_name)
+
+    def shed(self, request, view):
+        retry_after = settings.AVALON_ADMISSION_RETRY_AFTER
+        remembered = STATE.remembered(request.path)
+        if remembered is None:
+            REGISTRY.inc('avalon_shed_requests_total', view=view,
+                         response='unavailable')
+            response = HttpResponse(status=503)
+            response['Retry-After'] = retry_after
+            return response
+        REGISTRY.inc('avalon_shed_requests_total', view=view,
+                     response='stale')
+        etag, body, poll_interval = remembered
+        seq = _etag_seq(etag)
+        client_seqs = [_etag_seq(tag) for tag in
+                       parse_etags(request.headers.get('If-None-Match', ''))]
+        if any(client_seq is not None and seq is not None
+               and client_seq >= seq for client_seq in client_seqs):
+            # the client's status is at least as new as the remembered one
+            response = HttpResponse(status=304)
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        response['Retry-After'] = retry_after
+        response['X-Poll-Interval'] = max(int(poll_interval or 0),
+                                          retry_after * 1000)
+        return response
@@ -0,0 +1,112 @@
+"""Where does table time go? Aggregates over the VoteRound timestamps.
+
+pick time is from the start of a vote round until the leader finalizes the
+team (chose_team) and vote time is from then until the last vote is cast
+(voted). Everything is aggregated in the database, grouped by player count,
+round and vote number. With sharding, each game database is aggregated
+separately and the results are merged.
+"""
+from datetime import timedelta
+
+from django.db.models import Avg, Case, Count, DurationField,\
+                             ExpressionWrapper, F, IntegerField, Max, Min,\
+                             OuterRef, Subquery, Sum, When
+
+from .models import Player, VoteRound
+from .sharding import game_databases
+
+# upper bounds (in seconds) of the histogram buckets; the last bucket is open
+LATENCY_BUCKETS = (15, 30, 60, 120, 300)
+
+GROUP_BY = ('num_players', 'round_num', 'vote_num')
+
+_INTERVALS = {
+    'pick': ('started', 'chose_team'),
+    'vote': ('chose_team', 'voted'),
+}
+
+
+def _seconds(duration):
+    if duration is None:
+        return None
+    return duration.total_seconds()
+
+
+def _histogram_aggregates(field):
+    aggregates = {}
+    lower = None
+    for i, upper in enumerate(LATENCY_BUCKETS + (None,)):
+        condition = {}
+        if lower is not None:
+            condition[field + '__gte'] = timedelta(seconds=lower)
+        if upper is not None:
+            condition[field + '__lt'] = timedelta(seconds=upper)
+        aggregates['bucket_%d' % i] = Sum(Case(When(then=1, **condition),
+                                               default=0,
+                                               output_field=IntegerField()))
+        lower = upper
+    return aggregates
+
+
+def _interval_stats(interval, vote_rounds):
+    start, end = _INTERVALS[interval]
+    num_players = Player.objects.filter(game=OuterRef('game_round__game'))\
+                                .order_by()\
+                                .values('game')\
+                                .annotate(count=Count('pk'))\
+                                .values('count')
+    rows = vote_rounds.filter(**{start + '__isnull': False,
+                                 end + '__isnull': False})\
+                      .annotate(num_players=Subquery(num_players),
+                                round_num=F('game_round__round_num'),
+                                latency=ExpressionWrapper(
+                                    F(end) - F(start),
+                                    output_field=DurationField()))\
+                      .order_by()\
+                      .values(*GROUP_BY)\
+                      .annotate(count=Count('pk'),
+                                avg=Avg('latency'),
+                                min=Min('latency'),
+                                max=Max('latency'),
+                                **_histogram_aggregates('latency'))
+    for row in rows:
+        key = tuple(row[k] for k in GROUP_BY)
+        yield key, {
+            'count': row['count'],
+            'avg': _seconds(row['avg']),
+            'min': _seconds(row['min']),
+            'max': _seconds(row['max']),
+            'histogram': [row['bucket_%d' % i]
+                          for i in range(len(LATENCY_BUCKETS) + 1)],
+        }
+
+
+def _merge_stats(a, b):
+    count = a['count'] + b['count']
+    return {
+        'count': count,
+        'avg': (a['avg'] * a['count'] + b['avg'] * b['count']) / count,
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max']),
+        'histogram': [x + y for x, y in zip(a['histogram'], b['histogram'])],
+    }
+
+
+def decision_latency(since=None, until=None):
+    """Pick and vote time statistics grouped by GROUP_BY."""
+    vote_rounds = VoteRound.objects.all()
+    if since is not None:
+        vote_rounds = vote_rounds.filter(started__gte=since)
+    if until is not None:
+        vote_rounds = vote_rounds.filter(started__lt=until)
+
+    results = {}
+    for db in game_databases():
+        for interval in _INTERVALS:
+            for key, stats in _interval_stats(interval,
+                                              vote_rounds.using(db)):
+                row = results.setdefault(key, dict(zip(GROUP_BY, key)))
+                if interval in row:
+                    stats = _merge_stats(row[interval], stats)
+                row[interval] = stats
+    return [results[key] for key in sorted(results)]
@@ -0,0 +1,146 @@
+"""Static files with hashed names, precompressed and cached for good.
+
+In production (settings.AVALON_PRODUCTION), collectstatic copies the static
+files to STATIC_ROOT through CompressedManifestStorage, which
+
+ * adds a hash of the content to each name (css/styles.css ->
+   css/styles.0123456789ab.css, in the url()s of the stylesheets too) and
+   records the names in staticfiles.json, where {% static %} looks them up;
+ * writes a gzip (and, if the brotli package is installed, a brotli)
+   compressed copy next to each hashed text file, e.g.
+   css/styles.0123456789ab.css.gz, so nothing is compressed per request.
+
+A hashed name changes whenever the file does, so browsers can keep those
+files forever: serve_static() serves them with an immutable one-year
+Cache-Control, picking the precompressed copy the client accepts. It is only
+routed if settings.AVALON_SERVE_STATIC is set (see avalon/urls.py); a
+front-end server serving STATIC_ROOT itself should do the same (e.g. nginx's
+gzip_static and expires max for the hashed names).
+"""
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestFilesMixin,\
+                                               ManifestStaticFilesStorage,\
+                                               staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# files worth compressing; the images are compressed already
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.html')
+
+# smaller files aren't worth another request header
+MIN_COMPRESS_SIZE = 256
+
+# (Content-Encoding, suffix) of the precompressed copies, preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage which also writes compressed copies of the
+    hashed files."""
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # the final names, after the hashes of the files referenced by the
+        #   stylesheets have settled
+        for name in sorted(set(self.hashed_files.values())):
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as f:
+            content = f.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+        # mtime=0 to write the same file for the same content
+        variants = {'.gz': gzip.compress(content, 9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(content)
+        for suffix, compressed in variants.items():
+            if len(compressed) >= len(content):
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            self._save(name + suffix, ContentFile(compressed))
+
+
+def _accepted_encodings(request):
+    accepted = set()
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = coding.partition(';')
+        if re.match(r'\s*q=0(\.0*)?\s*$', params):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _hashed_names():
+    if isinstance(staticfiles_storage, ManifestFilesMixin):
+        return set(staticfiles_storage.hashed_files.values())
+    return set()
+
+
+# no database access, so no transaction (see ATOMIC_REQUESTS in settings.py)
+@transaction.non_atomic_requests
+@require_safe
+def serve_static(request, path):
+    """Serve the file path of STATIC_ROOT, precompressed if possible."""
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404()
+    if not os.path.isfile(full_path):
+        raise Http404()
+    hashed = path in _hashed_names()
+    mtime = os.stat(full_path).st_mtime
+    if not hashed:
+        response = get_conditional_response(request,
+                                            last_modified=int(mtime))
+        if response is not None:
+            response['Vary'] = 'Accept-Encoding'
+            return response
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    if content_type.startswith('text/')\
+            or content_type == 'application/javascript':
+        content_type += '; charset=utf-8'
+    accepted = _accepted_encodings(request)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.isfile(full_path + suffix):
+            response = FileResponse(open(full_path + suffix, 'rb'),
+                                    content_type=content_type,
+                                    filename=os.path.basename(path))
+            response['Content-Encoding'] = encoding
+            break
+    else:
+        response = FileResponse(open(full_path, 'rb'),
+                                content_type=content_type,
+                                filename=os.path.basename(path))
+    # caches must not give the compressed copy to other clients
+    response['Vary'] = 'Accept-Encoding'
+    if hashed:
+        response['Cache-Control'] = IMMUTABLE
+    else:
+        # the same name may be another file after the next deploy
+        response['Cache-Control'] = 'no-cache'
+        response['Last-Modified'] = http_date(mtime)
+    return response
@@ -0,0 +1,96 @@
+"""Collision-free access codes, and random player secrets.
+
+Instead of generating random strings and querying until an unused one comes
+up, codes are allocated from a counter (CodeSequence in models.py) and the
+counter value is passed through a keyed pseudorandom permutation of all
+strings of the right length. Distinct counter values always map to distinct
+codes, so no lookup is needed, but without the key (derived from SECRET_KEY)
+the codes are not predictable from each other.
+
+The permutation is a Feistel network over the smallest even number of bits
+that covers 26**length values; outputs outside of that range are fed back
+through the network ("cycle walking") until they land inside it.
+
+Player secrets are the only thing authenticating a player, so they are not
+allocated that way: anyone who could work out the key (e.g. a server left
+with the SECRET_KEY from the repository) and knows their own secret could
+compute everybody else's. They are random_code()s instead, kept unique
+within their game by a unique constraint (see Player.save()).
+"""
+import hashlib
+import hmac
+import secrets
+import string
+
+from django.conf import settings
+
+ALPHABET = string.ascii_lowercase
+
+FEISTEL_ROUNDS = 10
+
+
+class CodePermutation(object):
+    def __init__(self, length, key):
+        self.length = length
+        self.domain = len(ALPHABET) ** length
+        bits = (self.domain - 1).bit_length()
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.key = key
+
+    def _round_function(self, i, value):
+        digest = hmac.new(self.key, b'%d:%d' % (i, value),
+                          hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') & self.mask
+
+    def _feistel(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for i in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round_function(i, right)
+        return (left << self.half_bits) | right
+
+    def permute(self, value):
+        if not 0 <= value < self.domain:
+            raise ValueError("Code sequence exhausted.")
+        value = self._feistel(value)
+        while value >= self.domain:
+            value = self._feistel(value)
+        return value
+
+    def encode(self, value):
+        letters = []
+        for i in range(self.length):
+            value, digit = divmod(value, len(ALPHABET))
+            letters.append(ALPHABET[digit])
+        return ''.join(reversed(letters))
+
+    def code(self, value):
+        return self.encode(self.permute(value))
+
+
+_permutations = {}
+
+
+def code_for(name, length, value):
+    """The code of the given length for counter value of sequence name."""
+    permutation = _permutations.get((name, length))
+    if permutation is None:
+        key = hashlib.sha256(('avalon-codes:%s:%s'
+                              % (name, settings.SECRET_KEY)).encode('utf-8'))\
+                     .digest()
+        permutation = _permutations[(name, length)] =\
+            CodePermutation(length, key)
+    return permutation.code(value)
+
+
+def random_code(length):
+    """A code of the given length from the operating system's randomness."""
+    return ''.join(secrets.choice(ALPHABET) for i in range(length))
+
+
+def random_codes(length, count):
+    """count distinct random_code()s."""
+    codes = set()
+    while len(codes) < count:
+        codes.add(random_code(length))
+    return list(codes)
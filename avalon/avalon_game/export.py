@@ -0,0 +1,158 @@
+"""Export the history of finished games for offline analysis.
+
+Records are produced one per vote round and one per mission action. Games are
+read in fixed size batches (keyed on primary key) with all of their rounds,
+votes and mission actions prefetched, so memory use does not depend on how
+many games are exported. With sharding, the game databases are exported one
+after the other.
+"""
+import csv
+from datetime import datetime, time, timedelta
+import json
+
+from django.db.models import Count, Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Game, GameRound, VoteRound
+from .sharding import game_databases
+
+EXPORT_BATCH_SIZE = 100
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+CSV_COLUMNS = ['record', 'game', 'created', 'num_players', 'round_num',
+               'vote_num', 'leader', 'leader_role', 'team', 'approved_by',
+               'rejected_by', 'team_approved', 'player', 'role',
+               'played_success', 'mission_passed']
+
+
+def parse_day(value, end_of_day=False):
+    """Parse a YYYY-MM-DD string to an aware datetime (or None)."""
+    if not value:
+        return None
+    day = parse_date(value)
+    if day is None:
+        raise ValueError("Invalid date %r (expected YYYY-MM-DD)" % value)
+    if end_of_day:
+        day += timedelta(days=1)
+    return timezone.make_aware(datetime.combine(day, time()),
+                               timezone.utc)
+
+
+def exported_games(since=None, until=None, min_players=None,
+                   max_players=None):
+    """Finished games created in [since, until) with the given player count."""
+    games = Game.objects.filter(game_phase=Game.GAME_PHASE_END)
+    if since is not None:
+        games = games.filter(created__gte=since)
+    if until is not None:
+        games = games.filter(created__lt=until)
+    if min_players is not None or max_players is not None:
+        games = games.annotate(player_count=Count('player'))
+        if min_players is not None:
+            games = games.filter(player_count__gte=min_players)
+        if max_players is not None:
+            games = games.filter(player_count__lte=max_players)
+    return games
+
+
+def _game_batches(games, batch_size=EXPORT_BATCH_SIZE):
+    vote_rounds = VoteRound.objects.select_related('leader')\
+                                   .prefetch_related('chosen',
+                                                     'playervote_set')\
+                                   .order_by('vote_num')
+    game_rounds = GameRound.objects.prefetch_related(
+                      Prefetch('voteround_set', queryset=vote_rounds),
+                      'missionaction_set')\
+                                   .order_by('round_num')
+    games = games.order_by('pk')\
+                 .prefetch_related(Prefetch('gameround_set',
+                                            queryset=game_rounds),
+                                   'player_set')
+    last_pk = None
+    while True:
+        batch = games if last_pk is None else games.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def _game_records(game):
+    players = {p.pk: p for p in game.player_set.all()}
+    num_players = len(players)
+    base = {'game': game.access_code,
+            'created': game.created.isoformat(),
+            'num_players': num_players}
+    for game_round in game.gameround_set.all():
+        for vote_round in game_round.voteround_set.all():
+            if vote_round.vote_status != VoteRound.VOTE_STATUS_VOTED:
+                continue
+            votes = vote_round.playervote_set.all()
+            approved_by = [players[v.player_id] for v in votes if v.accept]
+            rejected_by = [players[v.player_id] for v in votes
+                           if not v.accept]
+            record = dict(base)
+            record.update({
+                'record': 'vote',
+                'round_num': game_round.round_num,
+                'vote_num': vote_round.vote_num,
+                'leader': vote_round.leader.name,
+                'leader_role': vote_round.leader.role_string(),
+                'team': [p.name for p in vote_round.chosen.all()],
+                'approved_by': [p.name for p in approved_by],
+                'rejected_by': [p.name for p in rejected_by],
+                'team_approved': len(approved_by) > len(rejected_by),
+            })
+            yield record
+        for action in game_round.missionaction_set.all():
+            player = players[action.player_id]
+            record = dict(base)
+            record.update({
+                'record': 'mission',
+                'round_num': game_round.round_num,
+                'player': player.name,
+                'role': player.role_string(),
+                'played_success': action.played_success,
+                'mission_passed': game_round.mission_passed,
+            })
+            yield record
+
+
+def history_records(games, batch_size=EXPORT_BATCH_SIZE):
+    for db in game_databases():
+        for batch in _game_batches(games.using(db), batch_size):
+            for game in batch:
+                for record in _game_records(game):
+                    yield record
+
+
+class _Echo(object):
+    """File-like object which just returns what is written to it."""
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, sort_keys=True) + '\n'
+
+
+def csv_lines(records):
+    writer = csv.DictWriter(_Echo(), fieldnames=CSV_COLUMNS)
+    yield writer.writeheader()
+    for record in records:
+        row = dict(record)
+        for key in ('team', 'approved_by', 'rejected_by'):
+            if key in row:
+                row[key] = ';'.join(row[key])
+        yield writer.writerow(row)
+
+
+def export_lines(export_format, records):
+    if export_format == 'csv':
+        return csv_lines(records)
+    else:
+        return ndjson_lines(records)
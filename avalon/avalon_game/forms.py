@@ -1,6 +1,6 @@
 from django import forms
 
-from .models import Game, Player
+from .models import Game, GameEvent, Player
 
 class NewGameForm(forms.Form):
     name = forms.CharField(label='Name', max_length=80, required=False)
@@ -28,7 +28,7 @@ class JoinGameForm(forms.Form):
         data = self.cleaned_data['game']
 
         try:
-            return Game.objects.get(access_code=data.lower())
+            return Game.objects.for_access_code(data).get()
         except Game.DoesNotExist:
             raise forms.ValidationError("Invalid access code.")
 
@@ -54,14 +54,10 @@ class JoinGameForm(forms.Form):
             cleaned_data["player"] = None
             return
 
-        previous_game = None
-        try:
-            previous_game = game.previous_game
-        except Game.DoesNotExist:
-            pass
+        previous_game = game.previous_game
         if previous_game is not None:
             try:
-                player = Player.objects.get(game=previous_game, name=name)
+                player = previous_game.player_set.get(name=name)
                 if not player.is_expired():
                     self.add_error('player', "Please choose a different name; there is already a player using that name.")
                     self.add_error('player', "Please try again in a few seconds if you are trying to rejoin.")
@@ -69,17 +65,21 @@ class JoinGameForm(forms.Form):
                 pass
 
         try:
-            player = Player.objects.get(game=game, name=name)
+            player = game.player_set.get(name=name)
             if player.is_expired():
                 player.change_secret_id();
                 player.save()
+                # not an event, but the live state and the materialized
+                #   status have the old secret
+                game.changed()
                 cleaned_data["player"] = player
             else:
                 self.add_error('player', "Please choose a different name; there is already a player using that name.")
                 self.add_error('player', "Please try again in a few seconds if you are trying to rejoin.")
         except Player.DoesNotExist:
             if game.game_phase == Game.GAME_PHASE_LOBBY:
-                player = Player.objects.create(game=game, name=name)
+                player = game.player_set.create(name=name)
+                game.log_event(GameEvent.EVENT_JOIN, player, name=name)
                 cleaned_data["player"] = player
             else:
                 self.add_error('player', "That game has already started. If you want to rejoin, please enter your name exactly as you did before or select \"Observe\" if you just want to display the game status.")
@@ -1,3 +1,28 @@
+import hashlib
+import os
+import random
+
+# Unlike the module-level functions in random, SystemRandom has no state that
+#   could be shared (or reseeded) between threads handling different requests.
+system_random = random.SystemRandom()
+
+def rss_kb():
+    """Resident memory of this process in KB (None if unknown)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def percentile(values, fraction):
+    """The value below which fraction of the (non-empty) values lie."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def deterministic_random_boolean(seed):
+    return hashlib.sha256(seed.encode('utf-8')).digest()[0] & 1 == 1
+
 def mission_size(num_players, round_num):
     if num_players == 5:
         if round_num == 1:
@@ -0,0 +1,304 @@
+"""Serving the pages of live games from memory instead of the database.
+
+A game is at most 10 players, 5 rounds and 25 vote rounds, so its whole state
+(everything load_game() prefetches) easily fits in memory. If
+settings.AVALON_LIVE_STATE names a store class, the status, game and observe
+views read games from that store and perform no queries at all:
+
+ * LocalStore keeps the games in this process. Only use it if there is a
+   single server process, as the other processes would never see the
+   changes.
+ * CacheStore keeps the games in the 'live_state' cache, which all processes
+   share (a file based cache by default; memcached or similar in a larger
+   deployment).
+
+The database stays the source of truth. Every change to a game logs a
+GameEvent, and Game.log_event() calls game_changed(), which writes the
+game through to the store once the transaction commits. A game that isn't in
+the store (e.g. after a restart) is loaded from the database on first access.
+
+The one write the read path would need is updating Player.last_accessed;
+touch() instead remembers it and a background thread writes the timestamps
+back every AVALON_LIVE_STATE_FLUSH_INTERVAL seconds.
+"""
+from collections import OrderedDict
+import logging
+import pickle
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+def load_game(games):
+    """The game in the queryset with everything needed to render it."""
+    from .models import Game, GameRound, VoteRound
+    # the chosen players, votes and mission actions are read from the
+    #   bitmasks on VoteRound and GameRound, so they aren't loaded
+    game_rounds = GameRound.objects.prefetch_related(
+        Prefetch('voteround_set',
+                 queryset=VoteRound.objects.select_related('leader')))
+    game = games.select_related('player_assassinated')\
+                .prefetch_related('player_set',
+                                  Prefetch('gameround_set',
+                                           queryset=game_rounds))\
+                .get()
+    if game.game_phase == Game.GAME_PHASE_END:
+        # for the scoreboard on the end page
+        game.series()
+    return game
+
+
+class LocalStore(object):
+    # get() and event_seq() don't do any I/O, so async views call them
+    #   directly instead of from a thread
+    blocking = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_games = settings.AVALON_LIVE_STATE_MAX_GAMES
+        # access code -> (event_seq, pickled game), least recently used first
+        self.games = OrderedDict()
+
+    def get(self, access_code):
+        with self.lock:
+            entry = self.games.get(access_code)
+            if entry is None:
+                return None
+            self.games.move_to_end(access_code)
+        # every request gets its own copy
+        return pickle.loads(entry[1])
+
+    def event_seq(self, access_code):
+        entry = self.games.get(access_code)
+        return None if entry is None else entry[0]
+
+    def _store(self, game, replace):
+        entry = (game.event_seq, pickle.dumps(game, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            current = self.games.get(game.access_code)
+            if current is not None and (not replace
+                                        or current[0] > game.event_seq):
+                return
+            self.games[game.access_code] = entry
+            self.games.move_to_end(game.access_code)
+            while len(self.games) > self.max_games:
+                self.games.popitem(last=False)
+
+    def add(self, game):
+        """Store game unless the store already has it."""
+        self._store(game, replace=False)
+
+    def put(self, game):
+        """Store game unless the store has a newer version of it."""
+        self._store(game, replace=True)
+
+    def discard(self, access_code):
+        with self.lock:
+            self.games.pop(access_code, None)
+
+
+class CacheStore(object):
+    blocking = True
+
+    def __init__(self):
+        self.cache = caches['live_state']
+
+    def _key(self, access_code):
+        return 'avalon-live:%s' % access_code
+
+    def _seq_key(self, access_code):
+        return 'avalon-live-seq:%s' % access_code
+
+    def get(self, access_code):
+        return self.cache.get(self._key(access_code))
+
+    def event_seq(self, access_code):
+        # kept separately so checking for changes doesn't load the game
+        return self.cache.get(self._seq_key(access_code))
+
+    def _set(self, game):
+        self.cache.set_many({self._key(game.access_code): game,
+                             self._seq_key(game.access_code): game.event_seq})
+
+    def add(self, game):
+        if self.cache.add(self._key(game.access_code), game):
+            self.cache.set(self._seq_key(game.access_code), game.event_seq)
+
+    def put(self, game):
+        # Not atomic, but the transactions of a game are serialized by the
+        #   database, so two writes racing here is very unlikely and the next
+        #   change to the game fixes it.
+        current = self.event_seq(game.access_code)
+        if current is None or current <= game.event_seq:
+            self._set(game)
+
+    def discard(self, access_code):
+        self.cache.delete_many([self._key(access_code),
+                                self._seq_key(access_code)])
+
+
+_store = None
+
+
+def store():
+    """The configured store or None if the live state is disabled."""
+    global _store
+    if _store is None and settings.AVALON_LIVE_STATE:
+        _store = import_string(settings.AVALON_LIVE_STATE)()
+    return _store
+
+
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting.startswith('AVALON_LIVE_STATE') or setting == 'CACHES':
+        _store = None
+
+setting_changed.connect(_reset_store)
+
+
+def _prepare(game):
+    # next_game/previous_game are looked up when needed, since the store
+    #   isn't updated when the linked game changes
+    game.__dict__.pop('_linked_games', None)
+    return game
+
+
+def cached_game(access_code):
+    """The game from the store or None."""
+    live_store = store()
+    if live_store is None:
+        return None
+    return live_store.get(access_code.lower())
+
+
+def cached_event_seq(access_code):
+    """The event_seq of the game in the store or None."""
+    live_store = store()
+    if live_store is None:
+        return None
+    return live_store.event_seq(access_code.lower())
+
+
+def event_seq(access_code):
+    """The event_seq of the game, from the store if possible (or None if
+    there is no such game)."""
+    from .models import Game
+    seq = cached_event_seq(access_code)
+    if seq is None:
+        seq = Game.objects.for_access_code(access_code)\
+                          .values_list('event_seq', flat=True).first()
+    return seq
+
+
+def fetch_game(games):
+    """Load the game in games from the database and add it to the store."""
+    game = load_game(games)
+    live_store = store()
+    if live_store is not None:
+        live_store.add(_prepare(game))
+    return game
+
+
+def refresh(access_code):
+    from .models import Game
+    live_store = store()
+    if live_store is None:
+        return
+    try:
+        game = load_game(Game.objects.for_access_code(access_code))
+    except Game.DoesNotExist:
+        live_store.discard(access_code)
+    else:
+        live_store.put(_prepare(game))
+
+
+def discard(access_code):
+    live_store = store()
+    if live_store is not None:
+        live_store.discard(access_code)
+
+
+def game_changed(game):
+    """Write game through to the store once the current transaction on its
+    database commits."""
+    if store() is None or game.__dict__.get('_live_state_pending'):
+        return
+    game._live_state_pending = True
+
+    def write_through():
+        game._live_state_pending = False
+        refresh(game.access_code)
+
+    transaction.on_commit(write_through, using=game._state.db)
+
+
+class TouchBuffer(object):
+    """Write-behind buffer of Player.last_accessed updates."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (database, player pk) -> last accessed
+        self.touches = {}
+        self.thread = None
+
+    def touch(self, db, pk):
+        with self.lock:
+            self.touches[(db, pk)] = timezone.now()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name='avalon-touch-flusher')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.AVALON_LIVE_STATE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                # losing some timestamps only makes players look idle
+                logger.exception("Writing back last_accessed failed.")
+            finally:
+                connections.close_all()
+
+    def flush(self):
+        from .models import Player
+        with self.lock:
+            touches, self.touches = self.touches, {}
+        by_db = {}
+        for (db, pk), last_accessed in touches.items():
+            by_db.setdefault(db, []).append((pk, last_accessed))
+        for db, updates in by_db.items():
+            with transaction.atomic(using=db):
+                for pk, last_accessed in updates:
+                    Player.objects.using(db).filter(pk=pk)\
+                                  .update(last_accessed=last_accessed)
+
+
+TOUCHES = TouchBuffer()
+
+
+def touch(player):
+    """Update player.last_accessed, later if the live state is enabled."""
+    if store() is None:
+        player.save(update_fields=['last_accessed'])
+    else:
+        TOUCHES.touch(player._state.db, player.pk)
+
+
+def touch_pk(db, pk):
+    """touch() for views which only have the primary key of the player."""
+    from .models import Player
+    if store() is None:
+        Player.objects.using(db).filter(pk=pk)\
+                      .update(last_accessed=timezone.now())
+    else:
+        TOUCHES.touch(db, pk)
@@ -0,0 +1,78 @@
+"""Waiting for games to change without tying up a thread per client.
+
+The long-poll views (status_wait and observe_status_wait in views.py) park
+the request in wait_for_change() until the game's event_seq moves on. However
+many clients wait on a game, there is only one watcher task per game and
+event loop which checks the event_seq every AVALON_LONG_POLL_INTERVAL seconds
+(from the live-state store if possible, see livestate.py, otherwise with one
+query in a worker thread) and wakes them all up when it changes. An idle
+client therefore only costs a suspended coroutine.
+"""
+import asyncio
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import livestate
+
+# event loop -> access code -> _Watch
+_watches = weakref.WeakKeyDictionary()
+
+
+class _Watch(object):
+    def __init__(self, seq):
+        self.seq = seq
+        self.changed = asyncio.Event()
+        self.waiters = 0
+
+
+async def current_event_seq(access_code):
+    live_store = livestate.store()
+    if live_store is not None and not live_store.blocking:
+        seq = livestate.cached_event_seq(access_code)
+        if seq is not None:
+            return seq
+    return await sync_to_async(livestate.event_seq)(access_code)
+
+
+async def _watch(watches, access_code, watch):
+    try:
+        while watch.waiters:
+            await asyncio.sleep(settings.AVALON_LONG_POLL_INTERVAL)
+            if await current_event_seq(access_code) != watch.seq:
+                watch.changed.set()
+                return
+    finally:
+        if watches.get(access_code) is watch:
+            del watches[access_code]
+
+
+async def wait_for_change(access_code, seq, timeout):
+    """Wait until the event_seq of the game isn't seq anymore. Returns False
+    if that didn't happen within timeout seconds."""
+    watches = _watches.setdefault(asyncio.get_running_loop(), {})
+    watch = watches.get(access_code)
+    if watch is not None and watch.seq != seq:
+        # the caller is already out of date
+        return True
+    if watch is None:
+        watch = watches[access_code] = _Watch(seq)
+        asyncio.ensure_future(_watch(watches, access_code, watch))
+    watch.waiters += 1
+    try:
+        await asyncio.wait_for(watch.changed.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        watch.waiters -= 1
+
+
+def waiting():
+    """Number of requests waiting in this thread's event loop."""
+    try:
+        watches = _watches.get(asyncio.get_running_loop(), {})
+    except RuntimeError:
+        return 0
+    return sum(watch.waiters for watch in watches.values())
@@ -0,0 +1,139 @@
+from contextlib import ExitStack
+from datetime import timedelta
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from avalon_game.helpers import percentile
+from avalon_game.management.commands.generate_games import GameGenerator,\
+                                                       generate_games
+from avalon_game.metrics import QueryCounter
+from avalon_game.models import Game
+
+HOT_VIEWS = ('status', 'game', 'join_game', 'enter_code')
+
+HEADER = "%10s %-11s %8s %8s %8s %8s" % ('games', 'view', 'p50 ms', 'p90 ms',
+                                        'p99 ms', 'queries')
+
+
+class Command(BaseCommand):
+    help = "Measure the latency of the most requested views (%s) on a game "\
+           "being played while the database grows, filling fresh test "\
+           "databases with historical games (see generate_games) between "\
+           "measurements." % ', '.join(HOT_VIEWS)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='0,10000,100000',
+                            help="Comma-separated numbers of historical "
+                                 "games to measure with, in increasing "
+                                 "order.")
+        parser.add_argument('--requests', type=int, default=200,
+                            help="Requests per view and size.")
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("--sizes must be comma-separated numbers.")
+        if sizes != sorted(sizes) or sizes[0] < 0:
+            raise CommandError("--sizes must be increasing and not "
+                               "negative.")
+        if options['requests'] <= 0:
+            raise CommandError("--requests must be positive.")
+
+        span = timedelta(days=3 * 365)
+        generator = GameGenerator(random.Random(options['seed']),
+                                  timezone.now() - span,
+                                  span / max(sizes[-1], 1) * 1.5)
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            # the test client's host
+            with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS
+                                                 + ['testserver']):
+                self.stdout.write(HEADER)
+                generated = 0
+                for size in sizes:
+                    if size > generated:
+                        generate_games(size - generated, generator)
+                        generated = size
+                    for view, times, queries in self.run(
+                            options['requests']):
+                        self.stdout.write("%10d %-11s %8.2f %8.2f %8.2f %8.1f"
+                                          % (size, view,
+                                             percentile(times, 0.5) * 1000,
+                                             percentile(times, 0.9) * 1000,
+                                             percentile(times, 0.99) * 1000,
+                                             1.0 * queries / len(times)))
+        finally:
+            runner.teardown_databases(old_config)
+
+    def new_game(self, client, num_players):
+        """Create a game with num_players players through the views and
+        return it."""
+        response = client.post(reverse('new_game'), {'name': 'p0'})
+        access_code = response.url.strip('/').split('/')[-2]
+        for i in range(1, num_players):
+            client.post(reverse('enter_code'),
+                        {'game': access_code, 'player': 'p%d' % i})
+        return Game.objects.for_access_code(access_code).get()
+
+    def requests(self, client, view, num_requests):
+        """The (method, path, data) of the requests to time for view."""
+        if view == 'enter_code':
+            # each joins a lobby as a new player, filling up one game after
+            #   the other
+            game = None
+            for i in range(num_requests):
+                if i % 9 == 0:
+                    game = self.new_game(client, 1)
+                yield 'post', reverse('enter_code'),\
+                      {'game': game.access_code, 'player': 'j%d' % i}
+            return
+        # a game in the pick phase, which is most of a game
+        game = self.new_game(client, 5)
+        players = list(game.player_set.all())
+        client.post(reverse('start', kwargs={
+            'access_code': game.access_code,
+            'player_secret': players[0].secret_id}),
+            {'merlin': 'on', 'assassin': 'on'})
+        for player in players:
+            client.post(reverse('ready', kwargs={
+                'access_code': game.access_code,
+                'player_secret': player.secret_id}))
+        for i in range(num_requests):
+            kwargs = {'access_code': game.access_code}
+            if view != 'join_game':
+                kwargs['player_secret'] = players[i % 5].secret_id
+            yield 'get', reverse(view, kwargs=kwargs), None
+
+    def run(self, num_requests):
+        client = Client()
+        for view in HOT_VIEWS:
+            times = []
+            counter = QueryCounter()
+            for method, path, data in self.requests(client, view,
+                                                    num_requests):
+                with ExitStack() as stack:
+                    for connection in connections.all():
+                        stack.enter_context(
+                            connection.execute_wrapper(counter))
+                    start = time.perf_counter()
+                    if method == 'post':
+                        response = client.post(path, data)
+                    else:
+                        response = client.get(path)
+                    times.append(time.perf_counter() - start)
+                if response.status_code not in (200, 302):
+                    raise CommandError("%s failed (%d)."
+                                       % (view, response.status_code))
+            yield view, times, counter.queries
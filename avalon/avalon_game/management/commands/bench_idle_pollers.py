@@ -0,0 +1,162 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from avalon_game import longpoll
+from avalon_game.helpers import rss_kb
+from avalon_game.models import Game, GameEvent
+from avalon_game.views import status_etag
+
+
+class ASGIClient(object):
+    """Calls the ASGI application directly, without a server or sockets."""
+    def __init__(self):
+        self.application = get_asgi_application()
+
+    async def get(self, path, headers):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode('ascii'),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'localhost')] +
+                       [(k.lower().encode('ascii'), v.encode('ascii'))
+                        for k, v in headers.items()],
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80),
+        }
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        await self.application(scope, receive, send)
+        return status[0]
+
+
+class HTTPClient(object):
+    """Minimal HTTP/1.1 client, one connection per request."""
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+
+    async def get(self, path, headers):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % self.host,
+                     'Connection: close']
+            lines += ['%s: %s' % item for item in headers.items()]
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('ascii'))
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+
+class Command(BaseCommand):
+    help = "Measure how many idle long-polling clients (status/wait/) a "\
+           "single process can hold."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pollers', default='100,500,1000,2000',
+                            help="Comma-separated numbers of concurrent "
+                                 "clients to try.")
+        parser.add_argument('--hold', type=float, default=3.0,
+                            help="Seconds to keep the clients waiting.")
+        parser.add_argument('--url', default=None,
+                            help="Benchmark a running server (e.g. "
+                                 "http://localhost:8000) sharing this "
+                                 "database instead of calling the ASGI "
+                                 "application in this process.")
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(n) for n in options['pollers'].split(',')]
+        except ValueError:
+            raise CommandError("--pollers must be a list of numbers.")
+        if not settings.AVALON_ASYNC_POLLING:
+            raise CommandError("The long polls are only served with "
+                               "AVALON_ASYNC_POLLING=1 (see avalon/asgi.py).")
+        if options['url']:
+            client = HTTPClient(options['url'])
+        else:
+            client = ASGIClient()
+
+        game = Game.objects.create()
+        try:
+            player = game.player_set.create(name='bench')
+            game.log_event(GameEvent.EVENT_JOIN, player, name=player.name)
+            self.stdout.write("pollers  parked(s)  rss/poller(KB)  "
+                              "loop lag(ms)  status(ms)  wake-up(s)  errors")
+            for count in counts:
+                row = asyncio.run(self.run(client, game, player, count,
+                                           options['hold'],
+                                           in_process=not options['url']))
+                self.stdout.write("%7d  %9.2f  %14s  %12.1f  %10.1f  %10.2f"
+                                  "  %6d" % row)
+        finally:
+            Game.objects.using(game._state.db).filter(pk=game.pk).delete()
+
+    async def run(self, client, game, player, count, hold, in_process):
+        kwargs = {'access_code': game.access_code,
+                  'player_secret': player.secret_id}
+        wait_path = reverse('status_wait', kwargs=kwargs)
+        status_path = reverse('status', kwargs=kwargs)
+        game = await sync_to_async(Game.objects.using(game._state.db).get)(
+            pk=game.pk)
+        headers = {'If-None-Match': status_etag(game, player)}
+
+        rss_before = rss_kb()
+        start = time.perf_counter()
+        pollers = [asyncio.ensure_future(client.get(wait_path, headers))
+                   for i in range(count)]
+        # wait until they're all parked (only known in this process)
+        while in_process and longpoll.waiting() < count\
+                and time.perf_counter() - start < hold:
+            await asyncio.sleep(0.01)
+        parked = time.perf_counter() - start
+        rss_after = rss_kb()
+
+        # how late the event loop runs while holding the clients
+        lag = 0.0
+        deadline = time.perf_counter() + hold
+        while time.perf_counter() < deadline:
+            before = time.perf_counter()
+            await asyncio.sleep(0.05)
+            lag = max(lag, time.perf_counter() - before - 0.05)
+
+        before = time.perf_counter()
+        await client.get(status_path, {})
+        status_time = time.perf_counter() - before
+
+        # a change wakes everyone up
+        before = time.perf_counter()
+        await sync_to_async(game.log_event)(GameEvent.EVENT_READY, player)
+        results = await asyncio.gather(*pollers, return_exceptions=True)
+        wake_up = time.perf_counter() - before
+        errors = len([r for r in results if r != 200])
+
+        if in_process and rss_before is not None:
+            rss = '%.1f' % ((rss_after - rss_before) / float(count))
+        else:
+            rss = '-'
+        return (count, parked, rss, lag * 1000, status_time * 1000, wake_up,
+                errors)
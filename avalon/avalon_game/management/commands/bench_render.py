@@ -0,0 +1,141 @@
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestFilesMixin,\
+                                               staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from avalon_game.helpers import percentile, rss_kb
+from avalon_game.models import Game, VoteRound
+
+HEADER = "%-10s %8s %8s %8s %8s %10s %11s %8s" % (
+    'profile', 'requests', 'mean ms', 'p50 ms', 'p90 ms', 'rss (KB)',
+    'rss/req (B)', 'queries')
+
+
+class Command(BaseCommand):
+    help = "Measure the time and memory growth of rendering the game page "\
+           "in the vote phase (the deepest template chain) with the current "\
+           "settings, or compare the default and production profiles (see "\
+           "AVALON_PRODUCTION in settings.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--compare', action='store_true',
+                            help="Run the benchmark once with each profile, "
+                                 "each in a new process.")
+        parser.add_argument('--no-header', action='store_true',
+                            help="Only print the row of results.")
+
+    def handle(self, *args, **options):
+        if options['requests'] <= 0:
+            raise CommandError("--requests must be positive.")
+        if options['compare']:
+            self.stdout.write(HEADER)
+            for production in ('0', '1'):
+                env = dict(os.environ, AVALON_PRODUCTION=production)
+                # the benchmark only uses test databases
+                env.setdefault('AVALON_SECRET_KEY', settings.SECRET_KEY)
+                result = subprocess.run(
+                    [sys.executable, '-m', 'django', 'bench_render',
+                     '--requests', str(options['requests']), '--no-header'],
+                    env=env, cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+                    universal_newlines=True)
+                if result.returncode:
+                    raise CommandError("The benchmark failed with "
+                                       "AVALON_PRODUCTION=%s." % production)
+                self.stdout.write(result.stdout, ending='')
+            return
+
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        static_root = tempfile.mkdtemp()
+        try:
+            # the test client's host
+            with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS
+                                                 + ['testserver'],
+                                   STATIC_ROOT=static_root):
+                if isinstance(staticfiles_storage, ManifestFilesMixin):
+                    # {% static %} looks the hashed names up in the manifest
+                    call_command('collectstatic', interactive=False,
+                                 verbosity=0)
+                row = self.run(options['requests'])
+        finally:
+            runner.teardown_databases(old_config)
+            shutil.rmtree(static_root)
+        if not options['no_header']:
+            self.stdout.write(HEADER)
+        self.stdout.write("%-10s %8d %8.2f %8.2f %8.2f %10s %11s %8d" % row)
+
+    def vote_phase(self, client):
+        """Create a 5 player game waiting on everyone's vote and return the
+        URLs of the game page of each player."""
+        response = client.post(reverse('new_game'), {'name': 'p0'})
+        access_code = response.url.strip('/').split('/')[-2]
+        for i in range(1, 5):
+            client.post(reverse('enter_code'),
+                        {'game': access_code, 'player': 'p%d' % i})
+        game = Game.objects.for_access_code(access_code).get()
+        players = list(game.player_set.all())
+
+        def url(name, player, **kwargs):
+            return reverse(name, kwargs=dict(kwargs, access_code=access_code,
+                                             player_secret=player.secret_id))
+
+        client.post(url('start', players[0]),
+                    {'merlin': 'on', 'assassin': 'on'})
+        for player in players:
+            client.post(url('ready', player))
+        game = Game.objects.for_access_code(access_code).get()
+        leader = VoteRound.objects.get_current_vote_round(game).leader
+        client.post(url('propose_team', leader, round_num=1, vote_num=1),
+                    {'team': [leader.order, (leader.order + 1) % 5],
+                     'finalize': 'on'})
+        if Game.objects.for_access_code(access_code).get().game_phase\
+                != Game.GAME_PHASE_VOTE:
+            raise CommandError("Couldn't set up a game in the vote phase.")
+        return [url('game', player) for player in players]
+
+    def run(self, num_requests):
+        client = Client()
+        urls = self.vote_phase(client)
+        # the first renders load the templates either way
+        for url in urls:
+            client.get(url)
+        gc.collect()
+        rss_before = rss_kb()
+        times = []
+        for i in range(num_requests):
+            start = time.perf_counter()
+            response = client.get(urls[i % len(urls)])
+            times.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise CommandError("The game page failed (%d)."
+                                   % response.status_code)
+        gc.collect()
+        rss_after = rss_kb()
+        if rss_before is None:
+            rss = per_request = '-'
+        else:
+            rss = '%d' % (rss_after - rss_before)
+            per_request = '%.0f' % ((rss_after - rss_before) * 1024.0
+                                    / num_requests)
+        # the queries Django keeps in memory in debug mode
+        queries = sum(len(connections[alias].queries_log)
+                      for alias in connections)
+        return ('production' if settings.AVALON_PRODUCTION else 'default',
+                num_requests, sum(times) / num_requests * 1000,
+                percentile(times, 0.5) * 1000,
+                percentile(times, 0.9) * 1000, rss, per_request, queries)
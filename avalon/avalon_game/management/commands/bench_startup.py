@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from avalon_game.helpers import percentile
+
+# Run in a new process for each measurement, so nothing is imported or cached
+#   yet. Prints the timings (in seconds) as JSON.
+CHILD = r'''
+import io
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+loaded = time.perf_counter()
+from avalon_game.warmup import warm_up
+warm_up()
+warmed = time.perf_counter()
+
+
+def request(path):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost', 'SCRIPT_NAME': '',
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http', 'wsgi.version': (1, 0),
+        'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    status = []
+    before = time.perf_counter()
+    body = b''.join(application(environ,
+                                lambda s, headers, *args: status.append(s)))
+    return time.perf_counter() - before, int(status[0].split()[0])
+
+
+first, first_status = request(%(path)r)
+second, second_status = request(%(path)r)
+print(json.dumps({
+    'load': loaded - start, 'warm_up': warmed - loaded,
+    'first': first, 'second': second,
+    'status': max(first_status, second_status),
+    'qrcode': 'qrcode' in sys.modules,
+}))
+'''
+
+
+class Command(BaseCommand):
+    help = "Measure how long a new server process takes to load the "\
+           "application and answer its first request, with and without "\
+           "the warm-up (see avalon_game/warmup.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5,
+                            help="Processes to start for each setting (the "
+                                 "median is reported).")
+        parser.add_argument('--path', default='/join/',
+                            help="Page to request.")
+
+    def measure(self, warm_up, path):
+        env = dict(os.environ, AVALON_WARM_UP='1' if warm_up else '0')
+        result = subprocess.run(
+            [sys.executable, '-c', CHILD % {'path': path}], env=env,
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode:
+            raise CommandError("The new process failed.")
+        return json.loads(result.stdout.splitlines()[-1])
+
+    def handle(self, *args, **options):
+        if options['runs'] <= 0:
+            raise CommandError("--runs must be positive.")
+        self.stdout.write("%-8s %8s %10s %10s %10s %10s %7s %7s"
+                          % ('warm-up', 'load ms', 'warm-up ms', 'first ms',
+                             'second ms', 'ready ms', 'status', 'qrcode'))
+        for warm_up in (False, True):
+            runs = [self.measure(warm_up, options['path'])
+                    for i in range(options['runs'])]
+
+            median = {key: percentile([run[key] for run in runs], 0.5)
+                           * 1000
+                      for key in ('load', 'warm_up', 'first', 'second')}
+            self.stdout.write(
+                "%-8s %8.1f %10.1f %10.1f %10.1f %10.1f %7d %7s"
+                % ('on' if warm_up else 'off', median['load'],
+                   median['warm_up'], median['first'], median['second'],
+                   # from process start until the first response is sent
+                   median['load'] + median['warm_up'] + median['first'],
+                   max(run['status'] for run in runs),
+                   'yes' if any(run['qrcode'] for run in runs) else 'no'))
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from avalon_game.analytics import LATENCY_BUCKETS, decision_latency
+from avalon_game.export import parse_day
+
+
+class Command(BaseCommand):
+    help = "Summarize how long leaders take to pick teams and players take "\
+           "to vote."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="First day (YYYY-MM-DD) of vote "
+                                            "rounds to include.")
+        parser.add_argument('--until', help="Last day (YYYY-MM-DD) of vote "
+                                            "rounds to include.")
+        parser.add_argument('--json', action='store_true',
+                            help="Output JSON instead of a table.")
+
+    def handle(self, *args, **options):
+        try:
+            rows = decision_latency(
+                since=parse_day(options['since']),
+                until=parse_day(options['until'], end_of_day=True))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+
+        buckets = ["<%ds" % b for b in LATENCY_BUCKETS]\
+                  + [">=%ds" % LATENCY_BUCKETS[-1]]
+        self.stdout.write("%7s %5s %4s  %-5s %5s %8s %8s %8s  %s"
+                          % ('players', 'round', 'vote', 'phase', 'count',
+                             'avg', 'min', 'max', ' '.join(buckets)))
+        for row in rows:
+            for interval in ('pick', 'vote'):
+                stats = row.get(interval)
+                if stats is None:
+                    continue
+                self.stdout.write("%7s %5d %4d  %-5s %5d %8.1f %8.1f %8.1f  %s"
+                                  % (row['num_players'], row['round_num'],
+                                     row['vote_num'], interval,
+                                     stats['count'], stats['avg'],
+                                     stats['min'], stats['max'],
+                                     ' '.join('%*d' % (len(b), n)
+                                              for b, n in zip(
+                                                  buckets,
+                                                  stats['histogram']))))
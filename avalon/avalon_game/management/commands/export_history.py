@@ -0,0 +1,43 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from avalon_game.export import EXPORT_FORMATS, export_lines, exported_games,\
+                               history_records, parse_day
+
+
+class Command(BaseCommand):
+    help = "Export the vote rounds and mission actions of finished games."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS,
+                            default='ndjson')
+        parser.add_argument('--since', help="First day (YYYY-MM-DD) of games "
+                                            "to export.")
+        parser.add_argument('--until', help="Last day (YYYY-MM-DD) of games "
+                                            "to export.")
+        parser.add_argument('--min-players', type=int, default=None)
+        parser.add_argument('--max-players', type=int, default=None)
+        parser.add_argument('--output', '-o', default=None,
+                            help="File to write to (default: stdout).")
+
+    def handle(self, *args, **options):
+        try:
+            games = exported_games(
+                since=parse_day(options['since']),
+                until=parse_day(options['until'], end_of_day=True),
+                min_players=options['min_players'],
+                max_players=options['max_players'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        lines = export_lines(options['format'], history_records(games))
+        if options['output'] is None:
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'w', newline='')
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
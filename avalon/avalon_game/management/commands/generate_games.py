@@ -0,0 +1,438 @@
+from collections import defaultdict
+from datetime import timedelta
+import json
+import math
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, models, transaction
+from django.utils import timezone
+
+from avalon_game.codes import random_codes
+from avalon_game.helpers import mission_size
+from avalon_game.models import CodeSequence, Game, GameRound, GameStats,\
+                               MissionAction, Player, PlayerVote, Series,\
+                               VoteRound
+from avalon_game.sharding import shard_for_code
+
+# (number of players, relative frequency)
+PLAYER_COUNTS = ((5, 22), (6, 20), (7, 20), (8, 16), (9, 10), (10, 12))
+# chance that the table plays another game (see Game.rematch())
+REMATCH_CHANCE = 0.45
+# chance that a game never leaves the lobby
+ABANDONED_CHANCE = 0.1
+# chance of each optional special role being in a game
+PERCIVAL_CHANCE = 0.6
+MORGANA_CHANCE = 0.6
+MORDRED_CHANCE = 0.3
+OBERON_CHANCE = 0.15
+# chance that the leader is on their own team
+LEADER_ON_TEAM_CHANCE = 0.8
+# chance that a spy on a mission plays fail
+SPY_FAIL_CHANCE = 0.75
+# chance that the assassin finds Merlin
+MERLIN_FOUND_CHANCE = 0.3
+# chance that a player approves a team: (without spies, with spies, on the
+#   final vote)
+APPROVE_CHANCE = (0.65, 0.45, 0.9)
+
+NAMES = ['Alex', 'Ana', 'Ben', 'Cam', 'Chris', 'Dana', 'Dev', 'Eli', 'Emma',
+         'Finn', 'Gabe', 'Grace', 'Hana', 'Ian', 'Ivy', 'Jack', 'Jade',
+         'Jess', 'Kai', 'Kim', 'Leo', 'Lily', 'Max', 'Maya', 'Nate', 'Nina',
+         'Omar', 'Pat', 'Quinn', 'Rosa', 'Sam', 'Sara', 'Theo', 'Tess',
+         'Uma', 'Vic', 'Will', 'Xena', 'Yuki', 'Zoe']
+
+# the models whose primary keys the generated rows refer to
+_GAME_ROW_MODELS = (Game, Player, GameRound, VoteRound)
+# the fields of the generated rows, in the order of insertion
+_GAME_ROW_FIELDS = (
+    (Game, ('id', 'access_code', 'game_phase', 'times_started',
+            'display_history', 'private_voting', 'player_assassinated',
+            'created', 'ended', 'next_access_code', 'previous_access_code',
+            'series_code', 'role_summary', 'event_seq')),
+    (Player, ('id', 'game', 'secret_id', 'name', 'role', 'order', 'ready',
+              'joined', 'last_accessed', 'visible_spies',
+              'possible_merlins')),
+    (GameRound, ('id', 'game', 'round_num', 'mission_passed', 'played_mask',
+                 'failed_mask')),
+    (MissionAction, ('game_round', 'player', 'played_success')),
+    (VoteRound, ('id', 'game_round', 'vote_num', 'vote_status', 'leader',
+                 'chosen_mask', 'voted_mask', 'accepted_mask', 'started',
+                 'chose_team', 'voted')),
+    (VoteRound.chosen.through, ('voteround', 'player')),
+    (PlayerVote, ('vote_round', 'player', 'accept')),
+)
+
+
+def _seconds(rng, low, high):
+    return timedelta(seconds=rng.uniform(low, high))
+
+
+class GameGenerator(object):
+    """Plays random but plausible games in memory, a table (series of games)
+    at a time, with tables arriving every mean_gap on average from start."""
+    def __init__(self, rng, start, mean_gap):
+        self.rng = rng
+        self.time = start
+        self.mean_gap = mean_gap
+
+    def tables(self):
+        while True:
+            self.time += timedelta(seconds=self.rng.expovariate(
+                1.0 / self.mean_gap.total_seconds()))
+            yield self.table(self.time)
+
+    def table(self, start):
+        """The games played by one table, each a dict with the rows of the
+        game and its players and rounds."""
+        num_players = self.rng.choices(
+            [n for n, _ in PLAYER_COUNTS],
+            [weight for _, weight in PLAYER_COUNTS])[0]
+        names = self.rng.sample(NAMES, num_players)
+        if self.rng.random() < ABANDONED_CHANCE:
+            return [self.abandoned(start, names[:self.rng.randint(1, 5)])]
+        games = []
+        time = start
+        while True:
+            game = self.game(time, names)
+            games.append(game)
+            time = game['ended'] + _seconds(self.rng, 30, 180)
+            if self.rng.random() >= REMATCH_CHANCE:
+                return games
+
+    def abandoned(self, created, names):
+        time = created
+        players = []
+        for name in names:
+            players.append({'name': name, 'role': None, 'order': None,
+                            'joined': time, 'last_accessed': time})
+            time += _seconds(self.rng, 5, 60)
+        return {'created': created, 'ended': None,
+                'game_phase': Game.GAME_PHASE_LOBBY, 'times_started': 0,
+                'display_history': None, 'private_voting': None,
+                'players': players, 'rounds': [], 'assassinated': None}
+
+    def roles(self, num_players):
+        num_spies = int(math.ceil(num_players / 3.0))
+        resistance_roles = [Player.ROLE_MERLIN]
+        spy_roles = [Player.ROLE_ASSASSIN]
+        if self.rng.random() < PERCIVAL_CHANCE:
+            resistance_roles.append(Player.ROLE_PERCIVAL)
+            if self.rng.random() < MORGANA_CHANCE:
+                spy_roles.append(Player.ROLE_MORGANA)
+        for role, chance in ((Player.ROLE_MORDRED, MORDRED_CHANCE),
+                             (Player.ROLE_OBERON, OBERON_CHANCE)):
+            if len(spy_roles) < num_spies and self.rng.random() < chance:
+                spy_roles.append(role)
+        roles = spy_roles + resistance_roles\
+                + [Player.ROLE_SPY] * (num_spies - len(spy_roles))\
+                + [Player.ROLE_GOOD] * (num_players - num_spies
+                                        - len(resistance_roles))
+        self.rng.shuffle(roles)
+        return roles
+
+    def game(self, created, names):
+        """Play a game like the views would (see vote(), mission() and
+        assassinate() in views.py)."""
+        rng = self.rng
+        num_players = len(names)
+        roles = self.roles(num_players)
+        orders = list(range(num_players))
+        rng.shuffle(orders)
+        spies = {order for order, role in zip(orders, roles) if role < 0}
+        players = []
+        time = created
+        for name, role, order in zip(names, roles, orders):
+            players.append({'name': name, 'role': role, 'order': order,
+                            'joined': time})
+            time += _seconds(rng, 5, 60)
+        time += _seconds(rng, 30, 120)
+
+        rounds = []
+        leader = rng.randrange(num_players)
+        passed = failed = 0
+        while passed < 3 and failed < 3:
+            round_num = len(rounds) + 1
+            team_size, fails_required = mission_size(num_players, round_num)
+            game_round = {'round_num': round_num, 'mission_passed': None,
+                          'played_mask': 0, 'failed_mask': 0, 'votes': []}
+            rounds.append(game_round)
+            for vote_num in range(1, 6):
+                others = [o for o in range(num_players) if o != leader]
+                team = rng.sample(others, team_size - 1) + [leader]\
+                       if rng.random() < LEADER_ON_TEAM_CHANCE\
+                       else rng.sample(others, team_size)
+                if vote_num == 5:
+                    approve_chance = APPROVE_CHANCE[2]
+                else:
+                    approve_chance = APPROVE_CHANCE[bool(spies & set(team))]
+                accepted = [o for o in range(num_players)
+                            if rng.random() < approve_chance]
+                started = time
+                chose_team = started + _seconds(rng, 15, 150)
+                time = chose_team + _seconds(rng, 10, 60)
+                game_round['votes'].append({
+                    'vote_num': vote_num, 'leader': leader, 'chosen': team,
+                    'accepted': accepted, 'started': started,
+                    'chose_team': chose_team, 'voted': time})
+                leader = (leader + 1) % num_players
+                if 2 * len(accepted) > num_players:
+                    break
+            else:
+                # the final team was rejected too, so the spies win
+                break
+            fails = [o for o in team
+                     if o in spies and rng.random() < SPY_FAIL_CHANCE]
+            game_round['played_mask'] = _mask(team)
+            game_round['failed_mask'] = _mask(fails)
+            game_round['mission_passed'] = len(fails) < fails_required
+            if game_round['mission_passed']:
+                passed += 1
+            else:
+                failed += 1
+            time += _seconds(rng, 20, 90)
+
+        assassinated = None
+        if passed == 3:
+            merlin = orders[roles.index(Player.ROLE_MERLIN)]
+            resistance = [o for o in range(num_players) if o not in spies]
+            assassinated = merlin if rng.random() < MERLIN_FOUND_CHANCE\
+                           else rng.choice([o for o in resistance
+                                            if o != merlin])
+            time += _seconds(rng, 30, 180)
+        for player in players:
+            player['last_accessed'] = time + _seconds(rng, 0, 60)
+        return {'created': created, 'ended': time,
+                'game_phase': Game.GAME_PHASE_END, 'times_started': 1,
+                'display_history': rng.random() < 0.8,
+                'private_voting': rng.random() < 0.8,
+                'players': players, 'rounds': rounds,
+                'assassinated': assassinated}
+
+
+def _mask(orders):
+    mask = 0
+    for order in orders:
+        mask |= 1 << order
+    return mask
+
+
+def _next_ids(using):
+    # Only safe while holding the write lock, which the transaction takes
+    #   right away (see avalon/sqlite3).
+    return {model: (model.objects.using(using)
+                    .aggregate(max_id=models.Max('pk'))['max_id'] or 0) + 1
+            for model in _GAME_ROW_MODELS}
+
+
+def _insert_rows(using, model, fields, rows):
+    """Insert rows (tuples of the database values of fields) into the table
+    of model. Like bulk_create(), but without building a model instance for
+    every row, which is most of the time bulk_create() takes."""
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(model._meta.get_field(name).column)
+                  for name in fields),
+        ', '.join(['%s'] * len(fields)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    return len(rows)
+
+
+def _insert_games(using, games):
+    """Insert the games (with their access codes and player secrets set) on
+    database using. The primary keys are assigned here so the rows can refer
+    to each other without reading them back."""
+    datetime_value = connections[using].ops.adapt_datetimefield_value
+    ids = _next_ids(using)
+    rows = defaultdict(list)
+    for data in games:
+        game_id = ids[Game]
+        ids[Game] += 1
+        # only for assign_knowledge()
+        game = Game()
+        player_list = []
+        for player_data in data['players']:
+            player_list.append(Player(id=ids[Player],
+                                      role=player_data['role'],
+                                      order=player_data['order']))
+            ids[Player] += 1
+        if data['game_phase'] != Game.GAME_PHASE_LOBBY:
+            game.assign_knowledge(player_list)
+        for player_data, player in zip(data['players'], player_list):
+            rows[Player].append((
+                player.id, game_id, player_data['secret'],
+                player_data['name'], player.role, player.order,
+                player.role is not None,
+                datetime_value(player_data['joined']),
+                datetime_value(player_data['last_accessed']),
+                player.visible_spies, player.possible_merlins))
+        # the players of a started game by order
+        players = {player.order: player for player in player_list}
+        rows[Game].append((
+            game_id, data['code'], data['game_phase'],
+            data['times_started'], data['display_history'],
+            data['private_voting'],
+            None if data['assassinated'] is None
+            else players[data['assassinated']].id,
+            datetime_value(data['created']), datetime_value(data['ended']),
+            data['next'], data['previous'], data['series'],
+            game.role_summary, 0))
+        for round_data in data['rounds']:
+            round_id = ids[GameRound]
+            ids[GameRound] += 1
+            rows[GameRound].append((
+                round_id, game_id, round_data['round_num'],
+                round_data['mission_passed'], round_data['played_mask'],
+                round_data['failed_mask']))
+            for order, player in players.items():
+                if round_data['played_mask'] >> order & 1:
+                    rows[MissionAction].append((
+                        round_id, player.id,
+                        not round_data['failed_mask'] >> order & 1))
+            for vote_data in round_data['votes']:
+                vote_id = ids[VoteRound]
+                ids[VoteRound] += 1
+                rows[VoteRound].append((
+                    vote_id, round_id, vote_data['vote_num'],
+                    VoteRound.VOTE_STATUS_VOTED,
+                    players[vote_data['leader']].id,
+                    _mask(vote_data['chosen']), (1 << len(players)) - 1,
+                    _mask(vote_data['accepted']),
+                    datetime_value(vote_data['started']),
+                    datetime_value(vote_data['chose_team']),
+                    datetime_value(vote_data['voted'])))
+                rows[VoteRound.chosen.through].extend(
+                    (vote_id, players[order].id)
+                    for order in vote_data['chosen'])
+                accepted = set(vote_data['accepted'])
+                rows[PlayerVote].extend(
+                    (vote_id, player.id, order in accepted)
+                    for order, player in players.items())
+    return sum(_insert_rows(using, model, fields, rows[model])
+               for model, fields in _GAME_ROW_FIELDS)
+
+
+def _results(data):
+    """(GameStats key, GameStats.game_totals(), Series.game_results()) of a
+    finished game."""
+    players = data['players']
+    roles = {p['order']: p['role'] for p in players}
+    passed = len([r for r in data['rounds'] if r['mission_passed']])
+    assassinated = data['assassinated']
+    merlin_assassinated = assassinated is not None\
+                          and roles[assassinated] == Player.ROLE_MERLIN
+    resistance_won = passed == 3 and not merlin_assassinated
+    role_config = ", ".join(sorted(
+        Player(role=p['role']).role_string() for p in players
+        if p['role'] not in (Player.ROLE_SPY, Player.ROLE_GOOD)))
+    totals = {
+        'games': 1,
+        'resistance_wins': 1 if resistance_won else 0,
+        'missions': len([r for r in data['rounds']
+                         if r['mission_passed'] is not None]),
+        'vote_rounds': sum(len(r['votes']) for r in data['rounds']),
+        'assassinations': 0 if assassinated is None else 1,
+        'merlin_assassinated': 1 if merlin_assassinated else 0,
+    }
+    return ((len(players), role_config), totals,
+            (resistance_won, merlin_assassinated,
+             {p['name']: (p['role'] < 0) != resistance_won for p in players}))
+
+
+def generate_games(num_games, generator, batch_size=1000):
+    """Insert num_games games from generator (a GameGenerator) in batches
+    of about batch_size games, keeping GameStats and Series up to date.
+    Returns the number of rows inserted."""
+    tables = generator.tables()
+    num_rows = 0
+    while num_games > 0:
+        batch = []
+        while sum(len(table) for table in batch) < min(batch_size,
+                                                       num_games):
+            batch.append(next(tables))
+        # the last table may not get to play all of its games
+        extra = sum(len(table) for table in batch) - num_games
+        if extra > 0:
+            batch[-1] = batch[-1][:len(batch[-1]) - extra]
+        games = [data for table in batch for data in table]
+        num_games -= len(games)
+        codes = iter(CodeSequence.allocate(CodeSequence.ACCESS_CODE,
+                                           Game.ACCESS_CODE_LENGTH,
+                                           count=len(games)))
+        for table in batch:
+            for data in table:
+                data['code'] = next(codes)
+                data['series'] = table[0]['code']
+                secrets = random_codes(Player.SECRET_ID_LENGTH,
+                                       len(data['players']))
+                for player, secret in zip(data['players'], secrets):
+                    player['secret'] = secret
+            # each game is the next game of the one before
+            for previous, data in zip([None] + table, table + [None]):
+                if data is not None:
+                    data['previous'] = None if previous is None\
+                                       else previous['code']
+                if previous is not None:
+                    previous['next'] = None if data is None else data['code']
+
+        shards = defaultdict(list)
+        for data in games:
+            shards[shard_for_code(data['code'])].append(data)
+        for using, shard_games in sorted(shards.items()):
+            with transaction.atomic(using=using):
+                num_rows += _insert_games(using, shard_games)
+
+        stats = defaultdict(lambda: dict.fromkeys(GameStats.COUNTERS, 0))
+        series = {}
+        for data in games:
+            if data['game_phase'] != Game.GAME_PHASE_END:
+                continue
+            key, totals, results = _results(data)
+            for name, value in totals.items():
+                stats[key][name] += value
+            resistance_won, merlin_assassinated, player_results = results
+            s = series.setdefault(data['series'],
+                                  Series(code=data['series'], players={}))
+            s.games += 1
+            s.resistance_wins += 1 if resistance_won else 0
+            s.merlin_assassinated += 1 if merlin_assassinated else 0
+            Series.add_results(s.players, player_results)
+        with transaction.atomic():
+            for (num_players, role_config), totals in stats.items():
+                GameStats.add(num_players, role_config, totals)
+            for s in series.values():
+                s.players = json.dumps(s.players, sort_keys=True)
+            Series.objects.bulk_create(series.values())
+        num_rows += len(series)
+    return num_rows
+
+
+class Command(BaseCommand):
+    help = "Insert randomly played historical games (players, rounds, "\
+           "votes and mission actions, but no event log) spread over the "\
+           "past --days, for testing with a production-sized database. "\
+           "Don't run it while the server is writing to the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=100000)
+        parser.add_argument('--days', type=float, default=3 * 365)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if options['games'] <= 0 or options['batch_size'] <= 0\
+                or options['days'] <= 0:
+            raise CommandError("--games, --days and --batch-size must be "
+                               "positive.")
+        span = timedelta(days=options['days'])
+        # a little over 1.5 games per table
+        generator = GameGenerator(random.Random(options['seed']),
+                                  timezone.now() - span,
+                                  span / options['games'] * 1.5)
+        num_rows = generate_games(options['games'], generator,
+                                  options['batch_size'])
+        self.stdout.write("Generated %d games (%d rows)."
+                          % (options['games'], num_rows))
@@ -0,0 +1,76 @@
+from collections import Counter
+import io
+import json
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Summarize the hot spots in the request profiles dumped by "\
+           "ProfilingMiddleware."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.AVALON_PROFILE_DIR,
+                            help="Profile directory (default: "
+                                 "AVALON_PROFILE_DIR).")
+        parser.add_argument('--view', default=None,
+                            help="Only include requests to this URL name.")
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        directory = options['dir']
+        if not directory or not os.path.isdir(directory):
+            raise CommandError("No profile directory %r." % directory)
+        limit = options['limit']
+
+        prof_files = []
+        leaf_samples = Counter()
+        total_samples = 0
+        sql_time = Counter()
+        sql_count = Counter()
+        views = Counter()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(directory, name)) as f:
+                dump = json.load(f)
+            if options['view'] and dump['view'] != options['view']:
+                continue
+            views[(dump['view'], dump['game_phase'])] += 1
+            prof = os.path.join(directory, name[:-len('.json')] + '.prof')
+            if os.path.exists(prof):
+                prof_files.append(prof)
+            for stack, count in dump['stacks'].items():
+                leaf_samples[stack.split(';')[-1]] += count
+                total_samples += count
+            for sql, duration in dump['queries']:
+                sql_time[sql] += duration
+                sql_count[sql] += 1
+
+        self.stdout.write("Requests dumped (view, game phase):")
+        for (view, phase), count in views.most_common():
+            self.stdout.write("  %5d  %s (%s)" % (count, view, phase))
+
+        if prof_files:
+            self.stdout.write("\nTop functions over %d cProfile dumps:"
+                              % len(prof_files))
+            stream = io.StringIO()
+            stats = pstats.Stats(*prof_files, stream=stream)
+            stats.sort_stats('cumulative').print_stats(limit)
+            self.stdout.write(stream.getvalue())
+
+        if total_samples:
+            self.stdout.write("Hottest lines in slow requests (%d samples):"
+                              % total_samples)
+            for frame, count in leaf_samples.most_common(limit):
+                self.stdout.write("  %5.1f%%  %s"
+                                  % (100.0 * count / total_samples, frame))
+
+        if sql_time:
+            self.stdout.write("\nSlowest SQL (total seconds, count):")
+            for sql, total in sql_time.most_common(limit):
+                self.stdout.write("  %8.3f %6d  %s" % (total, sql_count[sql],
+                                                       sql[:200]))
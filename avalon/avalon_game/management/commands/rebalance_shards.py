@@ -0,0 +1,136 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from avalon_game import livestate
+from avalon_game.models import Game, GameEvent, MissionAction, PlayerVote,\
+                               VoteRound
+from avalon_game.sharding import all_game_databases, shard_for_code
+
+
+def _copy(obj, using, **changes):
+    """Insert a copy of obj (with a new primary key) into database using."""
+    obj.pk = None
+    obj._state.adding = True
+    for name, value in changes.items():
+        setattr(obj, name, value)
+    # save_base() skips the save() overrides, which would e.g. allocate a new
+    #   access code or player secret.
+    obj.save_base(using=using, force_insert=True)
+    return obj
+
+
+def _remap_event_data(data, player_pks):
+    # Players who left the game have no row to copy; give them negative
+    #   keys so replays still tell them apart without clashing with the
+    #   primary keys on the new database.
+    def remap(pk):
+        return player_pks.get(int(pk), -int(pk))
+
+    data = json.loads(data)
+    if 'player' in data:
+        data['player'] = remap(data['player'])
+    if 'roles' in data:
+        data['roles'] = {remap(pk): value
+                         for pk, value in data['roles'].items()}
+    return json.dumps(data, sort_keys=True)
+
+
+def move_game(game, target):
+    """Move game and all of its rows from its database to target."""
+    source = game._state.db
+    with transaction.atomic(using=source), transaction.atomic(using=target):
+        game = Game.objects.using(source).get(pk=game.pk)
+        old_pk = game.pk
+        player_assassinated_id = game.player_assassinated_id
+        players = list(game.player_set.order_by('pk'))
+        game_rounds = list(game.gameround_set.order_by('pk'))
+        vote_rounds = list(VoteRound.objects.using(source)
+                                    .filter(game_round__game=game)
+                                    .order_by('pk'))
+        chosen = list(VoteRound.chosen.through.objects.using(source)
+                               .filter(voteround__game_round__game=game))
+        votes = list(PlayerVote.objects.using(source)
+                               .filter(vote_round__game_round__game=game))
+        mission_actions = list(MissionAction.objects.using(source)
+                                            .filter(game_round__game=game))
+        events = list(game.gameevent_set.all())
+
+        _copy(game, target, player_assassinated_id=None)
+        player_pks = {}
+        for player in players:
+            pk = player.pk
+            player_pks[pk] = _copy(player, target, game_id=game.pk).pk
+        game_round_pks = {}
+        for game_round in game_rounds:
+            pk = game_round.pk
+            game_round_pks[pk] = _copy(game_round, target,
+                                       game_id=game.pk).pk
+        vote_round_pks = {}
+        for vote_round in vote_rounds:
+            pk = vote_round.pk
+            vote_round_pks[pk] = _copy(
+                vote_round, target,
+                game_round_id=game_round_pks[vote_round.game_round_id],
+                leader_id=player_pks[vote_round.leader_id]).pk
+        VoteRound.chosen.through.objects.using(target).bulk_create(
+            VoteRound.chosen.through(
+                voteround_id=vote_round_pks[c.voteround_id],
+                player_id=player_pks[c.player_id])
+            for c in chosen)
+        PlayerVote.objects.using(target).bulk_create(
+            PlayerVote(vote_round_id=vote_round_pks[v.vote_round_id],
+                       player_id=player_pks[v.player_id], accept=v.accept)
+            for v in votes)
+        MissionAction.objects.using(target).bulk_create(
+            MissionAction(game_round_id=game_round_pks[a.game_round_id],
+                          player_id=player_pks[a.player_id],
+                          played_success=a.played_success)
+            for a in mission_actions)
+        GameEvent.objects.using(target).bulk_create(
+            GameEvent(game_id=game.pk, seq=e.seq, action=e.action,
+                      data=_remap_event_data(e.data, player_pks),
+                      created=e.created)
+            for e in events)
+        if player_assassinated_id is not None:
+            Game.objects.using(target).filter(pk=game.pk).update(
+                player_assassinated=player_pks[player_assassinated_id])
+
+        # player_assassinated would keep the players from being deleted
+        old_games = Game.objects.using(source).filter(pk=old_pk)
+        old_games.update(player_assassinated=None)
+        old_games.delete()
+    livestate.discard(game.access_code)
+
+
+class Command(BaseCommand):
+    help = "Move every game to the database its access code maps to with "\
+           "the current AVALON_GAME_SHARDS setting."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the games which would be "
+                                 "moved.")
+
+    def handle(self, *args, **options):
+        moved = 0
+        for db in all_game_databases():
+            last_pk = 0
+            while True:
+                games = list(Game.objects.using(db).filter(pk__gt=last_pk)
+                                         .order_by('pk')[:100])
+                if not games:
+                    break
+                last_pk = games[-1].pk
+                for game in games:
+                    target = shard_for_code(game.access_code)
+                    if target == db:
+                        continue
+                    if not options['dry_run']:
+                        move_game(game, target)
+                    moved += 1
+        if options['dry_run']:
+            self.stdout.write("Would move %d games." % moved)
+        else:
+            self.stdout.write("Moved %d games." % moved)
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from avalon_game.models import Game, GameRound, VoteRound, order_mask
+from avalon_game.sharding import game_databases
+
+
+def rebuild_masks(using, batch_size=500):
+    """Recompute the bitmasks of the vote and game rounds on database using
+    from the chosen players, PlayerVotes and MissionActions. Returns the
+    number of rounds changed."""
+    changed = 0
+    vote_rounds = VoteRound.objects.using(using)\
+                           .prefetch_related('chosen',
+                                             'playervote_set__player')\
+                           .order_by('pk')
+    game_rounds = GameRound.objects.using(using)\
+                           .prefetch_related('missionaction_set__player')\
+                           .order_by('pk')
+    for rounds, masks in ((vote_rounds, _vote_round_masks),
+                          (game_rounds, _game_round_masks)):
+        last_pk = 0
+        while True:
+            batch = list(rounds.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                for obj in batch:
+                    fields = masks(obj)
+                    if any(getattr(obj, name) != value
+                           for name, value in fields.items()):
+                        type(obj).objects.using(using).filter(pk=obj.pk)\
+                                 .update(**fields)
+                        # the materialized status was computed from the
+                        #   old masks
+                        Game.objects.using(using)\
+                                    .filter(gameround=obj.game_round_id
+                                            if masks is _vote_round_masks
+                                            else obj.pk)\
+                                    .update(status_seq=None)
+                        changed += 1
+            last_pk = batch[-1].pk
+    return changed
+
+
+def _vote_round_masks(vote_round):
+    votes = vote_round.playervote_set.all()
+    return {
+        'chosen_mask': order_mask(vote_round.chosen.all()),
+        'voted_mask': order_mask(v.player for v in votes),
+        'accepted_mask': order_mask(v.player for v in votes if v.accept),
+    }
+
+
+def _game_round_masks(game_round):
+    actions = game_round.missionaction_set.all()
+    return {
+        'played_mask': order_mask(a.player for a in actions),
+        'failed_mask': order_mask(a.player for a in actions
+                                  if not a.played_success),
+    }
+
+
+class Command(BaseCommand):
+    help = "Recompute the chosen/vote/mission bitmasks of every round, e.g. "\
+           "for rounds played before they existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        changed = sum(rebuild_masks(db, options['batch_size'])
+                      for db in game_databases())
+        self.stdout.write("Fixed the bitmasks of %d rounds." % changed)
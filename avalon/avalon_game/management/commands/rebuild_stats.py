@@ -0,0 +1,61 @@
+from collections import defaultdict
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from avalon_game.models import Game, GameStats, Series
+from avalon_game.sharding import game_databases
+
+
+class Command(BaseCommand):
+    help = "Recompute the GameStats and Series aggregate tables from all "\
+           "finished games."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        totals = defaultdict(lambda: dict.fromkeys(GameStats.COUNTERS, 0))
+        series = defaultdict(lambda: Series(players={}))
+        games = Game.objects.filter(game_phase=Game.GAME_PHASE_END)\
+                            .select_related('player_assassinated')\
+                            .prefetch_related('player_set',
+                                              'gameround_set__voteround_set')\
+                            .order_by('pk')
+        num_games = 0
+        for db in game_databases():
+            last_pk = 0
+            while True:
+                batch = list(games.using(db).filter(pk__gt=last_pk)
+                             [:options['batch_size']])
+                if not batch:
+                    break
+                for game in batch:
+                    key = (len(game.player_set.all()), game.role_config())
+                    for name, value in GameStats.game_totals(game).items():
+                        totals[key][name] += value
+                    if game.series_code is not None:
+                        resistance_won, merlin_assassinated, results =\
+                            Series.game_results(game)
+                        s = series[game.series_code]
+                        s.games += 1
+                        s.resistance_wins += 1 if resistance_won else 0
+                        s.merlin_assassinated += 1 if merlin_assassinated\
+                                                 else 0
+                        Series.add_results(s.players, results)
+                last_pk = batch[-1].pk
+                num_games += len(batch)
+
+        with transaction.atomic():
+            GameStats.objects.all().delete()
+            GameStats.objects.bulk_create(
+                GameStats(num_players=num_players, role_config=role_config,
+                          **counters)
+                for (num_players, role_config), counters in totals.items())
+            Series.objects.all().delete()
+            for code, s in series.items():
+                s.code = code
+                s.players = json.dumps(s.players, sort_keys=True)
+            Series.objects.bulk_create(series.values())
+        self.stdout.write("Rebuilt statistics from %d games." % num_games)
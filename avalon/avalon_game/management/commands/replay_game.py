@@ -0,0 +1,24 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from avalon_game.models import Game
+from avalon_game.replay import replay_game
+
+
+class Command(BaseCommand):
+    help = "Print the state of a game reconstructed from its event log."
+
+    def add_arguments(self, parser):
+        parser.add_argument('access_code')
+        parser.add_argument('--seq', type=int, default=None,
+                            help="Only replay events up to this sequence "
+                                 "number.")
+
+    def handle(self, *args, **options):
+        try:
+            game = Game.objects.for_access_code(options['access_code']).get()
+        except Game.DoesNotExist:
+            raise CommandError("Invalid access code.")
+        state = replay_game(game, seq=options['seq'])
+        self.stdout.write(json.dumps(state.as_dict(), indent=2))
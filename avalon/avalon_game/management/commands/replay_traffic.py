@@ -0,0 +1,211 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment,\
+                              teardown_test_environment
+from django.urls import Resolver404, resolve, reverse
+
+from avalon_game.helpers import percentile
+
+
+class Replayer(object):
+    """Re-issues traced requests at their recorded times (scaled by speed),
+    mapping the traced games and players to the ones created by the replayed
+    new_game and enter_code requests."""
+    def __init__(self, records, speed, workers, wait):
+        self.records = records
+        self.speed = speed
+        self.workers = workers
+        self.wait = wait
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # traced id -> (threading.Event, access code or player secret)
+        self.games = {}
+        self.players = {}
+        for record in records:
+            if record.get('new_game'):
+                self.games.setdefault(record['new_game'],
+                                      [threading.Event(), None])
+            if record.get('new_player'):
+                self.players.setdefault(record['new_player'],
+                                        [threading.Event(), None])
+        # view -> [latency in seconds]
+        self.latencies = {}
+        # view -> number of failed requests
+        self.errors = {}
+        self.skipped = 0
+        self.max_lag = 0.0
+
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = Client(raise_request_exception=False)
+        return client
+
+    def _lookup(self, ids, traced_id):
+        """The access code or secret for traced_id, once it's been created
+        (or None if it never is)."""
+        entry = ids.get(traced_id)
+        if entry is None or not entry[0].wait(self.wait):
+            return None
+        return entry[1]
+
+    def _created(self, ids, traced_id, value):
+        entry = ids.get(traced_id)
+        if entry is not None and value is not None:
+            entry[1] = value
+            entry[0].set()
+
+    def _request(self, record):
+        kwargs = dict(record['kwargs'])
+        if record['game']:
+            kwargs['access_code'] = self._lookup(self.games, record['game'])
+            if kwargs['access_code'] is None:
+                return None
+        if record['player']:
+            kwargs['player_secret'] = self._lookup(self.players,
+                                                   record['player'])
+            if kwargs['player_secret'] is None:
+                return None
+        data = dict(record.get('post') or {})
+        if data.get('game'):
+            data['game'] = self._lookup(self.games, data['game'])
+            if data['game'] is None:
+                return None
+        # the anonymized names are valid (and still unique) names
+        return reverse(record['view'], kwargs=kwargs), data
+
+    def run_one(self, record, scheduled, previous, done):
+        try:
+            # a browser only sends one request at a time
+            if previous is not None:
+                previous.wait(self.wait)
+            lag = time.perf_counter() - scheduled
+            with self.lock:
+                self.max_lag = max(self.max_lag, lag)
+            request = self._request(record)
+            if request is None:
+                with self.lock:
+                    self.skipped += 1
+                return
+            path, data = request
+            headers = {}
+            if settings.AVALON_ADMIN_TOKEN:
+                headers['HTTP_X_AVALON_ADMIN_TOKEN'] =\
+                    settings.AVALON_ADMIN_TOKEN
+            start = time.perf_counter()
+            if record['method'] == 'POST':
+                response = self.client().post(path, data, **headers)
+            else:
+                response = self.client().generic(record['method'], path,
+                                                 **headers)
+            latency = time.perf_counter() - start
+            # a client error is only an error if it wasn't one when traced
+            failed = response.status_code >= 500\
+                     or (response.status_code >= 400
+                         and record['status'] < 400)
+            if response.status_code == 302 and (record.get('new_game')
+                                                or record.get('new_player')):
+                try:
+                    target = resolve(response.url).kwargs
+                except Resolver404:
+                    target = {}
+                self._created(self.games, record.get('new_game'),
+                              target.get('access_code'))
+                self._created(self.players, record.get('new_player'),
+                              target.get('player_secret'))
+            with self.lock:
+                self.latencies.setdefault(record['view'], []).append(latency)
+                if failed:
+                    self.errors[record['view']] =\
+                        self.errors.get(record['view'], 0) + 1
+        finally:
+            done.set()
+            connections.close_all()
+
+    def run(self):
+        first = self.records[0]['t']
+        start = time.perf_counter()
+        # player (or observed game) -> threading.Event set once its last
+        #   request is done
+        clients = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for record in self.records:
+                scheduled = start + (record['t'] - first) / self.speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                key = record['player'] or record.get('new_player')\
+                      or record['game']
+                done = threading.Event()
+                previous = clients.get(key) if key else None
+                if key:
+                    clients[key] = done
+                executor.submit(self.run_one, record, scheduled, previous,
+                                done)
+        return time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = "Replay request traces recorded by TraceMiddleware (see "\
+           "avalon_game/tracing.py) against fresh test databases and report "\
+           "latency percentiles and error rates per view."
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help="Trace file (AVALON_TRACE_FILE).")
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help="Replay this many times faster than "
+                                 "recorded (e.g. 1, 10 or 100).")
+        parser.add_argument('--workers', type=int, default=16,
+                            help="Number of concurrent requests.")
+        parser.add_argument('--wait', type=float, default=30.0,
+                            help="Seconds a request waits for the replayed "
+                                 "request creating its game or player.")
+
+    def handle(self, *args, **options):
+        if options['speed'] <= 0:
+            raise CommandError("--speed must be positive.")
+        try:
+            with open(options['trace']) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            raise CommandError("Can't read trace: %s" % e)
+        if not records:
+            raise CommandError("The trace is empty.")
+        records.sort(key=lambda r: r['t'])
+
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            replayer = Replayer(records, options['speed'], options['workers'],
+                                options['wait'])
+            duration = replayer.run()
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        self.stdout.write("%d requests in %.1fs (%.1f/s), %d skipped as "
+                          "their game or player was created before the "
+                          "trace started, max start lag %.0fms"
+                          % (len(records), duration, len(records) / duration,
+                             replayer.skipped, replayer.max_lag * 1000))
+        self.stdout.write("%-22s %7s %7s %8s %8s %8s %8s"
+                          % ('view', 'count', 'errors', 'p50 ms', 'p90 ms',
+                             'p99 ms', 'max ms'))
+        for view, latencies in sorted(replayer.latencies.items()):
+            errors = replayer.errors.get(view, 0)
+            self.stdout.write("%-22s %7d %6.1f%% %8.1f %8.1f %8.1f %8.1f"
+                              % (view, len(latencies),
+                                 100.0 * errors / len(latencies),
+                                 percentile(latencies, 0.5) * 1000,
+                                 percentile(latencies, 0.9) * 1000,
+                                 percentile(latencies, 0.99) * 1000,
+                                 max(latencies) * 1000))
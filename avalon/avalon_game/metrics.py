@@ -0,0 +1,218 @@
+"""Per-view request metrics exposed in the Prometheus text format.
+
+MetricsMiddleware records for each resolved URL name the number of requests,
+a latency histogram, the number and total time of database queries, the
+response size and how many responses were 304 Not Modified. It is only
+installed if settings.AVALON_METRICS is set; otherwise Django drops it from
+the middleware chain so it costs nothing.
+
+The metrics are kept per process, so each worker has to be scraped
+separately.
+"""
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import timedelta
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Game, Player
+from .sharding import game_databases
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# a game counts as active if any of its players has polled this recently
+ACTIVE_GAME_TIMEOUT = timedelta(minutes=10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                                  .replace('"', '\\"'))
+                             for k, v in labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, metric_type, help_text):
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self._inc(name, value, labels)
+
+    def _inc(self, name, value, labels):
+        self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def _observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            # one count per bucket, then the sum and the count
+            histogram = self._histograms[key] = [0] * len(LATENCY_BUCKETS)\
+                                                + [0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def record_request(self, view, duration, queries, query_time, size,
+                       status_code):
+        labels = {'view': view}
+        with self.lock:
+            self._inc('avalon_requests_total', 1, labels)
+            self._observe('avalon_request_duration_seconds', duration,
+                          labels)
+            self._inc('avalon_db_queries_total', queries, labels)
+            self._inc('avalon_db_query_seconds_total', query_time, labels)
+            if size is not None:
+                self._inc('avalon_response_bytes_total', size, labels)
+            if status_code == 304:
+                self._inc('avalon_not_modified_total', 1, labels)
+
+    def render(self, gauges=()):
+        lines = []
+        described = set()
+
+        def header(name):
+            if name in described or name not in self._help:
+                return
+            described.add(name)
+            metric_type, help_text = self._help[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+        with self.lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value))
+                                for key, value in self._histograms.items())
+            in_flight = self.in_flight
+        for (name, labels), value in counters:
+            header(name)
+            lines.append('%s%s %r' % (name, _format_labels(labels),
+                                      float(value)))
+        for (name, labels), histogram in histograms:
+            header(name)
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                    histogram[:-2] + [histogram[-1]]):
+                lines.append('%s_bucket%s %d'
+                             % (name,
+                                _format_labels(labels + (('le', bound),)),
+                                count))
+            lines.append('%s_sum%s %r' % (name, _format_labels(labels),
+                                          histogram[-2]))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                            histogram[-1]))
+        header('avalon_requests_in_flight')
+        lines.append('avalon_requests_in_flight %d' % in_flight)
+        for name, labels, value in gauges:
+            header(name)
+            lines.append('%s%s %s' % (name,
+                                      _format_labels(tuple(labels.items())),
+                                      value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('avalon_requests_total', 'counter',
+                  'Requests handled, by URL name.')
+REGISTRY.describe('avalon_request_duration_seconds', 'histogram',
+                  'Request latency, by URL name.')
+REGISTRY.describe('avalon_db_queries_total', 'counter',
+                  'Database queries executed, by URL name.')
+REGISTRY.describe('avalon_db_query_seconds_total', 'counter',
+                  'Time spent executing database queries, by URL name.')
+REGISTRY.describe('avalon_response_bytes_total', 'counter',
+                  'Response body bytes sent, by URL name.')
+REGISTRY.describe('avalon_not_modified_total', 'counter',
+                  'Responses which were 304 Not Modified, by URL name.')
+REGISTRY.describe('avalon_requests_in_flight', 'gauge',
+                  'Requests currently being handled by this process.')
+REGISTRY.describe('avalon_active_games', 'gauge',
+                  'Games with a player seen in the last %d minutes, by phase.'
+                  % (ACTIVE_GAME_TIMEOUT.total_seconds() // 60))
+REGISTRY.describe('avalon_connected_players', 'gauge',
+                  'Players who have polled recently enough not to have '
+                  'expired.')
+
+
+def game_gauges():
+    now = timezone.now()
+    counts = dict.fromkeys(Game._game_phase_strings.values(), 0)
+    connected = 0
+    for db in game_databases():
+        active_games = Game.objects.using(db)\
+            .filter(player__last_accessed__gte=now - ACTIVE_GAME_TIMEOUT)\
+            .order_by()\
+            .values('game_phase')\
+            .annotate(count=Count('pk', distinct=True))
+        for row in active_games:
+            counts[Game._game_phase_strings[row['game_phase']]] +=\
+                row['count']
+        connected += Player.objects.using(db)\
+            .filter(last_accessed__gte=now - Player.EXPIRE_AFTER).count()
+    for phase, count in sorted(counts.items()):
+        yield 'avalon_active_games', {'phase': phase}, count
+    yield 'avalon_connected_players', {}, connected
+
+
+class QueryCounter(object):
+    """execute_wrapper() which counts queries and the time spent in them."""
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.queries += 1
+
+
+class MetricsMiddleware(object):
+    def __init__(self, get_response):
+        if not settings.AVALON_METRICS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        with REGISTRY.lock:
+            REGISTRY.in_flight += 1
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter))
+                response = self.get_response(request)
+        finally:
+            with REGISTRY.lock:
+                REGISTRY.in_flight -= 1
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None else None
+        if response.streaming:
+            size = None
+        else:
+            size = len(response.content)
+        REGISTRY.record_request(view or '<unresolved>', duration,
+                                counter.queries, counter.time, size,
+                                response.status_code)
+        return response
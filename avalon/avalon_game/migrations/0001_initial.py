@@ -0,0 +1,89 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Game',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('access_code', models.CharField(db_index=True, max_length=6, unique=True)),
+                ('game_phase', models.IntegerField(default=0)),
+                ('times_started', models.IntegerField(default=0)),
+                ('display_history', models.NullBooleanField()),
+                ('private_voting', models.NullBooleanField()),
+                ('created', models.DateTimeField()),
+                ('ended', models.DateTimeField(default=None, null=True)),
+                ('next_game', models.OneToOneField(default=None, null=True, on_delete=django.db.models.deletion.SET_DEFAULT, related_name='previous_game', to='avalon_game.game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameRound',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round_num', models.IntegerField()),
+                ('mission_passed', models.NullBooleanField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Player',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('secret_id', models.CharField(db_index=True, max_length=8)),
+                ('name', models.CharField(max_length=80)),
+                ('role', models.IntegerField(default=None, null=True)),
+                ('order', models.IntegerField(default=None, null=True)),
+                ('ready', models.BooleanField(default=False)),
+                ('joined', models.DateTimeField()),
+                ('last_accessed', models.DateTimeField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VoteRound',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vote_num', models.IntegerField()),
+                ('vote_status', models.IntegerField(default=0)),
+                ('started', models.DateTimeField()),
+                ('chose_team', models.DateTimeField(default=None, null=True)),
+                ('voted', models.DateTimeField(default=None, null=True)),
+                ('chosen', models.ManyToManyField(related_name='vote_round_chosen', to='avalon_game.Player')),
+                ('game_round', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.gameround')),
+                ('leader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vote_round_leader', to='avalon_game.player')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PlayerVote',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('accept', models.BooleanField()),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.player')),
+                ('vote_round', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.voteround')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MissionAction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('played_success', models.BooleanField()),
+                ('game_round', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.gameround')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.player')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='player_assassinated',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='avalon_game.player'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='event_seq',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.IntegerField()),
+                ('action', models.CharField(max_length=16)),
+                ('data', models.TextField(default='{}')),
+                ('created', models.DateTimeField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='avalon_game.game')),
+            ],
+            options={
+                'ordering': ('seq',),
+                'unique_together': {('game', 'seq')},
+            },
+        ),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:07
+
+from collections import defaultdict
+
+from django.db import migrations, models, router
+
+# historical models have neither the constants nor the methods of the models
+GAME_PHASE_END = 6
+ROLE_SPY = -1
+ROLE_GOOD = 1
+ROLE_MERLIN = 2
+ROLE_STRINGS = {-2: "Assassin", -3: "Morgana", -4: "Mordred", -5: "Oberon",
+                2: "Merlin", 3: "Percival"}
+VOTE_STATUS_VOTED = 2
+BATCH_SIZE = 500
+
+
+def game_totals(game):
+    # as GameStats.game_totals()
+    game_rounds = game.gameround_set.all()
+    assassinated = game.player_assassinated
+    merlin_assassinated = assassinated is not None\
+                          and assassinated.role == ROLE_MERLIN
+    res_wins = len([r for r in game_rounds if r.mission_passed])
+    return {
+        'games': 1,
+        'resistance_wins': 1 if res_wins == 3 and not merlin_assassinated
+                           else 0,
+        # not a round which ended on the fifth rejected team
+        'missions': len([r for r in game_rounds
+                         if r.mission_passed is not None]),
+        'vote_rounds': sum(len([v for v in r.voteround_set.all()
+                                if v.vote_status == VOTE_STATUS_VOTED])
+                           for r in game_rounds),
+        'assassinations': 0 if assassinated is None else 1,
+        'merlin_assassinated': 1 if merlin_assassinated else 0,
+    }
+
+
+def role_config(game):
+    # as Game.role_config()
+    return ", ".join(sorted(ROLE_STRINGS[p.role]
+                            for p in game.player_set.all()
+                            if p.role not in (None, ROLE_SPY, ROLE_GOOD)))
+
+
+def count_finished_games(apps, schema_editor):
+    # GameStats.record_game() only counts the games that end from now on
+    GameStats = apps.get_model('avalon_game', 'GameStats')
+    db = schema_editor.connection.alias
+    if not router.allow_migrate_model(db, GameStats):
+        return
+    Game = apps.get_model('avalon_game', 'Game')
+    games = Game.objects.using(db).filter(game_phase=GAME_PHASE_END)\
+                        .select_related('player_assassinated')\
+                        .prefetch_related('player_set',
+                                          'gameround_set__voteround_set')\
+                        .order_by('pk')
+    totals = defaultdict(lambda: defaultdict(int))
+    last_pk = 0
+    while True:
+        batch = list(games.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        for game in batch:
+            key = (len(game.player_set.all()), role_config(game))
+            for name, value in game_totals(game).items():
+                totals[key][name] += value
+        last_pk = batch[-1].pk
+    GameStats.objects.using(db).bulk_create(
+        GameStats(num_players=num_players, role_config=config, **counters)
+        for (num_players, config), counters in totals.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0002_game_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_players', models.IntegerField()),
+                ('role_config', models.CharField(max_length=200)),
+                ('games', models.IntegerField(default=0)),
+                ('resistance_wins', models.IntegerField(default=0)),
+                ('missions', models.IntegerField(default=0)),
+                ('vote_rounds', models.IntegerField(default=0)),
+                ('assassinations', models.IntegerField(default=0)),
+                ('merlin_assassinated', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('num_players', 'role_config'),
+                'unique_together': {('num_players', 'role_config')},
+            },
+        ),
+        migrations.RunPython(count_finished_games,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0003_game_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='voteround',
+            index=models.Index(fields=['started', 'chose_team', 'voted'], name='avalon_game_started_536ef1_idx'),
+        ),
+    ]
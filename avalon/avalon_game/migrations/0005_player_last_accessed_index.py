@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0004_voteround_timing_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='last_accessed',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:12
+
+from django.db import migrations, models
+
+
+def link_by_access_code(apps, schema_editor):
+    # Game.next_access_code and previous_access_code replace next_game
+    Game = apps.get_model('avalon_game', 'Game')
+    games = Game.objects.using(schema_editor.connection.alias)
+    games.exclude(next_game=None).update(
+        next_access_code=models.Subquery(
+            games.filter(pk=models.OuterRef('next_game'))
+                 .values('access_code')[:1]))
+    games.exclude(previous_game=None).update(
+        previous_access_code=models.Subquery(
+            games.filter(next_game=models.OuterRef('pk'))
+                 .values('access_code')[:1]))
+
+
+def link_by_foreign_key(apps, schema_editor):
+    # only links to games on the same database can be restored
+    Game = apps.get_model('avalon_game', 'Game')
+    games = Game.objects.using(schema_editor.connection.alias)
+    games.exclude(next_access_code=None).update(
+        next_game=models.Subquery(
+            games.filter(access_code=models.OuterRef('next_access_code'))
+                 .values('pk')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0006_code_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='next_access_code',
+            field=models.CharField(default=None, max_length=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='previous_access_code',
+            field=models.CharField(default=None, max_length=6, null=True),
+        ),
+        migrations.RunPython(link_by_access_code, link_by_foreign_key),
+        migrations.RemoveField(
+            model_name='game',
+            name='next_game',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0007_game_links_by_access_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='role_summary',
+            field=models.TextField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='possible_merlins',
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='visible_spies',
+            field=models.IntegerField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:22
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def order_mask(players):
+    # as models.order_mask()
+    mask = 0
+    for player in players:
+        mask |= 1 << player.order
+    return mask
+
+
+def vote_round_masks(vote_round):
+    votes = vote_round.playervote_set.all()
+    return {
+        'chosen_mask': order_mask(vote_round.chosen.all()),
+        'voted_mask': order_mask(v.player for v in votes),
+        'accepted_mask': order_mask(v.player for v in votes if v.accept),
+    }
+
+
+def game_round_masks(game_round):
+    actions = game_round.missionaction_set.all()
+    return {
+        'played_mask': order_mask(a.player for a in actions),
+        'failed_mask': order_mask(a.player for a in actions
+                                  if not a.played_success),
+    }
+
+
+def fill_masks(apps, schema_editor):
+    # as the rebuild_masks command, for the rounds played so far
+    db = schema_editor.connection.alias
+    VoteRound = apps.get_model('avalon_game', 'VoteRound')
+    GameRound = apps.get_model('avalon_game', 'GameRound')
+    vote_rounds = VoteRound.objects.using(db)\
+                           .prefetch_related('chosen',
+                                             'playervote_set__player')\
+                           .order_by('pk')
+    game_rounds = GameRound.objects.using(db)\
+                           .prefetch_related('missionaction_set__player')\
+                           .order_by('pk')
+    for rounds, masks in ((vote_rounds, vote_round_masks),
+                          (game_rounds, game_round_masks)):
+        last_pk = 0
+        while True:
+            batch = list(rounds.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if not batch:
+                break
+            for obj in batch:
+                fields = masks(obj)
+                if any(fields.values()):
+                    rounds.filter(pk=obj.pk).update(**fields)
+            last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0008_role_knowledge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameround',
+            name='failed_mask',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='gameround',
+            name='played_mask',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='voteround',
+            name='accepted_mask',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='voteround',
+            name='chosen_mask',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='voteround',
+            name='voted_mask',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_masks, migrations.RunPython.noop),
+    ]
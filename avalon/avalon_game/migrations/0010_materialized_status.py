@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0009_round_masks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='status_json',
+            field=models.TextField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='status_players',
+            field=models.TextField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='status_seq',
+            field=models.IntegerField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:26
+
+import json
+
+from django.db import migrations, models, router
+
+# historical models have neither the constants nor the methods of the models
+GAME_PHASE_END = 6
+ROLE_MERLIN = 2
+BATCH_SIZE = 500
+
+
+def set_series_codes(apps, schema_editor):
+    # a game's series_code is the access code of the first game of its
+    #   chain, which can only be followed within this database
+    Game = apps.get_model('avalon_game', 'Game')
+    games = Game.objects.using(schema_editor.connection.alias)
+    games.filter(previous_access_code=None)\
+         .update(series_code=models.F('access_code'))
+    while True:
+        linked = games.filter(series_code=None,
+                              previous_access_code__in=games.exclude(
+                                  series_code=None).values('access_code'))
+        if not linked.update(series_code=models.Subquery(
+                games.filter(access_code=models.OuterRef(
+                                 'previous_access_code'))
+                     .values('series_code')[:1])):
+            break
+
+
+def count_finished_games(apps, schema_editor):
+    # Series.record_game() only counts the games that end from now on
+    Series = apps.get_model('avalon_game', 'Series')
+    db = schema_editor.connection.alias
+    if not router.allow_migrate_model(db, Series):
+        return
+    Game = apps.get_model('avalon_game', 'Game')
+    games = Game.objects.using(db).filter(game_phase=GAME_PHASE_END)\
+                        .exclude(series_code=None)\
+                        .select_related('player_assassinated')\
+                        .prefetch_related('player_set', 'gameround_set')\
+                        .order_by('pk')
+    series = {}
+    last_pk = 0
+    while True:
+        batch = list(games.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        for game in batch:
+            # as Series.game_results() and add_results()
+            assassinated = game.player_assassinated
+            merlin_assassinated = assassinated is not None\
+                                  and assassinated.role == ROLE_MERLIN
+            resistance_won = not merlin_assassinated\
+                             and len([r for r in game.gameround_set.all()
+                                      if r.mission_passed]) == 3
+            s = series.setdefault(game.series_code,
+                                  Series(code=game.series_code, players={}))
+            s.games += 1
+            s.resistance_wins += 1 if resistance_won else 0
+            s.merlin_assassinated += 1 if merlin_assassinated else 0
+            for player in game.player_set.all():
+                record = s.players.setdefault(player.name, [0, 0])
+                record[0] += 1
+                if (player.role < 0) != resistance_won:
+                    record[1] += 1
+        last_pk = batch[-1].pk
+    for s in series.values():
+        s.players = json.dumps(s.players, sort_keys=True)
+    Series.objects.using(db).bulk_create(series.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0010_materialized_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Series',
+            fields=[
+                ('code', models.CharField(max_length=6, primary_key=True, serialize=False)),
+                ('games', models.IntegerField(default=0)),
+                ('resistance_wins', models.IntegerField(default=0)),
+                ('merlin_assassinated', models.IntegerField(default=0)),
+                ('players', models.TextField(default='{}')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='series_code',
+            field=models.CharField(db_index=True, default=None, max_length=6, null=True),
+        ),
+        migrations.RunPython(set_series_codes, migrations.RunPython.noop),
+        migrations.RunPython(count_finished_games,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avalon_game', '0011_series'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='player',
+            unique_together={('game', 'secret_id')},
+        ),
+    ]
@@ -1,17 +1,50 @@
 from __future__ import unicode_literals
 
+from collections import namedtuple
 from datetime import datetime, timedelta
-import random
-import string
+import json
 
-from django.db import models, transaction
+from django.db import IntegrityError, models, router, transaction
 from django.utils import timezone
 
+from .codes import code_for, random_code, random_codes
+from . import livestate
 from .helpers import mission_size, mission_size_string
-
-def generate_code(length):
-    return "".join([random.choice(string.ascii_lowercase)
-                    for i in range(length)])
+from .sharding import shard_for_code
+
+class CodeSequence(models.Model):
+    """Counters the access codes are allocated from.
+
+    See codes.py for how counter values are turned into codes.
+    """
+    name = models.CharField(max_length=20, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    ACCESS_CODE = 'access_code'
+
+    @classmethod
+    def allocate(cls, name, length, count=1):
+        """Return count unused codes of the given length."""
+        # Incrementing first takes the write lock, so concurrent requests
+        #   can never be handed the same counter values. The requests aren't
+        #   atomic on this database if games are sharded (see settings.py).
+        with transaction.atomic(using=router.db_for_write(cls)):
+            if not cls.objects.filter(name=name)\
+                              .update(value=models.F('value') + count):
+                cls.objects.get_or_create(name=name)
+                cls.objects.filter(name=name)\
+                           .update(value=models.F('value') + count)
+            end = cls.objects.values_list('value', flat=True).get(name=name)
+        return [code_for(name, length, value)
+                for value in range(end - count, end)]
+
+class GameManager(models.Manager):
+    def for_access_code(self, access_code):
+        """The game with this access code (as a queryset, which is empty if
+        there is no such game) on the database it is stored in."""
+        access_code = access_code.lower()
+        return self.using(shard_for_code(access_code))\
+                   .filter(access_code=access_code)
 
 class Game(models.Model):
     ACCESS_CODE_LENGTH = 6
@@ -33,23 +66,87 @@ class Game(models.Model):
                                             on_delete=models.PROTECT)
     created = models.DateTimeField()
     ended = models.DateTimeField(null=True, default=None)
-    next_game = models.OneToOneField('self', null=True, default=None,
-                                     related_name='previous_game',
-                                     on_delete=models.SET_DEFAULT)
+    # Games are linked by access code instead of by foreign key because
+    #   consecutive games are usually on different databases (see
+    #   sharding.py).
+    next_access_code = models.CharField(null=True, default=None,
+                                        max_length=ACCESS_CODE_LENGTH)
+    previous_access_code = models.CharField(null=True, default=None,
+                                            max_length=ACCESS_CODE_LENGTH)
+    # access code of the first game of the chain of next games this game is
+    #   part of, which is the code of its Series
+    series_code = models.CharField(null=True, default=None, db_index=True,
+                                   max_length=ACCESS_CODE_LENGTH)
+    # sequence number of the last GameEvent logged for this game
+    event_seq = models.IntegerField(null=False, default=0)
+    # JSON summary of the roles in the game, see assign_knowledge()
+    role_summary = models.TextField(null=True, default=None)
+    # The status served to polling clients, as of event status_seq: the JSON
+    #   shared by everyone and a JSON map from player secret (or '' for
+    #   observers) to what's specific to that player. Written in the
+    #   transaction of every change, see materialize_status() in views.py.
+    status_json = models.TextField(null=True, default=None)
+    status_players = models.TextField(null=True, default=None)
+    status_seq = models.IntegerField(null=True, default=None)
+
+    objects = GameManager()
+
+    _UNSAVED_FIELDS = ('event_seq', 'status_json', 'status_players',
+                       'status_seq')
 
     # from http://stackoverflow.com/a/11821832
     def save(self, *args, **kwargs):
         # object is being created, thus no primary key field yet
         if not self.pk:
-            # Make sure access_code is unique before using it.
-            access_code = generate_code(Game.ACCESS_CODE_LENGTH)
-            while Game.objects.filter(access_code=access_code).exists():
-                access_code = generate_code(Game.ACCESS_CODE_LENGTH)
-            self.access_code = access_code
+            self.access_code = CodeSequence.allocate(
+                CodeSequence.ACCESS_CODE, Game.ACCESS_CODE_LENGTH)[0]
             self.created = timezone.now()
-        if self.ended is None and self.game_phase == Game.GAME_PHASE_END:
+        just_ended = self.ended is None\
+                     and self.game_phase == Game.GAME_PHASE_END
+        if just_ended:
             self.ended = timezone.now()
-        super(Game, self).save(*args, **kwargs)
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields'])\
+                                          | {'ended'}
+        if self.pk:
+            super(Game, self).save(*args, **kwargs)
+        else:
+            self._insert(*args, **kwargs)
+        if just_ended:
+            GameStats.record_game(self)
+            Series.record_game(self)
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        # event_seq is only ever advanced by log_event() and the status only
+        #   written by materialize_status(), so unless they're saved
+        #   explicitly, don't let a stale copy of the game overwrite them.
+        if update_fields is None:
+            values = [value for value in values
+                      if value[0].name not in self._UNSAVED_FIELDS]
+        return super(Game, self)._do_update(base_qs, using, pk_val, values,
+                                            update_fields, forced_update)
+
+    def _insert(self, *args, **kwargs):
+        # Allocated access codes never collide with each other, but they
+        #   could collide with a randomly generated code from before they
+        #   were allocated from a CodeSequence.
+        starts_series = self.series_code is None
+        while True:
+            if starts_series:
+                self.series_code = self.access_code
+            # a game always lives on the database of its access code, even if
+            #   created through Game.objects (which would use 'default')
+            kwargs['using'] = shard_for_code(self.access_code)
+            try:
+                with transaction.atomic(using=kwargs['using']):
+                    return super(Game, self).save(*args, **kwargs)
+            except IntegrityError:
+                if not Game.objects.for_access_code(self.access_code)\
+                                   .exists():
+                    raise
+                self.access_code = CodeSequence.allocate(
+                    CodeSequence.ACCESS_CODE, Game.ACCESS_CODE_LENGTH)[0]
 
     _game_phase_strings = {
         GAME_PHASE_LOBBY: 'lobby',
@@ -66,15 +163,184 @@ class Game(models.Model):
     def num_players(self):
         return self.player_set.count()
 
-    # The global settings make everything atomic... this is just to annotate
-    #   that it's important that we never create two next games.
-    @transaction.atomic
-    def create_or_get_next_game(self):
-        if self.next_game is None and self.game_phase == self.GAME_PHASE_END:
-            self.next_game = Game.objects.create()
-            self.save()
+    def resistance_won(self):
+        if self.game_phase != Game.GAME_PHASE_END:
+            return None
+        res_wins = len([r for r in self.gameround_set.all()
+                        if r.mission_passed])
+        return res_wins == 3 and (self.player_assassinated is None
+                                  or not self.player_assassinated.is_merlin())
+
+    def role_config(self):
+        """Comma-separated list of the special roles in this game."""
+        return ", ".join(sorted(p.role_string() for p in self.player_set.all()
+                                if p.role not in (None, Player.ROLE_SPY,
+                                                  Player.ROLE_GOOD)))
+
+    def _linked_game(self, access_code):
+        if access_code is None:
+            return None
+        linked_games = self.__dict__.setdefault('_linked_games', {})
+        if access_code not in linked_games:
+            linked_games[access_code] =\
+                Game.objects.for_access_code(access_code).first()
+        return linked_games[access_code]
+
+    @property
+    def next_game(self):
+        return self._linked_game(self.next_access_code)
+
+    @property
+    def previous_game(self):
+        return self._linked_game(self.previous_access_code)
+
+    # Players are carried over to the next game by rematch() if they were on
+    #   the game page this recently (the end page polls the status every 30
+    #   seconds, see POLL_INTERVALS in views.py).
+    REMATCH_IDLE_LIMIT = timedelta(minutes=1)
+
+    def series(self):
+        """The Series of this game (None before its first game ended)."""
+        if '_series' not in self.__dict__:
+            self._series = None if self.series_code is None\
+                           else Series.objects.filter(code=self.series_code)\
+                                              .first()
+        return self._series
+
+    def create_or_get_next_game(self, names=()):
+        """The game after this one, created if this game ended and doesn't
+        have one yet, in which case the players with the given names join
+        it."""
+        if self.next_access_code is None\
+                and self.game_phase == self.GAME_PHASE_END:
+            next_game = Game.objects.create(
+                previous_access_code=self.access_code,
+                series_code=self.series_code or self.access_code)
+            if names:
+                next_game.add_players(names)
+            # The next game is usually on another database, so it's the
+            #   conditional update which makes sure we never link two next
+            #   games.
+            games = Game.objects.using(self._state.db).filter(pk=self.pk)
+            if games.filter(next_access_code=None)\
+                    .update(next_access_code=next_game.access_code):
+                self.next_access_code = next_game.access_code
+                self.log_event(GameEvent.EVENT_NEXT_GAME,
+                               next_game=next_game.access_code)
+            else:
+                next_game.delete()
+                self.next_access_code = games.values_list(
+                    'next_access_code', flat=True).get()
         return self.next_game
 
+    def rematch(self, player=None):
+        """create_or_get_next_game(), carrying over player and everyone else
+        still at the table, so the next game starts with the whole table
+        instead of each of them joining it separately."""
+        # another request may have created it since this game was loaded
+        self.next_access_code = Game.objects.using(self._state.db)\
+                                            .filter(pk=self.pk)\
+                                            .values_list('next_access_code',
+                                                         flat=True).get()
+        if self.next_access_code is not None:
+            return self.next_game
+        since = timezone.now() - Game.REMATCH_IDLE_LIMIT
+        names = [p.name for p in self.player_set.order_by('order')
+                 if p.last_accessed >= since
+                    or (player is not None and p.pk == player.pk)]
+        return self.create_or_get_next_game(names)
+
+    def add_players(self, names):
+        """Add players with the given names to the game with one insert (and
+        one for their join events)."""
+        db = self._state.db
+        now = timezone.now()
+        with transaction.atomic(using=db):
+            while True:
+                secrets = random_codes(Player.SECRET_ID_LENGTH, len(names))
+                try:
+                    with transaction.atomic(using=db):
+                        Player.objects.using(db).bulk_create(
+                            Player(game=self, name=name, secret_id=secret,
+                                   joined=now, last_accessed=now)
+                            for name, secret in zip(names, secrets))
+                    break
+                except IntegrityError:
+                    # a player of the game already has one of the secrets
+                    if not self.player_set.filter(secret_id__in=secrets)\
+                                          .exists():
+                        raise
+            # bulk_create() doesn't set the primary keys on SQLite
+            players = {p.name: p for p in self.player_set.filter(
+                name__in=names)}
+            self.log_events([(GameEvent.EVENT_JOIN, players[name],
+                              {'name': name})
+                             for name in names])
+
+    def assign_knowledge(self, players):
+        """Work out what the players know once their roles and orders are
+        assigned, which doesn't change for the rest of the game: the counts
+        and special roles of both teams (role_summary) and what each player
+        sees of the others (Player.visible_spies/possible_merlins). Only sets
+        the fields; the caller saves the game and the players."""
+        spies = [p for p in players if p.is_spy()]
+        resistance = [p for p in players if not p.is_spy()]
+        self.role_summary = json.dumps({
+            'num_spies': len(spies),
+            'spy_roles': sorted(p.role_string() for p in spies
+                                if p.role != Player.ROLE_SPY),
+            'num_resistance': len(resistance),
+            'resistance_roles': sorted(p.role_string() for p in resistance
+                                       if p.role != Player.ROLE_GOOD),
+            'has_mordred': any(p.is_mordred() for p in players),
+        }, sort_keys=True)
+        for player in players:
+            player.visible_spies = order_mask(p for p in players
+                                              if player.sees_as_spy(p))
+            if player.is_percival():
+                player.possible_merlins = order_mask(
+                    p for p in players if p.appears_as_merlin())
+            else:
+                player.possible_merlins = 0
+
+    def role_summary_dict(self):
+        if self.role_summary is None:
+            return None
+        return json.loads(self.role_summary)
+
+    def changed(self):
+        """Note that the game changed, so its status has to be materialized
+        again and the live state refreshed. log_event() does this."""
+        self._status_changed = True
+        livestate.game_changed(self)
+
+    def log_event(self, action, player=None, **data):
+        return self.log_events([(action, player, data)])[0]
+
+    def log_events(self, events):
+        """Log (action, player, data) events in that order."""
+        # Bump the counter in the database first so concurrent requests can
+        #   never be handed the same sequence numbers.
+        games = Game.objects.using(self._state.db).filter(pk=self.pk)
+        games.update(event_seq=models.F('event_seq') + len(events))
+        self.event_seq = games.values_list('event_seq', flat=True).get()
+        self.changed()
+        now = timezone.now()
+        game_events = []
+        for seq, (action, player, data) in enumerate(
+                events, self.event_seq - len(events) + 1):
+            if player is not None:
+                data = dict(data, player=player.pk)
+            game_events.append(GameEvent(game=self, seq=seq, action=action,
+                                         data=json.dumps(data,
+                                                         sort_keys=True),
+                                         created=now))
+        if len(game_events) == 1:
+            game_events[0].save(using=self._state.db)
+            return game_events
+        return GameEvent.objects.using(self._state.db)\
+                                .bulk_create(game_events)
+
 class Player(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE, db_index=True)
     SECRET_ID_LENGTH = 8
@@ -92,20 +358,24 @@ class Player(models.Model):
     order = models.IntegerField(null=True, default=None)
     ready = models.BooleanField(default=False)
     joined = models.DateTimeField()
-    last_accessed = models.DateTimeField()
-    # names are unique in a game
-    unique_together = (("game", "name"), ("game", "secret_id"))
+    last_accessed = models.DateTimeField(db_index=True)
+    # bitmasks over the orders of the other players (bit i is the player
+    #   with order i), set by Game.assign_knowledge() when the game starts
+    visible_spies = models.IntegerField(null=True, default=None)
+    possible_merlins = models.IntegerField(null=True, default=None)
+    class Meta:
+        # Names are unique in a game too (see JoinGameForm). Secrets are
+        #   random (see codes.py), so they may collide.
+        unique_together = (("game", "secret_id"),)
+
+    EXPIRE_AFTER = timedelta(seconds=10)
 
     def is_expired(self):
-        return timezone.now() - self.last_accessed > timedelta(seconds=10)
+        return timezone.now() - self.last_accessed > Player.EXPIRE_AFTER
 
     def change_secret_id(self):
-        # Make sure secret_id is unique before using it.
-        secret_id = generate_code(Player.SECRET_ID_LENGTH)
-        while Player.objects.filter(game=self.game,
-                                    secret_id=secret_id).exists():
-            secret_id = generate_code(Player.SECRET_ID_LENGTH)
-        self.secret_id = secret_id
+        self.secret_id = random_code(Player.SECRET_ID_LENGTH)
+        self._new_secret_id = True
 
     # from http://stackoverflow.com/a/11821832
     def save(self, *args, **kwargs):
@@ -114,7 +384,21 @@ class Player(models.Model):
             self.change_secret_id()
             self.joined = timezone.now()
         self.last_accessed = timezone.now()
-        super(Player, self).save(*args, **kwargs)
+        if not self.__dict__.pop('_new_secret_id', False):
+            return super(Player, self).save(*args, **kwargs)
+        using = kwargs.get('using')\
+                or router.db_for_write(Player, instance=self)
+        while True:
+            try:
+                with transaction.atomic(using=using):
+                    return super(Player, self).save(*args, **kwargs)
+            except IntegrityError:
+                if not Player.objects.using(using)\
+                                     .filter(game_id=self.game_id,
+                                             secret_id=self.secret_id)\
+                                     .exclude(pk=self.pk).exists():
+                    raise
+                self.secret_id = random_code(Player.SECRET_ID_LENGTH)
 
     def is_spy(self):
         if self.role is None:
@@ -182,15 +466,41 @@ class Player(models.Model):
     def appears_as_merlin(self):
         return self.is_merlin() or self.is_morgana()
 
+def order_mask(players):
+    mask = 0
+    for player in players:
+        mask |= 1 << player.order
+    return mask
+
+def players_in_mask(players, mask):
+    """The players whose bit is set in mask (see order_mask())."""
+    return [p for p in players if p.order is not None and mask >> p.order & 1]
+
+def in_mask(player, mask):
+    return player is not None and player.order is not None\
+           and mask >> player.order & 1 == 1
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+# The managers and the methods used when rendering a game only use .all() on
+#   related objects so a game loaded with livestate.load_game() can be
+#   rendered without any queries.
+
 class GameRoundManager(models.Manager):
     def get_current_game_round(self, game):
-        return self.filter(game=game).order_by('-round_num').first()
+        return max(game.gameround_set.all(), key=lambda r: r.round_num,
+                   default=None)
 
 class GameRound(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE, db_index=True)
     round_num = models.IntegerField()
     unique_together = (("game", "round_num"),)
     mission_passed = models.NullBooleanField()
+    # who went on the mission and who of them played fail, as bitmasks over
+    #   Player.order mirroring the MissionActions (see order_mask())
+    played_mask = models.IntegerField(default=0)
+    failed_mask = models.IntegerField(default=0)
 
     objects = GameRoundManager()
 
@@ -211,7 +521,7 @@ class GameRound(models.Model):
             return 'fail'
 
     def mission_size_tuple(self):
-        num_players = Player.objects.filter(game=self.game).count()
+        num_players = self.game.player_set.count()
         return mission_size(num_players=num_players,
                             round_num=self.round_num)
 
@@ -228,14 +538,34 @@ class GameRound(models.Model):
         if self.mission_passed is None:
             return None
         else:
-            return self.missionaction_set.filter(played_success=False).count()
+            return popcount(self.failed_mask)
 
     def played_fail(self):
         if self.mission_passed is None:
             return None
         else:
-            fail_actions = self.missionaction_set.filter(played_success=False)
-            return [action.player for action in fail_actions]
+            return players_in_mask(self.game.player_set.all(),
+                                   self.failed_mask)
+
+    def num_played(self):
+        return popcount(self.played_mask)
+
+    def mission_action_of(self, player):
+        """Whether player played success (None if they haven't played)."""
+        if not in_mask(player, self.played_mask):
+            return None
+        return not in_mask(player, self.failed_mask)
+
+    def record_mission_action(self, player, played_success):
+        self.missionaction_set.update_or_create(
+            defaults={'played_success': played_success}, player=player)
+        bit = 1 << player.order
+        if played_success:
+            failed_mask = self.failed_mask & ~bit
+        else:
+            failed_mask = self.failed_mask | bit
+        _update_fields(self, played_mask=self.played_mask | bit,
+                       failed_mask=failed_mask)
 
 class MissionAction(models.Model):
     game_round = models.ForeignKey(GameRound, on_delete=models.CASCADE, db_index=True)
@@ -243,11 +573,25 @@ class MissionAction(models.Model):
     unique_together = (("game", "player"),)
     played_success = models.BooleanField()
 
+def _update_fields(obj, **fields):
+    # An UPDATE of just these fields: save() would also write the other
+    #   fields, e.g. VoteRound's timestamps.
+    for name, value in fields.items():
+        setattr(obj, name, value)
+    type(obj).objects.using(obj._state.db).filter(pk=obj.pk).update(**fields)
+
+# a cell of the vote history, see VoteRound.player_votes()
+PlayerVoteCell = namedtuple('PlayerVoteCell',
+                            'player accept leader chosen played_fail')
+
 class VoteRoundManager(models.Manager):
     def get_current_vote_round(self, game=None, game_round=None):
         if game_round is None:
             game_round = GameRound.objects.get_current_game_round(game=game)
-        return self.filter(game_round=game_round).order_by('-vote_num').first()
+        if game_round is None:
+            return None
+        return max(game_round.voteround_set.all(), key=lambda v: v.vote_num,
+                   default=None)
 
 class VoteRound(models.Model):
     game_round = models.ForeignKey(GameRound, on_delete=models.CASCADE, db_index=True)
@@ -259,12 +603,21 @@ class VoteRound(models.Model):
     vote_status = models.IntegerField(default=VOTE_STATUS_WAITING)
     leader = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='vote_round_leader')
     chosen = models.ManyToManyField(Player, related_name='vote_round_chosen')
+    # chosen and the PlayerVotes as bitmasks over Player.order (see
+    #   order_mask()), so membership tests and tallies need no queries
+    chosen_mask = models.IntegerField(default=0)
+    voted_mask = models.IntegerField(default=0)
+    accepted_mask = models.IntegerField(default=0)
     started = models.DateTimeField()
     chose_team = models.DateTimeField(null=True, default=None)
     voted = models.DateTimeField(null=True, default=None)
 
     objects = VoteRoundManager()
 
+    class Meta:
+        # for the decision latency analytics (see analytics.py)
+        indexes = [models.Index(fields=['started', 'chose_team', 'voted'])]
+
     def is_team_finalized(self):
         return self.vote_status != VoteRound.VOTE_STATUS_WAITING
 
@@ -281,7 +634,73 @@ class VoteRound(models.Model):
         return self.vote_num == 1
 
     def is_chosen_correct_size(self):
-        return self.chosen.count() == self.game_round.num_players_on_mission()
+        return popcount(self.chosen_mask)\
+               == self.game_round.num_players_on_mission()
+
+    def is_chosen(self, player):
+        return in_mask(player, self.chosen_mask)
+
+    def chosen_players(self):
+        return sorted(players_in_mask(self.game_round.game.player_set.all(),
+                                      self.chosen_mask),
+                      key=lambda p: p.order)
+
+    def choose(self, player):
+        self.chosen.add(player)
+        _update_fields(self, chosen_mask=self.chosen_mask | 1 << player.order)
+
+    def unchoose(self, player):
+        self.chosen.remove(player)
+        _update_fields(self,
+                       chosen_mask=self.chosen_mask & ~(1 << player.order))
+
+    def set_chosen(self, players):
+        """Make players the whole team."""
+        self.chosen.set(players)
+        _update_fields(self, chosen_mask=order_mask(players))
+
+    def num_votes(self):
+        return popcount(self.voted_mask)
+
+    def vote_of(self, player):
+        """Whether player accepted the team (None if they haven't voted)."""
+        if not in_mask(player, self.voted_mask):
+            return None
+        return in_mask(player, self.accepted_mask)
+
+    def record_vote(self, player, accept):
+        self.playervote_set.update_or_create(defaults={'accept': accept},
+                                             player=player)
+        bit = 1 << player.order
+        if accept:
+            accepted_mask = self.accepted_mask | bit
+        else:
+            accepted_mask = self.accepted_mask & ~bit
+        _update_fields(self, voted_mask=self.voted_mask | bit,
+                       accepted_mask=accepted_mask)
+
+    def retract_vote(self, player):
+        self.playervote_set.filter(player=player).delete()
+        bit = 1 << player.order
+        _update_fields(self, voted_mask=self.voted_mask & ~bit,
+                       accepted_mask=self.accepted_mask & ~bit)
+
+    def clear_votes(self):
+        self.playervote_set.all().delete()
+        _update_fields(self, voted_mask=0, accepted_mask=0)
+
+    def player_votes(self):
+        """The votes in the order of the players, for the history."""
+        failed_mask = self.game_round.failed_mask
+        return [PlayerVoteCell(player=p,
+                               accept=in_mask(p, self.accepted_mask),
+                               leader=p.pk == self.leader_id,
+                               chosen=in_mask(p, self.chosen_mask),
+                               played_fail=in_mask(p, failed_mask))
+                for p in sorted(players_in_mask(
+                                    self.game_round.game.player_set.all(),
+                                    self.voted_mask),
+                                key=lambda p: p.order)]
 
     def is_final_vote(self):
         return self.vote_num == 5
@@ -289,13 +708,15 @@ class VoteRound(models.Model):
     def previous_vote(self):
         if self.is_first_vote():
             return None
-        return VoteRound.objects.get(game_round=self.game_round,
-                                     vote_num=self.vote_num-1)
+        for vote_round in self.game_round.voteround_set.all():
+            if vote_round.vote_num == self.vote_num - 1:
+                return vote_round
+        raise VoteRound.DoesNotExist()
 
     def vote_totals(self):
         num_players = self.game_round.game.num_players()
-        if self.playervote_set.count() == num_players:
-            accepts = self.playervote_set.filter(accept=True).count()
+        if self.num_votes() == num_players:
+            accepts = popcount(self.accepted_mask)
             rejects = num_players - accepts
             return {'accepts': accepts, 'rejects': rejects}
         else:
@@ -310,10 +731,9 @@ class VoteRound(models.Model):
 
     def next_leader(self):
         game = self.game_round.game
-        num_players = Player.objects.filter(game=game).count()
+        num_players = game.player_set.count()
         next_leader_order = (self.leader.order + 1) % num_players
-        next_leader = Player.objects.get(game=game,
-                                         order=next_leader_order)
+        next_leader = game.player_set.get(order=next_leader_order)
         return next_leader
 
     def save(self, *args, **kwargs):
@@ -332,3 +752,188 @@ class PlayerVote(models.Model):
     player = models.ForeignKey(Player, on_delete=models.CASCADE)
     unique_together = (("vote_round", "player"),)
     accept = models.BooleanField()
+
+class GameEvent(models.Model):
+    """Append-only log of every action taken in a game.
+
+    Replaying the events of a game in seq order (see replay.py) reconstructs
+    the state of the game at any point.
+    """
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, db_index=True)
+    seq = models.IntegerField()
+    EVENT_JOIN = 'join'
+    EVENT_LEAVE = 'leave'
+    EVENT_START = 'start'
+    EVENT_CANCEL = 'cancel'
+    EVENT_READY = 'ready'
+    EVENT_CHOOSE = 'choose'
+    EVENT_UNCHOOSE = 'unchoose'
+    EVENT_PROPOSE = 'propose'
+    EVENT_FINALIZE = 'finalize'
+    EVENT_RETRACT = 'retract'
+    EVENT_VOTE = 'vote'
+    EVENT_MISSION = 'mission'
+    EVENT_ASSASSINATE = 'assassinate'
+    EVENT_NEXT_GAME = 'next_game'
+    action = models.CharField(max_length=16)
+    data = models.TextField(default='{}')
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = (("game", "seq"),)
+        ordering = ('seq',)
+
+    def data_dict(self):
+        return json.loads(self.data)
+
+    def save(self, *args, **kwargs):
+        if not self.pk:
+            self.created = timezone.now()
+        super(GameEvent, self).save(*args, **kwargs)
+
+class GameStats(models.Model):
+    """Totals over all finished games with the same setup.
+
+    Updated once per game by record_game() when the game ends; the
+    rebuild_stats management command recomputes them from scratch.
+    """
+    num_players = models.IntegerField()
+    role_config = models.CharField(max_length=200)
+    games = models.IntegerField(default=0)
+    resistance_wins = models.IntegerField(default=0)
+    missions = models.IntegerField(default=0)
+    vote_rounds = models.IntegerField(default=0)
+    assassinations = models.IntegerField(default=0)
+    merlin_assassinated = models.IntegerField(default=0)
+
+    COUNTERS = ('games', 'resistance_wins', 'missions', 'vote_rounds',
+                'assassinations', 'merlin_assassinated')
+
+    class Meta:
+        unique_together = (("num_players", "role_config"),)
+        ordering = ('num_players', 'role_config')
+
+    @staticmethod
+    def game_totals(game):
+        """This game's contribution to the GameStats counters.
+
+        Only uses .all() on related objects so it can be used with
+        prefetch_related().
+        """
+        game_rounds = game.gameround_set.all()
+        assassinated = game.player_assassinated
+        return {
+            'games': 1,
+            'resistance_wins': 1 if game.resistance_won() else 0,
+            # not a round which ended on the fifth rejected team
+            'missions': len([r for r in game_rounds
+                             if r.mission_passed is not None]),
+            'vote_rounds': sum(len([v for v in r.voteround_set.all()
+                                    if v.is_voting_complete()])
+                               for r in game_rounds),
+            'assassinations': 0 if assassinated is None else 1,
+            'merlin_assassinated': 1 if assassinated is not None
+                                        and assassinated.is_merlin() else 0,
+        }
+
+    @classmethod
+    def add(cls, num_players, role_config, totals):
+        stats, _ = cls.objects.get_or_create(num_players=num_players,
+                                             role_config=role_config)
+        cls.objects.filter(pk=stats.pk)\
+                   .update(**{name: models.F(name) + totals[name]
+                              for name in cls.COUNTERS})
+
+    @classmethod
+    def record_game(cls, game):
+        cls.add(game.num_players(), game.role_config(), cls.game_totals(game))
+
+    def _rate(self, count, total):
+        if not total:
+            return None
+        return 100.0 * count / total
+
+    def resistance_win_percent(self):
+        return self._rate(self.resistance_wins, self.games)
+
+    def spy_win_percent(self):
+        return self._rate(self.games - self.resistance_wins, self.games)
+
+    def votes_per_mission(self):
+        if not self.missions:
+            return None
+        return 1.0 * self.vote_rounds / self.missions
+
+    def merlin_assassinated_percent(self):
+        return self._rate(self.merlin_assassinated, self.assassinations)
+
+class Series(models.Model):
+    """Running scoreboard of a series of games, each the next game of the
+    one before (see Game.series_code).
+
+    Updated once per game by record_game() when the game ends, so showing it
+    never needs to walk the chain of games.
+    """
+    code = models.CharField(primary_key=True,
+                            max_length=Game.ACCESS_CODE_LENGTH)
+    games = models.IntegerField(default=0)
+    resistance_wins = models.IntegerField(default=0)
+    merlin_assassinated = models.IntegerField(default=0)
+    # JSON map from player name to [games played, games won]
+    players = models.TextField(default='{}')
+
+    @staticmethod
+    def game_results(game):
+        """(whether the resistance won, whether Merlin was assassinated, map
+        from player name to whether they won) of a finished game.
+
+        Only uses .all() on related objects so it can be used with
+        prefetch_related().
+        """
+        resistance_won = game.resistance_won()
+        assassinated = game.player_assassinated
+        return (resistance_won,
+                assassinated is not None and assassinated.is_merlin(),
+                {p.name: p.is_spy() != resistance_won
+                 for p in game.player_set.all()})
+
+    @staticmethod
+    def add_results(players, results):
+        """Add the map from name to won from game_results() to players (see
+        Series.players)."""
+        for name, won in results.items():
+            record = players.setdefault(name, [0, 0])
+            record[0] += 1
+            if won:
+                record[1] += 1
+
+    @classmethod
+    def record_game(cls, game):
+        if game.series_code is None:
+            return
+        resistance_won, merlin_assassinated, results = cls.game_results(game)
+        # the transaction takes the write lock before reading the players,
+        #   so concurrent updates can't lose each other's results
+        with transaction.atomic(using=router.db_for_write(cls)):
+            series, _ = cls.objects.get_or_create(code=game.series_code)
+            players = series.players_dict()
+            cls.add_results(players, results)
+            cls.objects.filter(pk=series.pk).update(
+                games=models.F('games') + 1,
+                resistance_wins=models.F('resistance_wins')
+                                + (1 if resistance_won else 0),
+                merlin_assassinated=models.F('merlin_assassinated')
+                                    + (1 if merlin_assassinated else 0),
+                players=json.dumps(players, sort_keys=True))
+
+    def players_dict(self):
+        return json.loads(self.players)
+
+    def spy_wins(self):
+        return self.games - self.resistance_wins
+
+    def scoreboard(self):
+        """(name, games played, games won) of every player, best first."""
+        return sorted(((name, played, won) for name, (played, won)
+                       in self.players_dict().items()),
+                      key=lambda row: (-row[2], row[1], row[0]))
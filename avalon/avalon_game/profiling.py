@@ -0,0 +1,173 @@
+"""Opt-in request profiling with slow request capture.
+
+ProfilingMiddleware is only installed if settings.AVALON_PROFILE_DIR is set.
+Then:
+
+ * a random AVALON_PROFILE_SAMPLE_RATE fraction of requests are run under
+   cProfile and always dumped;
+ * every other request is watched by a low-overhead stack sampler (a single
+   background thread looking at the request thread's stack every
+   AVALON_PROFILE_INTERVAL seconds) and dumped only if it took longer than
+   AVALON_PROFILE_SLOW_MS.
+
+Every dump has a .json file with the request metadata (view name, game phase,
+number of players, latency), the SQL executed and (for slow requests) the
+sampled stacks; cProfile dumps also have a .prof file readable by pstats.
+Only the newest AVALON_PROFILE_MAX_DUMPS dumps are kept. The profile_summary
+management command summarizes the hot spots across all dumps.
+"""
+from collections import Counter
+from contextlib import ExitStack
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+class StackSampler(object):
+    """Periodically records the stacks of the registered threads."""
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._samples[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='avalon-stack-sampler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._samples.pop(thread_id)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_format_stack(frame)] += 1
+
+
+def _format_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%d(%s)' % (code.co_filename, frame.f_lineno,
+                                    code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SQLRecorder(object):
+    """execute_wrapper() which records every query and its duration."""
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+
+def _tag(value):
+    return ''.join(c if c.isalnum() or c == '_' else '-' for c in str(value))
+
+
+class ProfilingMiddleware(object):
+    def __init__(self, get_response):
+        if not settings.AVALON_PROFILE_DIR:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.directory = settings.AVALON_PROFILE_DIR
+        self.sample_rate = settings.AVALON_PROFILE_SAMPLE_RATE
+        self.slow = settings.AVALON_PROFILE_SLOW_MS / 1000.0
+        self.max_dumps = settings.AVALON_PROFILE_MAX_DUMPS
+        self.sampler = StackSampler(settings.AVALON_PROFILE_INTERVAL)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __call__(self, request):
+        recorder = SQLRecorder()
+        profile = None
+        thread_id = threading.get_ident()
+        if random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+        else:
+            self.sampler.start(thread_id)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(recorder))
+                if profile is not None:
+                    response = profile.runcall(self.get_response, request)
+                else:
+                    response = self.get_response(request)
+        finally:
+            duration = time.perf_counter() - start
+            samples = None if profile is not None\
+                      else self.sampler.stop(thread_id)
+
+        if profile is not None or duration >= self.slow:
+            self.dump(request, duration, recorder.queries, profile, samples)
+        return response
+
+    def dump(self, request, duration, queries, profile, samples):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name if match is not None else None)\
+               or 'unresolved'
+        game = getattr(request, 'avalon_game', None)
+        if game is not None:
+            phase = game.game_phase_string()
+            num_players = game.player_set.count()
+        else:
+            phase = 'none'
+            num_players = 0
+        name = '%s-%dms-%s-%s-%dp-%s' % (time.strftime('%Y%m%dT%H%M%S'),
+                                          duration * 1000, _tag(view),
+                                          phase, num_players,
+                                          uuid.uuid4().hex[:8])
+        base = os.path.join(self.directory, name)
+        if profile is not None:
+            profile.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as f:
+            json.dump({
+                'view': view,
+                'path': request.path,
+                'method': request.method,
+                'game_phase': phase,
+                'num_players': num_players,
+                'duration': duration,
+                'sampled': profile is not None,
+                'queries': queries,
+                'stacks': dict(samples) if samples else {},
+            }, f)
+        self.rotate()
+
+    def rotate(self):
+        dumps = sorted(f[:-len('.json')] for f in os.listdir(self.directory)
+                       if f.endswith('.json'))
+        for name in dumps[:-self.max_dumps]:
+            for ext in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except OSError:
+                    pass
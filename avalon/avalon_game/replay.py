@@ -0,0 +1,228 @@
+"""Reconstruct the state of a game by replaying its GameEvent log.
+
+The replayed state only uses plain Python objects, so it can be computed for
+any point in a game's history (not just the current state) and used to
+rebuild anything derived from the game tables.
+"""
+from collections import OrderedDict
+
+from .helpers import mission_size
+from .models import Game, VoteRound
+
+
+class PlayerState(object):
+    def __init__(self, pk, name):
+        self.pk = pk
+        self.name = name
+        self.role = None
+        self.order = None
+        self.ready = False
+
+    def is_spy(self):
+        if self.role is None:
+            return None
+        return self.role < 0
+
+
+class VoteRoundState(object):
+    def __init__(self, vote_num, leader):
+        self.vote_num = vote_num
+        self.leader = leader
+        self.vote_status = VoteRound.VOTE_STATUS_WAITING
+        # orders of the chosen players
+        self.chosen = set()
+        # player pk -> accept
+        self.votes = {}
+
+    def vote_totals(self, num_players):
+        if len(self.votes) != num_players:
+            return None
+        accepts = len([v for v in self.votes.values() if v])
+        return {'accepts': accepts, 'rejects': num_players - accepts}
+
+
+class GameRoundState(object):
+    def __init__(self, round_num):
+        self.round_num = round_num
+        self.vote_rounds = []
+        # player pk -> played_success
+        self.mission_actions = {}
+        self.mission_passed = None
+
+    def current_vote_round(self):
+        return self.vote_rounds[-1]
+
+
+class GameState(object):
+    def __init__(self):
+        self.seq = 0
+        self.game_phase = Game.GAME_PHASE_LOBBY
+        self.times_started = 0
+        self.display_history = None
+        self.private_voting = None
+        self.players = OrderedDict()
+        self.game_rounds = []
+        self.player_assassinated = None
+        self.next_game = None
+
+    def num_players(self):
+        return len(self.players)
+
+    def player_by_order(self, order):
+        for p in self.players.values():
+            if p.order == order:
+                return p
+        return None
+
+    def current_game_round(self):
+        return self.game_rounds[-1]
+
+    def apply(self, event):
+        getattr(self, '_apply_' + event.action)(**event.data_dict())
+        self.seq = event.seq
+
+    def _new_vote_round(self, game_round, leader_order):
+        vote_round = VoteRoundState(len(game_round.vote_rounds) + 1,
+                                    self.player_by_order(leader_order))
+        game_round.vote_rounds.append(vote_round)
+
+    def _next_leader_order(self):
+        leader = self.current_game_round().current_vote_round().leader
+        return (leader.order + 1) % self.num_players()
+
+    def _apply_join(self, player, name):
+        self.players[player] = PlayerState(player, name)
+
+    def _apply_leave(self, player):
+        del self.players[player]
+
+    def _apply_start(self, display_history, private_voting, roles,
+                     player=None):
+        self.display_history = display_history
+        self.private_voting = private_voting
+        self.game_phase = Game.GAME_PHASE_ROLE
+        self.times_started += 1
+        for pk, (role, order) in roles.items():
+            self.players[int(pk)].role = role
+            self.players[int(pk)].order = order
+
+    def _apply_cancel(self, player=None):
+        if player is not None:
+            self.players[player].ready = False
+        self.game_phase = Game.GAME_PHASE_LOBBY
+
+    def _apply_ready(self, player):
+        self.players[player].ready = True
+        if all(p.ready for p in self.players.values()):
+            self.game_phase = Game.GAME_PHASE_PICK
+            game_round = GameRoundState(1)
+            self.game_rounds.append(game_round)
+            self._new_vote_round(game_round, 0)
+
+    def _apply_choose(self, player, who):
+        self.current_game_round().current_vote_round().chosen.add(who)
+
+    def _apply_unchoose(self, player, who):
+        self.current_game_round().current_vote_round().chosen.discard(who)
+
+    def _apply_propose(self, player, team):
+        self.current_game_round().current_vote_round().chosen = set(team)
+
+    def _apply_finalize(self, player):
+        vote_round = self.current_game_round().current_vote_round()
+        vote_round.vote_status = VoteRound.VOTE_STATUS_VOTING
+        self.game_phase = Game.GAME_PHASE_VOTE
+
+    def _apply_retract(self, player):
+        vote_round = self.current_game_round().current_vote_round()
+        vote_round.vote_status = VoteRound.VOTE_STATUS_WAITING
+        vote_round.votes.clear()
+        self.game_phase = Game.GAME_PHASE_PICK
+
+    def _apply_vote(self, player, vote):
+        game_round = self.current_game_round()
+        vote_round = game_round.current_vote_round()
+        if vote == "cancel":
+            vote_round.votes.pop(player, None)
+            return
+        vote_round.votes[player] = vote == "approve"
+        votes = vote_round.vote_totals(self.num_players())
+        if votes is None:
+            return
+        vote_round.vote_status = VoteRound.VOTE_STATUS_VOTED
+        if votes['accepts'] > votes['rejects']:
+            self.game_phase = Game.GAME_PHASE_MISSION
+        elif vote_round.vote_num == 5:
+            self.game_phase = Game.GAME_PHASE_END
+        else:
+            self.game_phase = Game.GAME_PHASE_PICK
+            self._new_vote_round(game_round, self._next_leader_order())
+
+    def _apply_mission(self, player, success):
+        game_round = self.current_game_round()
+        game_round.mission_actions[player] = success
+        num_on_mission, num_fails_required =\
+            mission_size(num_players=self.num_players(),
+                         round_num=game_round.round_num)
+        if len(game_round.mission_actions) != num_on_mission:
+            return
+        fails = len([s for s in game_round.mission_actions.values() if not s])
+        game_round.mission_passed = fails < num_fails_required
+        res_wins = len([r for r in self.game_rounds if r.mission_passed])
+        spy_wins = len([r for r in self.game_rounds
+                        if r.mission_passed is False])
+        if res_wins == 3:
+            self.game_phase = Game.GAME_PHASE_ASSASSIN
+        elif spy_wins == 3:
+            self.game_phase = Game.GAME_PHASE_END
+        else:
+            self.game_phase = Game.GAME_PHASE_PICK
+            next_leader_order = self._next_leader_order()
+            game_round = GameRoundState(game_round.round_num + 1)
+            self.game_rounds.append(game_round)
+            self._new_vote_round(game_round, next_leader_order)
+
+    def _apply_assassinate(self, player, target):
+        self.player_assassinated = self.player_by_order(target)
+        self.game_phase = Game.GAME_PHASE_END
+
+    def _apply_next_game(self, next_game):
+        self.next_game = next_game
+
+    def as_dict(self):
+        players = sorted(self.players.values(),
+                         key=lambda p: (p.order is None, p.order, p.pk))
+        return {
+            'seq': self.seq,
+            'game_phase': Game._game_phase_strings[self.game_phase],
+            'times_started': self.times_started,
+            'players': [{'name': p.name, 'role': p.role, 'order': p.order,
+                         'ready': p.ready} for p in players],
+            'rounds': [{
+                'round_num': r.round_num,
+                'mission_passed': r.mission_passed,
+                'votes': [{
+                    'vote_num': v.vote_num,
+                    'leader': v.leader.name,
+                    'vote_status': v.vote_status,
+                    'chosen': sorted(v.chosen),
+                    'accepts': sorted(self.players[pk].name
+                                      for pk, accept in v.votes.items()
+                                      if accept),
+                } for v in r.vote_rounds],
+            } for r in self.game_rounds],
+            'player_assassinated': None if self.player_assassinated is None
+                                   else self.player_assassinated.name,
+            'next_game': self.next_game,
+        }
+
+
+def replay_game(game, seq=None):
+    """Return the GameState of game after event seq (default: all events)."""
+    state = GameState()
+    events = game.gameevent_set.order_by('seq')
+    if seq is not None:
+        events = events.filter(seq__lte=seq)
+    for event in events.iterator():
+        state.apply(event)
+    return state
@@ -0,0 +1,124 @@
+"""Spreading games across several SQLite databases.
+
+Games are independent of each other, so each game and all of its rows
+(players, rounds, votes, mission actions and events) live together in one
+database, chosen from the access code by shard_for_code(). Finding a game by
+its access code therefore never needs a directory lookup. Everything else
+(CodeSequence, GameStats, Series) stays in the 'default' database.
+
+With settings.AVALON_GAME_SHARDS unset, 'default' is the only game database
+and nothing changes. Otherwise the game databases are 'games0', 'games1', ...
+(see settings.py) and GameShardRouter sends queries for game rows to the
+database of the game they belong to. Queries which don't have an instance to
+route by (e.g. Player.objects.filter(game=game)) go to 'default', so game
+code has to go through the related managers (game.player_set),
+Game.objects.for_access_code() or .using(game._state.db) instead.
+
+If the number of shards changes, the rebalance_shards management command
+moves every game to the database its access code now maps to.
+"""
+from contextlib import contextmanager
+import zlib
+
+from django.conf import settings
+from django.db import connections, transaction
+
+# the models stored in the game databases (lowercase model names)
+GAME_MODELS = frozenset(['game', 'player', 'gameround', 'voteround',
+                         'voteround_chosen', 'playervote', 'missionaction',
+                         'gameevent'])
+
+# the foreign keys to follow to find the game a row belongs to
+_PARENT_FIELDS = ('game', 'game_round', 'vote_round', 'voteround', 'player')
+
+
+def shard_alias(i):
+    return 'games%d' % i
+
+
+def game_databases():
+    """The database aliases games are currently spread across."""
+    if not settings.AVALON_GAME_SHARDS:
+        return ['default']
+    return [shard_alias(i) for i in range(settings.AVALON_GAME_SHARDS)]
+
+
+def all_game_databases():
+    """Every configured database which may hold games (e.g. for rebalancing
+    after the number of shards changed)."""
+    return ['default'] + sorted(alias for alias in settings.DATABASES
+                                if alias.startswith('games'))
+
+
+def shard_for_code(access_code):
+    databases = game_databases()
+    return databases[zlib.crc32(access_code.lower().encode('utf-8'))
+                     % len(databases)]
+
+
+@contextmanager
+def game_atomic(using, view=None):
+    """Make the block atomic on the given database, like ATOMIC_REQUESTS.
+
+    When games are sharded no database has ATOMIC_REQUESTS set, since
+    starting a transaction locks the whole database (see avalon/sqlite3);
+    views instead only lock the database of the game they work on. This is a
+    no-op if the handler already made the request atomic or the view is
+    marked with transaction.non_atomic_requests.
+    """
+    if connections[using].settings_dict['ATOMIC_REQUESTS']\
+            or using in getattr(view, '_non_atomic_requests', ()):
+        yield
+    else:
+        with transaction.atomic(using=using):
+            yield
+
+
+def is_game_model(model):
+    return model._meta.app_label == 'avalon_game'\
+           and model._meta.model_name in GAME_MODELS
+
+
+def instance_db(instance):
+    """The database a (possibly unsaved) game row belongs in, if known."""
+    if instance._state.db is not None:
+        return instance._state.db
+    if instance._meta.model_name == 'game':
+        if instance.access_code:
+            return shard_for_code(instance.access_code)
+        return None
+    for name in _PARENT_FIELDS:
+        try:
+            field = instance._meta.get_field(name)
+        except Exception:
+            continue
+        if field.is_relation and field.is_cached(instance):
+            parent = getattr(instance, name)
+            if parent is not None:
+                return instance_db(parent)
+    return None
+
+
+class GameShardRouter(object):
+    def _db_for_game_model(self, model, **hints):
+        if not is_game_model(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and is_game_model(type(instance)):
+            return instance_db(instance)
+        return None
+
+    db_for_read = _db_for_game_model
+    db_for_write = _db_for_game_model
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_game_model(type(obj1)) and is_game_model(type(obj2)):
+            return instance_db(obj1) == instance_db(obj2)
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != 'avalon_game' or model_name is None:
+            return None
+        if model_name in GAME_MODELS:
+            return db in all_game_databases()
+        return db == 'default'
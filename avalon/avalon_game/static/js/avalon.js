@@ -0,0 +1,227 @@
+// The scripts of the game pages: polling the status (see game.html), posting
+//   actions with AJAX and showing the role info (see in_game.html). Plain
+//   JavaScript, so the pages don't load a library.
+var avalon = (function() {
+  "use strict";
+
+  // Show (or hide) el, or toggle it if show isn't given.
+  function toggle(el, show) {
+    if(!el) {
+      return;
+    }
+    if(show === undefined) {
+      show = getComputedStyle(el).display == "none";
+    }
+    el.style.display = "";
+    if(show && getComputedStyle(el).display == "none") {
+      // hidden by the stylesheet
+      el.style.display = "block";
+    } else if(!show) {
+      el.style.display = "none";
+    }
+  }
+
+  function setText(id, text) {
+    var el = document.getElementById(id);
+    if(el) {
+      el.textContent = text;
+    }
+  }
+
+  // Replace the items of the list with id by names, marking the item of
+  //   highlighted as "this-player".
+  function setList(id, names, highlighted) {
+    var list = document.getElementById(id);
+    while(list.firstChild) {
+      list.removeChild(list.firstChild);
+    }
+    names.forEach(function(name) {
+      var el = document.createElement("li");
+      el.textContent = name;
+      if(name == highlighted) {
+        el.className = "this-player";
+      }
+      list.appendChild(el);
+    });
+  }
+
+  // Request url expecting a JSON status, with the extra request headers if
+  //   given; calls done(data, xhr) (with data null for a 304 Not Modified)
+  //   or fail(xhr).
+  function requestJSON(method, url, body, done, fail, headers) {
+    var xhr = new XMLHttpRequest();
+    xhr.open(method, url);
+    // see wants_json() in views.py
+    xhr.setRequestHeader("Accept", "application/json");
+    Object.keys(headers || {}).forEach(function(name) {
+      xhr.setRequestHeader(name, headers[name]);
+    });
+    xhr.onload = function() {
+      var data;
+      if(xhr.status == 304) {
+        done(null, xhr);
+        return;
+      }
+      if(xhr.status < 200 || xhr.status >= 300) {
+        fail(xhr);
+        return;
+      }
+      try {
+        data = JSON.parse(xhr.responseText);
+      } catch(e) {
+        fail(xhr);
+        return;
+      }
+      done(data, xhr);
+    };
+    xhr.onerror = function() {
+      fail(xhr);
+    };
+    xhr.send(body);
+  }
+
+  // The server recommends how long to wait before the next poll in the
+  //   X-Poll-Interval header (in milliseconds). Polling stops while the page
+  //   is hidden and backs off exponentially on errors (at least as long as
+  //   the Retry-After header says).
+  //
+  //   When the server is run with ASGI (see avalon/asgi.py), it gives a
+  //   waitUrl to long-poll instead: the server only answers it once the
+  //   status has changed from the one with the ETag sent along (or with a
+  //   304 after a while), so it is asked again right away.
+  var maxErrorDelay = 5 * 60 * 1000;
+  var statusUrl = null;
+  var waitUrl = null;
+  var statusEtag = null;
+  var status = null;
+  var handleNewStatus = null;
+  var pollInterval = 0;
+  var errorDelay = 0;
+  var pollTimer = null;
+  var polling = false;
+
+  function nextPollDelay() {
+    return waitUrl ? 0 : pollInterval;
+  }
+
+  function schedulePoll(delay) {
+    clearTimeout(pollTimer);
+    pollTimer = null;
+    if(!document.hidden) {
+      pollTimer = setTimeout(poll, delay);
+    }
+  }
+
+  // Returns false if the page is reloaded to show newStatus.
+  function applyStatus(newStatus, xhr) {
+    var interval = parseInt(xhr.getResponseHeader("X-Poll-Interval"), 10);
+    if(interval > 0) {
+      pollInterval = interval;
+    }
+    var etag = xhr.getResponseHeader("ETag");
+    if(etag) {
+      statusEtag = etag;
+    }
+    if(newStatus !== null && JSON.stringify(newStatus) != JSON.stringify(status)) {
+      if(!handleNewStatus(status, newStatus)) {
+        document.getElementById("button-refresh").click();
+        return false;
+      }
+    }
+    return true;
+  }
+
+  function poll() {
+    pollTimer = null;
+    if(polling) {
+      // the request in flight schedules the next one
+      return;
+    }
+    polling = true;
+    var url = statusUrl, headers = null;
+    if(waitUrl) {
+      url = waitUrl;
+      headers = {"If-None-Match": statusEtag};
+    }
+    requestJSON("GET", url, null, function(data, xhr) {
+      polling = false;
+      errorDelay = 0;
+      if(applyStatus(data, xhr)) {
+        schedulePoll(nextPollDelay());
+      }
+    }, function(xhr) {
+      polling = false;
+      errorDelay = Math.min(errorDelay ? 2 * errorDelay : pollInterval,
+                            maxErrorDelay);
+      // the server sheds polls while overloaded (see admission.py)
+      var retryAfter = parseInt(xhr.getResponseHeader("Retry-After"), 10);
+      if(retryAfter > 0) {
+        errorDelay = Math.max(errorDelay, 1000 * retryAfter);
+      }
+      schedulePoll(errorDelay);
+    }, headers);
+  }
+
+  // Poll url for the status, calling handle(oldStatus, newStatus) when it
+  //   changes, which either updates the page (and initialStatus, which is
+  //   the status the page shows) and returns true or returns false to have
+  //   the page reloaded. longPollUrl and etag (of initialStatus) are only
+  //   given to long-poll.
+  function startPolling(url, initialStatus, interval, handle, longPollUrl,
+                        etag) {
+    statusUrl = url;
+    waitUrl = longPollUrl || null;
+    statusEtag = etag || null;
+    status = initialStatus;
+    pollInterval = interval;
+    handleNewStatus = handle;
+    document.addEventListener("visibilitychange", function() {
+      if(document.hidden) {
+        clearTimeout(pollTimer);
+        pollTimer = null;
+      } else if(!polling) {
+        // catch up right away when the player comes back
+        schedulePoll(errorDelay);
+      }
+    });
+    schedulePoll(nextPollDelay());
+  }
+
+  // Post form to action with AJAX and show the new status it answers with
+  //   instead of a redirect to the whole page (see json_action() in
+  //   views.py). If that fails, the form is submitted normally.
+  function postForm(form, action) {
+    requestJSON("POST", action, new FormData(form), function(data, xhr) {
+      if(applyStatus(data, xhr)) {
+        schedulePoll(nextPollDelay());
+      }
+    }, function() {
+      form.setAttribute("action", action);
+      form.submit();
+    });
+  }
+
+  document.addEventListener("click", function(event) {
+    var target = event.target;
+    // buttons marked data-ajax post their action with postForm()
+    var button = target.closest("button[data-ajax]");
+    if(button && statusUrl) {
+      event.preventDefault();
+      postForm(button.form, button.getAttribute("formaction")
+                            || button.form.action);
+      return;
+    }
+    if(target.closest(".role-info")) {
+      toggle(document.getElementById("role-info"));
+      toggle(document.getElementById("role-info-hidden"));
+    }
+  });
+
+  return {
+    toggle: toggle,
+    setText: setText,
+    setList: setList,
+    startPolling: startPolling,
+    postForm: postForm
+  };
+})();
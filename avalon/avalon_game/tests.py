@@ -1,3 +1,1388 @@
-from django.test import TestCase
+import asyncio
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+import json
+import math
+import gzip
+import importlib
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.handlers.base import BaseHandler
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.templatetags.static import static
+from django.test import AsyncClient, Client, RequestFactory,\
+                        SimpleTestCase, TransactionTestCase,\
+                        override_settings
+from django.urls import clear_url_caches, reverse
+from django.utils import timezone
+
+from . import admission, livestate, longpoll
+from .analytics import decision_latency
+from .assets import serve_static
+from .codes import CodePermutation, code_for
+from .export import CSV_COLUMNS, exported_games, history_records
+from .helpers import deterministic_random_boolean
+from .management.commands.generate_games import GameGenerator,\
+                                                generate_games
+from .management.commands.rebuild_masks import rebuild_masks
+from .management.commands.replay_traffic import Replayer
+from .metrics import LATENCY_BUCKETS, REGISTRY
+from .models import Game, GameEvent, GameRound, GameStats, Player, Series,\
+                    VoteRound, players_in_mask
+from .profiling import StackSampler
+from .replay import replay_game
+from .sharding import GameShardRouter, game_databases, shard_for_code
+from .views import game_status_string
+from .warmup import template_names, warm_up
+from . import urls as game_urls
+
+
+class GamePlayer(object):
+    """Plays games through the web interface like a (very fast) table."""
+    def __init__(self, num_players):
+        self.client = Client()
+        self.num_players = num_players
+
+    def game_url(self, name, player, **kwargs):
+        kwargs['access_code'] = self.access_code
+        kwargs['player_secret'] = player.secret_id
+        return reverse(name, kwargs=kwargs)
+
+    def create(self):
+        response = self.client.post(reverse('new_game'), {'name': 'p0'})
+        self.access_code = response.url.strip('/').split('/')[-2]
+        for i in range(1, self.num_players):
+            self.client.post(reverse('enter_code'),
+                             {'game': self.access_code, 'player': 'p%d' % i})
+
+    def game(self):
+        return Game.objects.for_access_code(self.access_code).get()
+
+    def play(self, create=True):
+        if create:
+            self.create()
+        game = self.game()
+        first = game.player_set.first()
+        self.client.post(self.game_url('start', first),
+                         {'merlin': 'on', 'percival': 'on', 'assassin': 'on',
+                          'morgana': 'on', 'display_history': 'on'})
+        for p in self.game().player_set.all():
+            self.client.post(self.game_url('ready', p))
+
+        for step in range(100):
+            game = self.game()
+            players = list(game.player_set.order_by('order'))
+            for p in players:
+                self.client.get(self.game_url('status', p))
+            if game.game_phase == Game.GAME_PHASE_END:
+                break
+            vote_round = VoteRound.objects.get_current_vote_round(game)
+            game_round = vote_round.game_round
+            nums = {'round_num': game_round.round_num,
+                    'vote_num': vote_round.vote_num}
+            if game.game_phase == Game.GAME_PHASE_PICK:
+                leader = vote_round.leader
+                self.client.get(self.game_url('game', leader))
+                for i in range(game_round.num_players_on_mission()):
+                    who = (leader.order + i) % len(players)
+                    self.client.post(self.game_url('choose', leader, who=who,
+                                                   **nums))
+                self.client.post(self.game_url('finalize_team', leader,
+                                               **nums))
+            elif game.game_phase == Game.GAME_PHASE_VOTE:
+                for p in players:
+                    self.client.get(self.game_url('game', p))
+                    vote = 'approve' if vote_round.vote_num > 1 or p.order % 2\
+                           else 'reject'
+                    self.client.post(self.game_url('vote', p, vote=vote,
+                                                   **nums))
+            elif game.game_phase == Game.GAME_PHASE_MISSION:
+                for p in vote_round.chosen.all():
+                    self.client.get(self.game_url('game', p))
+                    self.client.post(self.game_url(
+                        'mission', p, round_num=game_round.round_num,
+                        mission_action='fail'))
+            elif game.game_phase == Game.GAME_PHASE_ASSASSIN:
+                assassin = game.player_set.get(role=Player.ROLE_ASSASSIN)
+                target = game.player_set.filter(role__gt=0).first()
+                self.client.post(self.game_url('assassinate', assassin,
+                                               target=target.order))
+        return self.game()
+
+
+def stored_state(game):
+    """replay_game(game).as_dict() computed from the game's rows instead of
+    its events."""
+    players = sorted(game.player_set.all(),
+                     key=lambda p: (p.order is None, p.order, p.pk))
+    return {
+        'seq': game.event_seq,
+        'game_phase': game.game_phase_string(),
+        'times_started': game.times_started,
+        'players': [{'name': p.name, 'role': p.role, 'order': p.order,
+                     'ready': p.ready} for p in players],
+        'rounds': [{
+            'round_num': r.round_num,
+            'mission_passed': r.mission_passed,
+            'votes': [{
+                'vote_num': v.vote_num,
+                'leader': v.leader.name,
+                'vote_status': v.vote_status,
+                'chosen': sorted(p.order for p in v.chosen.all()),
+                'accepts': sorted(pv.player.name for pv
+                                  in v.playervote_set.filter(accept=True)),
+            } for v in r.voteround_set.order_by('vote_num')],
+        } for r in game.gameround_set.order_by('round_num')],
+        'player_assassinated': None if game.player_assassinated is None
+                               else game.player_assassinated.name,
+        'next_game': game.next_access_code,
+    }
+
+
+class DeterministicRandomBooleanTests(SimpleTestCase):
+    def test_stable(self):
+        for i in range(100):
+            seed = 'abcdef-ghijklmn-%d-1' % i
+            self.assertEqual(deterministic_random_boolean(seed),
+                             deterministic_random_boolean(seed))
+
+    def test_balanced(self):
+        results = Counter(deterministic_random_boolean('seed-%d' % i)
+                          for i in range(1000))
+        self.assertGreater(results[True], 400)
+        self.assertGreater(results[False], 400)
+
+
+class CodePermutationTests(SimpleTestCase):
+    def test_bijective(self):
+        for length in (1, 2, 3):
+            permutation = CodePermutation(length, b'key')
+            self.assertEqual(sorted(permutation.permute(i)
+                                    for i in range(permutation.domain)),
+                             list(range(permutation.domain)))
+
+    def test_code_format(self):
+        codes = [code_for('test', 6, i) for i in range(1000)]
+        self.assertEqual(len(set(codes)), len(codes))
+        for code in codes:
+            self.assertRegex(code, r'^[a-z]{6}$')
+
+
+class PlayerSecretTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_colliding_secrets_are_replaced(self):
+        table = GamePlayer(2)
+        table.create()
+        game = table.game()
+        taken = game.player_set.get(name='p0').secret_id
+        with mock.patch('avalon_game.models.random_code',
+                        side_effect=[taken, 'aaaaaaaa']):
+            player = Player(game=game, name='p2')
+            player.save()
+        self.assertEqual(player.secret_id, 'aaaaaaaa')
+
+        with mock.patch('avalon_game.models.random_codes',
+                        side_effect=[[taken, 'bbbbbbbb'],
+                                     ['cccccccc', 'dddddddd']]):
+            game.add_players(['p3', 'p4'])
+        secrets = list(game.player_set.values_list('secret_id', flat=True))
+        self.assertEqual(len(set(secrets)), 5)
+        self.assertLessEqual({'aaaaaaaa', 'cccccccc', 'dddddddd'},
+                             set(secrets))
+
+
+@override_settings(AVALON_GAME_SHARDS=4)
+class ShardingTests(SimpleTestCase):
+    def test_shard_for_code(self):
+        codes = [code_for('test', 6, i) for i in range(200)]
+        shards = Counter(shard_for_code(code) for code in codes)
+        self.assertEqual(sorted(shards), ['games0', 'games1', 'games2',
+                                          'games3'])
+        for code in codes:
+            self.assertEqual(shard_for_code(code),
+                             shard_for_code(code.upper()))
+
+    def test_router_follows_game(self):
+        router = GameShardRouter()
+        game = Game(access_code='abcdef')
+        player = Player(game=game, name='p0')
+        self.assertEqual(router.db_for_write(Game, instance=game),
+                         shard_for_code('abcdef'))
+        self.assertEqual(router.db_for_write(Player, instance=player),
+                         shard_for_code('abcdef'))
+        self.assertIsNone(router.db_for_read(Player))
+
+
+class WarmUpTests(SimpleTestCase):
+    @override_settings(AVALON_WARM_UP=True)
+    def test_warm_up(self):
+        # every template compiles and the URL resolver can be built
+        warm_up()
+        self.assertIn('vote_base.html', template_names())
+
+
+class StaticAssetsTests(SimpleTestCase):
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+
+    def test_hashed_and_precompressed(self):
+        with override_settings(
+                STATIC_ROOT=self.static_root, STATICFILES_STORAGE=
+                'avalon_game.assets.CompressedManifestStorage'):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            url = static('js/avalon.js')
+            self.assertRegex(url, r'^/static/js/avalon\.[0-9a-f]{12}\.js$')
+            path = url[len('/static/'):]
+            with open(os.path.join(self.static_root, path), 'rb') as f:
+                content = f.read()
+
+            response = serve_static(RequestFactory().get(
+                url, HTTP_ACCEPT_ENCODING='gzip, deflate'), path)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            self.assertEqual(
+                gzip.decompress(b''.join(response.streaming_content)),
+                content)
+
+            response = serve_static(RequestFactory().get(url), path)
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+            # the unhashed name may change, so it is revalidated
+            response = serve_static(RequestFactory().get('/static/'
+                                                         'js/avalon.js'),
+                                    'js/avalon.js')
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_not_atomic(self):
+        # serving a file mustn't lock the database with BEGIN IMMEDIATE
+        self.assertIs(BaseHandler().make_view_atomic(serve_static),
+                      serve_static)
+
+
+class ConcurrentGamesTests(TransactionTestCase):
+    # the game databases too, if sharded
+    databases = '__all__'
+    NUM_GAMES = 6
+
+    def play_games(self):
+        games = []
+        errors = []
+
+        def run(num_players):
+            try:
+                games.append(GamePlayer(num_players).play())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(5 + i % 3,))
+                   for i in range(self.NUM_GAMES)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        return games
+
+    def test_parallel_games(self):
+        games = self.play_games()
+        self.assertEqual(len(games), self.NUM_GAMES)
+        self.assertEqual(len(set(g.access_code for g in games)),
+                         self.NUM_GAMES)
+        for game in games:
+            self.assertEqual(game.game_phase, Game.GAME_PHASE_END)
+            players = list(game.player_set.all())
+            num_players = len(players)
+            self.assertEqual(sorted(p.order for p in players),
+                             list(range(num_players)))
+            self.assertEqual(len(set(p.secret_id for p in players)),
+                             num_players)
+            self.assertEqual(len([p for p in players if p.is_spy()]),
+                             int(math.ceil(num_players / 3.0)))
+            roles = Counter(p.role for p in players)
+            for role in (Player.ROLE_MERLIN, Player.ROLE_PERCIVAL,
+                         Player.ROLE_ASSASSIN, Player.ROLE_MORGANA):
+                self.assertEqual(roles[role], 1)
+            state = replay_game(game)
+            self.assertEqual(state.seq, game.event_seq)
+            self.assertEqual(state.game_phase, game.game_phase)
+
+
+class ReplayTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.table = GamePlayer(5)
+        self.table.create()
+        first = self.table.game().player_set.first()
+        self.table.client.post(self.table.game_url('start', first),
+                               {'merlin': 'on', 'assassin': 'on'})
+        for p in self.table.game().player_set.all():
+            self.table.client.post(self.table.game_url('ready', p))
+
+    def assertReplays(self):
+        game = self.table.game()
+        self.assertEqual(replay_game(game).as_dict(), stored_state(game))
+
+    def post(self, name, player, **kwargs):
+        vote_round = VoteRound.objects.get_current_vote_round(
+            self.table.game())
+        if name != 'mission':
+            kwargs['vote_num'] = vote_round.vote_num
+        kwargs['round_num'] = vote_round.game_round.round_num
+        self.table.client.post(self.table.game_url(name, player, **kwargs))
+
+    def propose(self):
+        """Propose and finalize a team of the leader and the players after
+        them; returns the leader and the team."""
+        vote_round = VoteRound.objects.get_current_vote_round(
+            self.table.game())
+        leader = vote_round.leader
+        team = [(leader.order + i) % 5 for i in
+                range(vote_round.game_round.num_players_on_mission())]
+        self.table.client.post(
+            self.table.game_url('propose_team', leader,
+                                round_num=vote_round.game_round.round_num,
+                                vote_num=vote_round.vote_num),
+            {'team': team, 'finalize': 'on'})
+        return leader, team
+
+    def test_retract_and_cancel(self):
+        leader, _ = self.propose()
+        players = list(self.table.game().player_set.order_by('order'))
+        self.post('vote', players[1], vote='approve')
+        self.post('vote', players[1], vote='cancel')
+        self.assertReplays()
+
+        # neither cancelling a vote that wasn't cast nor voting the same
+        #   way again changes anything
+        seq = self.table.game().event_seq
+        self.post('vote', players[2], vote='cancel')
+        self.post('vote', players[3], vote='reject')
+        self.post('vote', players[3], vote='reject')
+        self.assertEqual(self.table.game().event_seq, seq + 1)
+
+        self.post('retract_team', leader)
+        self.assertEqual(self.table.game().game_phase, Game.GAME_PHASE_PICK)
+        self.assertReplays()
+
+    def test_assassinate(self):
+        while self.table.game().game_phase != Game.GAME_PHASE_ASSASSIN:
+            _, team = self.propose()
+            for p in self.table.game().player_set.all():
+                self.post('vote', p, vote='approve')
+            for p in self.table.game().player_set.filter(order__in=team):
+                self.post('mission', p, mission_action='success')
+            self.assertReplays()
+        game = self.table.game()
+        assassin = game.player_set.get(role=Player.ROLE_ASSASSIN)
+        merlin = game.player_set.get(role=Player.ROLE_MERLIN)
+        self.table.client.post(self.table.game_url('assassinate', assassin,
+                                                   target=merlin.order))
+        self.assertEqual(self.table.game().game_phase, Game.GAME_PHASE_END)
+        self.assertReplays()
+
+
+@override_settings(AVALON_ADMIN_TOKEN='admin-token')
+class ExportTests(TransactionTestCase):
+    databases = '__all__'
+
+    def export(self, export_format='ndjson', **params):
+        return Client().get(reverse('export_history', kwargs={
+            'export_format': export_format}), params,
+            HTTP_X_AVALON_ADMIN_TOKEN='admin-token')
+
+    def records(self, **params):
+        response = self.export(**params)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_admin_token(self):
+        url = reverse('export_history', kwargs={'export_format': 'ndjson'})
+        self.assertEqual(Client().get(url).status_code, 403)
+        self.assertEqual(Client().get(url, HTTP_X_AVALON_ADMIN_TOKEN='wrong')
+                                 .status_code, 403)
+        # not from the query string, which ends up in access logs
+        self.assertEqual(Client().get(url, {'token': 'admin-token'})
+                                 .status_code, 403)
+        self.assertEqual(self.export().status_code, 200)
+        with override_settings(AVALON_ADMIN_TOKEN=None):
+            self.assertEqual(self.export().status_code, 404)
+
+    def test_export(self):
+        games = [GamePlayer(5).play(), GamePlayer(6).play(),
+                 GamePlayer(5).play()]
+        GamePlayer(5).create()
+        records = self.records()
+        self.assertEqual(sorted(set(r['game'] for r in records)),
+                         sorted(g.access_code for g in games))
+        num_votes = sum(VoteRound.objects.using(g._state.db)
+                        .filter(game_round__game=g,
+                                vote_status=VoteRound.VOTE_STATUS_VOTED)
+                        .count() for g in games)
+        self.assertEqual(len([r for r in records if r['record'] == 'vote']),
+                         num_votes)
+        # batches are keyed on the primary key, so their size doesn't matter
+        self.assertEqual(list(history_records(exported_games(),
+                                              batch_size=1)), records)
+
+        self.assertEqual(set(r['game'] for r in
+                             self.records(min_players=6)),
+                         {games[1].access_code})
+        self.assertEqual(len(self.records(max_players=5)),
+                         len(records) - len(self.records(min_players=6)))
+        today = timezone.now().date()
+        self.assertEqual(self.records(since=str(today + timedelta(days=1))),
+                         [])
+        self.assertEqual(self.records(until=str(today)), records)
+        self.assertEqual(self.records(until=str(today - timedelta(days=1))),
+                         [])
+        self.assertEqual(self.export(since='yesterday').status_code, 400)
+
+        response = self.export('csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(CSV_COLUMNS))
+        self.assertEqual(len(lines), len(records) + 1)
+
+
+@override_settings(AVALON_ADMIN_TOKEN='admin-token')
+class DecisionLatencyTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_latency(self):
+        start = timezone.now() - timedelta(hours=1)
+        for pick, vote in ((20, 70), (40, 400)):
+            game = GamePlayer(5).play()
+            VoteRound.objects.using(game._state.db)\
+                             .filter(game_round__game=game)\
+                             .update(started=start,
+                                     chose_team=start
+                                                + timedelta(seconds=pick),
+                                     voted=start
+                                           + timedelta(seconds=pick + vote))
+        rows = decision_latency()
+        row = next(r for r in rows if (r['num_players'], r['round_num'],
+                                       r['vote_num']) == (5, 1, 1))
+        # LATENCY_BUCKETS are < 15, 30, 60, 120, 300 and >= 300 seconds
+        self.assertEqual(row['pick'], {'count': 2, 'avg': 30.0, 'min': 20.0,
+                                       'max': 40.0,
+                                       'histogram': [0, 1, 1, 0, 0, 0]})
+        self.assertEqual(row['vote'], {'count': 2, 'avg': 235.0,
+                                       'min': 70.0, 'max': 400.0,
+                                       'histogram': [0, 0, 0, 1, 0, 1]})
+
+        url = reverse('latency_analytics')
+        response = Client().get(url, HTTP_X_AVALON_ADMIN_TOKEN='admin-token')
+        self.assertEqual(response.json(), {'latency': rows})
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        response = Client().get(url, {'since': str(tomorrow)},
+                                HTTP_X_AVALON_ADMIN_TOKEN='admin-token')
+        self.assertEqual(response.json(), {'latency': []})
+
+
+@override_settings(AVALON_METRICS=True, AVALON_ADMIN_TOKEN='admin-token')
+class MetricsTests(TransactionTestCase):
+    databases = '__all__'
+
+    def metrics(self):
+        """The metric types and samples (by name with labels) served."""
+        response = Client().get(reverse('metrics'),
+                                HTTP_X_AVALON_ADMIN_TOKEN='admin-token')
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4')
+        types = {}
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if line.startswith('# TYPE '):
+                name, metric_type = line.split(' ')[2:]
+                types[name] = metric_type
+            elif not line.startswith('# HELP '):
+                match = re.match(r'^([a-z_]+(\{[^}]*\})?) (\S+)$', line)
+                self.assertIsNotNone(match, line)
+                samples[match.group(1)] = float(match.group(3))
+        return types, samples
+
+    def test_metrics(self):
+        _, before = self.metrics()
+        table = GamePlayer(5)
+        table.create()
+        player = table.game().player_set.first()
+        response = table.client.get(table.game_url('status', player))
+        table.client.get(table.game_url('status', player),
+                         HTTP_IF_NONE_MATCH=response['ETag'])
+        types, after = self.metrics()
+
+        def increase(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        self.assertEqual(types['avalon_requests_total'], 'counter')
+        self.assertEqual(types['avalon_request_duration_seconds'],
+                         'histogram')
+        self.assertEqual(types['avalon_active_games'], 'gauge')
+        status = '{view="status"}'
+        self.assertEqual(increase('avalon_requests_total' + status), 2)
+        self.assertEqual(increase('avalon_not_modified_total' + status), 1)
+        self.assertGreater(increase('avalon_db_queries_total' + status), 0)
+        self.assertEqual(increase('avalon_requests_total{view="enter_code"}'),
+                         4)
+        # cumulative buckets, the last of which counts every request
+        buckets = [after['avalon_request_duration_seconds_bucket'
+                         '{view="status",le="%s"}' % bound]
+                   for bound in LATENCY_BUCKETS + ('+Inf',)]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1],
+                         after['avalon_request_duration_seconds_count'
+                               + status])
+        self.assertEqual(after['avalon_active_games{phase="lobby"}'], 1)
+        self.assertEqual(after['avalon_connected_players'], 5)
+        self.assertEqual(after['avalon_requests_in_flight'], 1)
+
+
+class ProfilingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def dumps(self):
+        dumps = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.json'):
+                with open(os.path.join(self.directory, name)) as f:
+                    dumps.append((name, json.load(f)))
+        return dumps
+
+    def play(self, **settings):
+        with override_settings(AVALON_PROFILE_DIR=self.directory,
+                               **settings):
+            table = GamePlayer(5)
+            table.create()
+            player = table.game().player_set.first()
+            table.client.get(table.game_url('game', player))
+
+    def test_slow_requests_are_dumped(self):
+        self.play(AVALON_PROFILE_SAMPLE_RATE=0, AVALON_PROFILE_SLOW_MS=60000)
+        self.assertEqual(self.dumps(), [])
+
+        # every request is slow
+        self.play(AVALON_PROFILE_SAMPLE_RATE=0, AVALON_PROFILE_SLOW_MS=0)
+        dumps = self.dumps()
+        self.assertEqual(len(dumps), 6)
+        name, dump = next((name, dump) for name, dump in dumps
+                          if dump['view'] == 'game')
+        self.assertIn('-game-lobby-5p-', name)
+        self.assertEqual((dump['method'], dump['game_phase'],
+                          dump['num_players'], dump['sampled']),
+                         ('GET', 'lobby', 5, False))
+        self.assertTrue(any('avalon_game_player' in sql
+                            for sql, _ in dump['queries']))
+        self.assertFalse(any(name.endswith('.prof')
+                             for name in os.listdir(self.directory)))
+
+    def test_sampled_requests_are_profiled(self):
+        self.play(AVALON_PROFILE_SAMPLE_RATE=1, AVALON_PROFILE_SLOW_MS=60000,
+                  AVALON_PROFILE_MAX_DUMPS=3)
+        dumps = self.dumps()
+        # only the newest dumps are kept
+        self.assertEqual(len(dumps), 3)
+        self.assertTrue(all(dump['sampled'] for _, dump in dumps))
+        for name, _ in dumps:
+            self.assertTrue(os.path.exists(os.path.join(
+                self.directory, name[:-len('.json')] + '.prof')))
+        out = StringIO()
+        call_command('profile_summary', dir=self.directory, stdout=out)
+        self.assertIn('views.py', out.getvalue())
+
+    def test_stack_sampler(self):
+        sampler = StackSampler(0.001)
+        sampler.start(threading.get_ident())
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+        samples = sampler.stop(threading.get_ident())
+        self.assertGreater(sum(samples.values()), 0)
+        self.assertTrue(all('test_stack_sampler' in stack.split(';')[-1]
+                            for stack in samples))
+
+
+class MigrationTests(TransactionTestCase):
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate(target)
+        return executor.loader.project_state(target).apps
+
+    def migrate_to_initial(self):
+        """Returns the latest migrations and the apps of the first one.
+
+        Migrates forward again at cleanup.
+        """
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes(
+            'avalon_game')
+        self.addCleanup(self.migrate, latest)
+        return latest, self.migrate([('avalon_game', '0001_initial')])
+
+    def create_old_game(self, apps, access_code, finished=True):
+        """Creates a five player game in the first schema.
+
+        p1 (the assassin) fails the second mission and the other missions
+        pass; a finished game ends with p2 assassinated.
+        """
+        OldGame = apps.get_model('avalon_game', 'Game')
+        OldPlayer = apps.get_model('avalon_game', 'Player')
+        now = timezone.now()
+        game = OldGame.objects.create(access_code=access_code, created=now,
+                                      game_phase=6 if finished else 2,
+                                      ended=now if finished else None)
+        # Merlin, Assassin, Loyal servant, Loyal servant, Minion of Mordred
+        players = []
+        for order, role in enumerate((2, -2, 1, 1, -1)):
+            players.append(OldPlayer.objects.create(
+                game=game, name='p%d' % order, role=role, order=order,
+                secret_id=access_code + 'x' + 'abcde'[order], joined=now,
+                last_accessed=now))
+        for round_num, passed in enumerate((True, False, True, True), 1):
+            if not finished and round_num > 2:
+                break
+            game_round = game.gameround_set.create(round_num=round_num,
+                                                   mission_passed=passed)
+            vote_round = game_round.voteround_set.create(
+                vote_num=1, vote_status=2, started=now, leader=players[0])
+            vote_round.chosen.set(players[:2])
+            for player in players:
+                vote_round.playervote_set.create(player=player,
+                                                 accept=player.order < 3)
+            for player in players[:2]:
+                game_round.missionaction_set.create(
+                    player=player,
+                    played_success=passed or player.order == 0)
+        if finished:
+            OldGame.objects.filter(pk=game.pk)\
+                           .update(player_assassinated=players[2])
+        return game
+
+    def test_stats_include_old_games(self):
+        latest, old_apps = self.migrate_to_initial()
+        self.create_old_game(old_apps, 'aaaaaa')
+        self.create_old_game(old_apps, 'bbbbbb', finished=False)
+
+        GameStats = self.migrate(latest).get_model('avalon_game',
+                                                   'GameStats')
+        self.assertEqual(list(GameStats.objects.values(
+                             'num_players', 'role_config', 'games',
+                             'resistance_wins', 'missions', 'vote_rounds',
+                             'assassinations', 'merlin_assassinated')),
+                         [{'num_players': 5, 'role_config': 'Assassin, Merlin',
+                           'games': 1, 'resistance_wins': 1, 'missions': 4,
+                           'vote_rounds': 4, 'assassinations': 1,
+                           'merlin_assassinated': 0}])
+
+    def test_next_game_links_are_kept(self):
+        latest, old_apps = self.migrate_to_initial()
+        OldGame = old_apps.get_model('avalon_game', 'Game')
+        now = timezone.now()
+        first, second, third, other = [
+            OldGame.objects.create(access_code=code, created=now)
+            for code in ('aaaaaa', 'bbbbbb', 'cccccc', 'dddddd')]
+        OldGame.objects.filter(pk=first.pk).update(next_game=second)
+        OldGame.objects.filter(pk=second.pk).update(next_game=third)
+
+        new_apps = self.migrate(latest)
+        Game = new_apps.get_model('avalon_game', 'Game')
+        self.assertEqual(sorted(Game.objects.values_list(
+                             'access_code', 'previous_access_code',
+                             'next_access_code')),
+                         [('aaaaaa', None, 'bbbbbb'),
+                          ('bbbbbb', 'aaaaaa', 'cccccc'),
+                          ('cccccc', 'bbbbbb', None),
+                          ('dddddd', None, None)])
+
+        old_apps = self.migrate([('avalon_game', '0001_initial')])
+        OldGame = old_apps.get_model('avalon_game', 'Game')
+        self.assertEqual(sorted(OldGame.objects.values_list(
+                             'access_code', 'next_game__access_code')),
+                         [('aaaaaa', 'bbbbbb'), ('bbbbbb', 'cccccc'),
+                          ('cccccc', None), ('dddddd', None)])
+
+    def test_masks_of_old_games_are_filled(self):
+        latest, old_apps = self.migrate_to_initial()
+        self.create_old_game(old_apps, 'aaaaaa', finished=False)
+
+        new_apps = self.migrate(latest)
+        GameRound = new_apps.get_model('avalon_game', 'GameRound')
+        VoteRound = new_apps.get_model('avalon_game', 'VoteRound')
+        self.assertEqual(list(GameRound.objects.order_by('round_num')
+                                       .values_list('played_mask',
+                                                    'failed_mask')),
+                         [(0b11, 0), (0b11, 0b10)])
+        self.assertEqual(list(VoteRound.objects.values_list(
+                             'chosen_mask', 'voted_mask', 'accepted_mask')),
+                         [(0b11, 0b11111, 0b111)] * 2)
+
+    def test_old_games_join_their_series(self):
+        latest, old_apps = self.migrate_to_initial()
+        first = self.create_old_game(old_apps, 'aaaaaa')
+        second = self.create_old_game(old_apps, 'bbbbbb')
+        self.create_old_game(old_apps, 'cccccc', finished=False)
+        type(first).objects.filter(pk=first.pk).update(next_game=second)
+
+        new_apps = self.migrate(latest)
+        Game = new_apps.get_model('avalon_game', 'Game')
+        Series = new_apps.get_model('avalon_game', 'Series')
+        self.assertEqual(sorted(Game.objects.values_list('access_code',
+                                                         'series_code')),
+                         [('aaaaaa', 'aaaaaa'), ('bbbbbb', 'aaaaaa'),
+                          ('cccccc', 'cccccc')])
+        series = Series.objects.get()
+        self.assertEqual((series.code, series.games, series.resistance_wins,
+                          series.merlin_assassinated),
+                         ('aaaaaa', 2, 2, 0))
+        self.assertEqual(json.loads(series.players),
+                         {'p0': [2, 2], 'p1': [2, 0], 'p2': [2, 2],
+                          'p3': [2, 2], 'p4': [2, 0]})
+
+
+class RematchTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_concurrent_next_game(self):
+        table = GamePlayer(10)
+        game = table.play()
+        players = list(game.player_set.order_by('order'))
+        responses = {}
+        errors = []
+
+        def run(player):
+            try:
+                responses[player.name] = Client().get(
+                    table.game_url('next_game', player))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(p,)) for p in players]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(errors, [])
+
+        game = table.game()
+        # exactly one next game, holding the whole table
+        self.assertEqual(sum(Game.objects.using(db)
+                             .filter(previous_access_code=game.access_code)
+                             .count() for db in game_databases()), 1)
+        next_game = game.next_game
+        self.assertEqual(next_game.game_phase, Game.GAME_PHASE_LOBBY)
+        next_players = {p.name: p for p in next_game.player_set.all()}
+        self.assertEqual(sorted(next_players), sorted(p.name for p in players))
+        for name, response in responses.items():
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.url, reverse('game', kwargs={
+                'access_code': next_game.access_code,
+                'player_secret': next_players[name].secret_id}))
+        self.assertEqual(replay_game(next_game).seq, next_game.event_seq)
+        # nobody waited on the database lock for long
+        self.assertLess(elapsed, 10)
+
+
+class SeriesTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_scoreboard(self):
+        table = GamePlayer(5)
+        first = table.play()
+        for p in first.player_set.all():
+            table.client.get(table.game_url('next_game', p))
+        table.access_code = table.game().next_access_code
+        second = table.play(create=False)
+        self.assertEqual(second.series_code, first.access_code)
+
+        series = Series.objects.get(code=first.access_code)
+        self.assertEqual(series.games, 2)
+        expected = {}
+        resistance_wins = 0
+        for game in (first, second):
+            resistance_won, _, results = Series.game_results(game)
+            resistance_wins += 1 if resistance_won else 0
+            Series.add_results(expected, results)
+        self.assertEqual(series.resistance_wins, resistance_wins)
+        self.assertEqual(series.players_dict(), expected)
+
+        player = second.player_set.first()
+        response = table.client.get(table.game_url('game', player))
+        self.assertContains(response, 'series-scoreboard')
+
+        call_command('rebuild_stats', stdout=StringIO())
+        rebuilt = Series.objects.get(code=first.access_code)
+        self.assertEqual((rebuilt.games, rebuilt.resistance_wins,
+                          rebuilt.merlin_assassinated, rebuilt.players_dict()),
+                         (series.games, series.resistance_wins,
+                          series.merlin_assassinated, expected))
+
+
+class GameStatsTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_rejected_teams_are_not_missions(self):
+        table = GamePlayer(5)
+        table.create()
+        first = table.game().player_set.first()
+        table.client.post(table.game_url('start', first), {'merlin': 'on'})
+        for p in table.game().player_set.all():
+            table.client.post(table.game_url('ready', p))
+        # the spies win by rejecting five teams in a row
+        for vote_num in range(1, 6):
+            vote_round = VoteRound.objects.get_current_vote_round(
+                table.game())
+            leader = vote_round.leader
+            nums = {'round_num': 1, 'vote_num': vote_num}
+            table.client.post(table.game_url('propose_team', leader, **nums),
+                              {'team': [leader.order,
+                                        (leader.order + 1) % 5],
+                               'finalize': 'on'})
+            for p in table.game().player_set.all():
+                table.client.post(table.game_url('vote', p, vote='reject',
+                                                 **nums))
+        self.assertEqual(table.game().game_phase, Game.GAME_PHASE_END)
+        stats = GameStats.objects.get()
+        self.assertEqual((stats.games, stats.resistance_wins,
+                          stats.missions, stats.vote_rounds), (1, 0, 0, 5))
+        self.assertIsNone(stats.votes_per_mission())
+
+
+class GenerateGamesTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_generated_games_are_consistent(self):
+        generator = GameGenerator(random.Random(1),
+                                  timezone.now() - timedelta(days=1),
+                                  timedelta(minutes=10))
+        generate_games(60, generator, batch_size=25)
+        games = [game for db in game_databases()
+                 for game in Game.objects.using(db).order_by('pk')]
+        self.assertEqual(len(games), 60)
+        for db in game_databases():
+            self.assertEqual(rebuild_masks(db), 0)
+
+        # the aggregates kept up to date match the ones recomputed from
+        #   the rows
+        def aggregates():
+            return (sorted(GameStats.objects.values_list(
+                        'num_players', 'role_config', *GameStats.COUNTERS)),
+                    sorted(Series.objects.values_list(
+                        'code', 'games', 'resistance_wins',
+                        'merlin_assassinated', 'players')))
+        generated = aggregates()
+        self.assertEqual(sum(row[2] for row in generated[0]),
+                         len([g for g in games
+                              if g.game_phase == Game.GAME_PHASE_END]))
+        call_command('rebuild_stats', stdout=StringIO())
+        self.assertEqual(aggregates(), generated)
+
+        ended = next(g for g in games if g.game_phase == Game.GAME_PHASE_END)
+        response = Client().get(reverse('game_results', kwargs={
+            'access_code': ended.access_code}))
+        self.assertEqual(response.status_code, 200)
+        # new games get rows after the generated ones
+        table = GamePlayer(5)
+        self.assertEqual(table.play().game_phase, Game.GAME_PHASE_END)
+
+
+class LiveStateTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        # a new store for each test, as access codes are reused after the
+        #   database is flushed
+        live_state = override_settings(
+            AVALON_LIVE_STATE='avalon_game.livestate.LocalStore')
+        live_state.enable()
+        self.addCleanup(live_state.disable)
+
+    def assert_served_from_store(self, table):
+        game = table.game()
+        for player in game.player_set.all():
+            table.client.get(table.game_url('status', player))
+            with self.assertNumQueries(0):
+                status = table.client.get(table.game_url('status', player))
+                page = table.client.get(table.game_url('game', player))
+                table.client.get(reverse('observe', kwargs={
+                    'access_code': game.access_code}))
+            self.assertEqual(status.content.decode(),
+                             game_status_string(game, player))
+            self.assertEqual(page.status_code, 200)
+
+    def test_reads_without_queries(self):
+        table = GamePlayer(5)
+        table.create()
+        self.assert_served_from_store(table)
+        first = table.game().player_set.first()
+        table.client.post(table.game_url('start', first),
+                          {'merlin': 'on', 'assassin': 'on'})
+        for p in table.game().player_set.all():
+            table.client.post(table.game_url('ready', p))
+        self.assert_served_from_store(table)
+
+    def test_played_game_matches_database(self):
+        table = GamePlayer(6)
+        game = table.play()
+        self.assertEqual(livestate.store().get(game.access_code).event_seq,
+                         game.event_seq)
+        self.assert_served_from_store(table)
+
+    def test_touch_is_written_back(self):
+        table = GamePlayer(5)
+        table.create()
+        player = table.game().player_set.first()
+        before = player.last_accessed
+        table.client.get(table.game_url('status', player))
+        livestate.TOUCHES.flush()
+        player.refresh_from_db()
+        self.assertGreater(player.last_accessed, before)
+
+
+def reload_urls():
+    """Rebuild the URLconf for the current AVALON_ASYNC_POLLING."""
+    import avalon.urls
+    importlib.reload(game_urls)
+    importlib.reload(avalon.urls)
+    clear_url_caches()
+
+
+class AsyncPollingTestCase(TransactionTestCase):
+    """Serves the URLs of avalon/asgi.py, which include the long polls."""
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls._async_polling = override_settings(AVALON_ASYNC_POLLING=True)
+        cls._async_polling.enable()
+        reload_urls()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._async_polling.disable()
+        reload_urls()
+
+
+@override_settings(AVALON_LONG_POLL_TIMEOUT=0.2,
+                   AVALON_LONG_POLL_INTERVAL=0.05)
+class LongPollTests(AsyncPollingTestCase):
+    def setUp(self):
+        self.table = GamePlayer(5)
+        self.table.create()
+        self.player = self.table.game().player_set.first()
+        status = self.table.client.get(self.table.game_url('status',
+                                                           self.player))
+        self.etag = status['ETag']
+
+    def wait(self):
+        return self.table.client.get(
+            self.table.game_url('status_wait', self.player),
+            HTTP_IF_NONE_MATCH=self.etag)
+
+    def test_game_page_long_polls(self):
+        response = self.table.client.get(self.table.game_url('game',
+                                                             self.player))
+        self.assertContains(response,
+                            self.table.game_url('status_wait', self.player))
+
+    def test_not_served_without_async_polling(self):
+        wait_path = self.table.game_url('status_wait', self.player)
+        try:
+            with override_settings(AVALON_ASYNC_POLLING=False):
+                reload_urls()
+                self.assertEqual(self.table.client.get(wait_path).status_code,
+                                 404)
+                response = self.table.client.get(
+                    self.table.game_url('game', self.player))
+                self.assertNotContains(response, wait_path)
+        finally:
+            reload_urls()
+
+    def test_out_of_date_client_is_answered_at_once(self):
+        self.etag = '"0-%d"' % self.player.pk
+        response = self.wait()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode(),
+                         game_status_string(self.table.game(), self.player))
+
+    def test_unchanged_game_times_out(self):
+        self.assertEqual(self.wait().status_code, 304)
+
+    @override_settings(AVALON_LONG_POLL_TIMEOUT=10)
+    def test_change_wakes_up_client(self):
+        def change():
+            try:
+                self.table.game().log_event(GameEvent.EVENT_READY,
+                                            self.player)
+            finally:
+                connections.close_all()
+
+        timer = threading.Timer(0.2, change)
+        timer.start()
+        response = self.wait()
+        timer.join()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], self.etag)
+
+
+class PollIntervalTests(TransactionTestCase):
+    databases = '__all__'
+
+    def poll_interval(self, table, player):
+        response = table.client.get(table.game_url('status', player))
+        return int(response['X-Poll-Interval'])
+
+    def test_not_awaited_polls_less(self):
+        table = GamePlayer(5)
+        table.create()
+        first = table.game().player_set.first()
+        table.client.post(table.game_url('start', first),
+                          {'merlin': 'on', 'assassin': 'on'})
+        for p in table.game().player_set.all():
+            table.client.post(table.game_url('ready', p))
+        game = table.game()
+        self.assertEqual(game.game_phase, Game.GAME_PHASE_PICK)
+        leader = VoteRound.objects.get_current_vote_round(game).leader
+        other = game.player_set.exclude(pk=leader.pk).first()
+        self.assertLess(self.poll_interval(table, leader),
+                        self.poll_interval(table, other))
+
+    @override_settings(AVALON_POLL_MAX_INTERVAL=2)
+    def test_capped(self):
+        table = GamePlayer(5)
+        table.create()
+        player = table.game().player_set.first()
+        self.assertLessEqual(self.poll_interval(table, player), 2000)
+
+
+class JSONActionTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_action_returns_status(self):
+        table = GamePlayer(5)
+        table.create()
+        first = table.game().player_set.first()
+        table.client.post(table.game_url('start', first),
+                          {'merlin': 'on', 'assassin': 'on'})
+        response = table.client.post(table.game_url('ready', first),
+                                     HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode(),
+                         game_status_string(table.game(), first))
+        self.assertIn('X-Poll-Interval', response)
+
+        for p in table.game().player_set.all():
+            table.client.post(table.game_url('ready', p))
+        game = table.game()
+        leader = VoteRound.objects.get_current_vote_round(game).leader
+        nums = {'round_num': 1, 'vote_num': 1}
+        response = table.client.post(
+            table.game_url('choose', leader, who=leader.order, **nums),
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['chosen'], [leader.name])
+        # the form fallback still redirects
+        response = table.client.post(
+            table.game_url('unchoose', leader, who=leader.order, **nums))
+        self.assertEqual(response.status_code, 302)
+
+
+class ProposeTeamTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.table = GamePlayer(5)
+        self.table.create()
+        first = self.table.game().player_set.first()
+        self.table.client.post(self.table.game_url('start', first),
+                               {'merlin': 'on', 'assassin': 'on'})
+        for p in self.table.game().player_set.all():
+            self.table.client.post(self.table.game_url('ready', p))
+        self.leader = VoteRound.objects.get_current_vote_round(
+            self.table.game()).leader
+
+    def propose(self, team, **data):
+        data['team'] = team
+        return self.table.client.post(
+            self.table.game_url('propose_team', self.leader, round_num=1,
+                                vote_num=1), data)
+
+    def test_propose_and_finalize(self):
+        # mission 1 of a 5 player game is 2 players
+        team = [self.leader.order, (self.leader.order + 2) % 5]
+        response = self.propose(team, finalize='on')
+        self.assertEqual(response.status_code, 302)
+        game = self.table.game()
+        self.assertEqual(game.game_phase, Game.GAME_PHASE_VOTE)
+        vote_round = VoteRound.objects.get_current_vote_round(game)
+        self.assertEqual([p.order for p in vote_round.chosen_players()],
+                         sorted(team))
+        self.assertEqual(sorted(p.order for p in vote_round.chosen.all()),
+                         sorted(team))
+        state = replay_game(game)
+        self.assertEqual(state.game_phase, Game.GAME_PHASE_VOTE)
+        self.assertEqual(state.current_game_round().current_vote_round()
+                              .chosen, set(team))
+
+    def test_wrong_size_is_rejected(self):
+        self.assertEqual(self.propose([self.leader.order],
+                                      finalize='on').status_code, 400)
+        self.assertEqual(self.propose([0, 1, 2]).status_code, 400)
+        self.assertEqual(self.propose([7]).status_code, 400)
+        # a draft may be short of a full team if it isn't finalized
+        self.assertEqual(self.propose([self.leader.order]).status_code, 302)
+        game = self.table.game()
+        self.assertEqual(game.game_phase, Game.GAME_PHASE_PICK)
+        self.assertEqual(VoteRound.objects.get_current_vote_round(game)
+                         .chosen_players(), [self.leader])
+
+
+class RoleKnowledgeTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_matches_roles(self):
+        table = GamePlayer(8)
+        table.create()
+        first = table.game().player_set.first()
+        table.client.post(table.game_url('start', first),
+                          {'merlin': 'on', 'percival': 'on', 'assassin': 'on',
+                           'morgana': 'on', 'mordred': 'on'})
+        game = table.game()
+        players = list(game.player_set.order_by('order'))
+        for player in players:
+            self.assertEqual(
+                players_in_mask(players, player.visible_spies),
+                [p for p in players if player.sees_as_spy(p)])
+            if player.is_percival():
+                self.assertEqual(
+                    players_in_mask(players, player.possible_merlins),
+                    [p for p in players if p.appears_as_merlin()])
+        summary = game.role_summary_dict()
+        self.assertEqual(summary['num_spies'], 3)
+        self.assertEqual(summary['num_resistance'], 5)
+        self.assertEqual(summary['spy_roles'],
+                         ['Assassin', 'Mordred', 'Morgana'])
+        self.assertEqual(summary['resistance_roles'], ['Merlin', 'Percival'])
+        self.assertTrue(summary['has_mordred'])
+
+
+@override_settings(AVALON_ADMISSION=True)
+class AdmissionTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        state = admission.STATE
+        admission.STATE = admission.AdmissionState()
+        self.addCleanup(setattr, admission, 'STATE', state)
+        self.table = GamePlayer(5)
+        self.table.create()
+        self.game = self.table.game()
+        self.player, self.other = self.game.player_set.all()[:2]
+
+    def shed_count(self, response):
+        return REGISTRY._counters[('avalon_shed_requests_total',
+                                   (('response', response),
+                                    ('view', 'status')))]
+
+    def test_polls_shed_and_actions_admitted(self):
+        status = self.table.client.get(self.table.game_url('status',
+                                                           self.player))
+        stale = self.shed_count('stale')
+        # every request is one too many
+        with override_settings(AVALON_ADMISSION_MAX_IN_FLIGHT=0):
+            with self.assertNumQueries(0, using=self.game._state.db):
+                shed = self.table.client.get(
+                    self.table.game_url('status', self.player))
+                unchanged = self.table.client.get(
+                    self.table.game_url('status', self.player),
+                    HTTP_IF_NONE_MATCH=status['ETag'])
+                unknown = self.table.client.get(
+                    self.table.game_url('status', self.other))
+            self.table.client.post(self.table.game_url('start', self.player),
+                                   {'merlin': 'on', 'assassin': 'on'})
+        self.assertEqual(shed.status_code, 200)
+        self.assertEqual(shed.content, status.content)
+        self.assertEqual(shed['Retry-After'], '5')
+        self.assertGreaterEqual(int(shed['X-Poll-Interval']), 5000)
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unknown.status_code, 503)
+        self.assertEqual(self.shed_count('stale'), stale + 2)
+        self.assertEqual(self.table.game().game_phase, Game.GAME_PHASE_ROLE)
+
+        # admitted again once the load is gone
+        status = self.table.client.get(self.table.game_url('status',
+                                                           self.player))
+        self.assertNotEqual(status.content, shed.content)
+
+    def test_slow_queries_shed_polls(self):
+        with override_settings(AVALON_ADMISSION_MAX_DB_WAIT_MS=-1):
+            self.table.client.get(self.table.game_url('game', self.player))
+        self.assertEqual(admission.STATE.overloaded(), 'db_wait')
+        response = self.table.client.get(self.table.game_url('status',
+                                                             self.player))
+        self.assertEqual(response.status_code, 503)
+        with override_settings(AVALON_ADMISSION_WINDOW=0):
+            self.assertIsNone(admission.STATE.overloaded())
+
+
+@override_settings(AVALON_ADMISSION=True, AVALON_LONG_POLL_TIMEOUT=10,
+                   AVALON_LONG_POLL_INTERVAL=0.05)
+class AsyncAdmissionTests(AsyncPollingTestCase):
+    def setUp(self):
+        state = admission.STATE
+        admission.STATE = admission.AdmissionState()
+        self.addCleanup(setattr, admission, 'STATE', state)
+
+    def test_async_capable(self):
+        async def get_response(request):
+            pass
+        self.assertTrue(asyncio.iscoroutinefunction(
+            admission.AdmissionMiddleware(get_response)))
+        self.assertFalse(asyncio.iscoroutinefunction(
+            admission.AdmissionMiddleware(lambda request: None)))
+
+    def test_long_poll_does_not_hold_up_other_requests(self):
+        table = GamePlayer(5)
+        table.create()
+        player = table.game().player_set.first()
+        etag = table.client.get(table.game_url('status', player))['ETag']
+        client = AsyncClient()
+
+        async def requests():
+            wait = asyncio.ensure_future(client.get(
+                table.game_url('status_wait', player),
+                **{'If-None-Match': etag}))
+            while not longpoll.waiting() and not wait.done():
+                await asyncio.sleep(0.05)
+            start = time.perf_counter()
+            status = await client.get(table.game_url('status', player))
+            elapsed = time.perf_counter() - start
+            await sync_to_async(lambda: table.game().log_event(
+                GameEvent.EVENT_READY, player))()
+            return status, elapsed, await wait
+
+        status, elapsed, waited = asyncio.run(requests())
+        self.assertEqual(status.status_code, 200)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(waited.status_code, 200)
+        self.assertNotEqual(waited['ETag'], etag)
+
+
+class TraceTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        fd, self.trace_file = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        self.addCleanup(os.remove, self.trace_file)
+
+    def test_record_and_replay(self):
+        with override_settings(AVALON_TRACE_FILE=self.trace_file):
+            table = GamePlayer(5)
+            table.create()
+            game = table.game()
+            for player in game.player_set.all():
+                table.client.get(table.game_url('status', player))
+        with open(self.trace_file) as f:
+            trace = f.read()
+        records = [json.loads(line) for line in trace.splitlines()]
+        self.assertEqual(len(records), 10)
+        self.assertNotIn(game.access_code, trace)
+        for player in game.player_set.all():
+            self.assertNotIn(player.secret_id, trace)
+            self.assertNotIn('"%s"' % player.name, trace)
+
+        replayer = Replayer(records, speed=100, workers=4, wait=10)
+        replayer.run()
+        self.assertEqual(replayer.skipped, 0)
+        self.assertEqual(replayer.errors, {})
+        self.assertEqual(len(replayer.latencies['status']), 5)
+        replayed = replayer.games[records[0]['new_game']][1]
+        self.assertNotEqual(replayed, game.access_code)
+        self.assertEqual(Game.objects.for_access_code(replayed).get()
+                             .player_set.count(), 5)
+
+
+class MaskTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_masks_match_rows(self):
+        game = GamePlayer(7).play()
+        db = game._state.db
+        # the masks kept up to date by the views match the rows
+        self.assertEqual(rebuild_masks(db), 0)
+        vote_rounds = VoteRound.objects.using(db)\
+                               .filter(game_round__game=game)
+        self.assertTrue(any(v.voted_mask for v in vote_rounds))
+        for vote_round in vote_rounds:
+            self.assertEqual(vote_round.chosen_players(),
+                             sorted(vote_round.chosen.all(),
+                                    key=lambda p: p.order))
+            votes = vote_round.playervote_set.all()
+            self.assertEqual(vote_round.num_votes(), len(votes))
+            for vote in votes:
+                self.assertEqual(vote_round.vote_of(vote.player), vote.accept)
+
+        vote_rounds.update(chosen_mask=0, voted_mask=0, accepted_mask=0)
+        GameRound.objects.using(db).filter(game=game)\
+                 .update(played_mask=0, failed_mask=0)
+        self.assertGreater(rebuild_masks(db), 0)
+        self.assertEqual(rebuild_masks(db), 0)
+
+
+@override_settings(AVALON_VERIFY_STATUS=True)
+class MaterializedStatusTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_played_game_matches_fresh_status(self):
+        # every status served while playing is checked against the status
+        #   computed from the game
+        game = GamePlayer(7).play()
+        self.assertEqual(game.status_seq, game.event_seq)
+
+    def test_poll_only_reads_game_row(self):
+        table = GamePlayer(5)
+        table.create()
+        game = table.game()
+        player = game.player_set.first()
+        with override_settings(AVALON_VERIFY_STATUS=False):
+            # the game and updating last_accessed
+            with self.assertNumQueries(2, using=game._state.db):
+                response = table.client.get(table.game_url('status', player))
+        self.assertEqual(response.content.decode(),
+                         game_status_string(game, player))
+
+    def test_stale_status_is_recomputed(self):
+        table = GamePlayer(5)
+        table.create()
+        game = table.game()
+        player = game.player_set.first()
+        Game.objects.using(game._state.db).filter(pk=game.pk)\
+                    .update(status_seq=None)
+        response = table.client.get(table.game_url('status', player))
+        self.assertEqual(response.content.decode(),
+                         game_status_string(game, player))
@@ -0,0 +1,109 @@
+"""Opt-in recording of anonymized request traces for capacity planning.
+
+TraceMiddleware is only installed if settings.AVALON_TRACE_FILE is set. It
+appends one JSON line per request to that file:
+
+    {"t": 1476371230.12, "view": "choose", "method": "POST",
+     "game": "3f1c0a9b2e4d", "player": "a0b1c2d3e4f5", "phase": "pick",
+     "kwargs": {"round_num": "1", "vote_num": "1", "who": "3"},
+     "status": 302, "ms": 4.2}
+
+Access codes, player secrets and player names are replaced by keyed hashes
+(stable across processes, as they're keyed with SECRET_KEY), so a trace
+tells games and players apart without identifying them. "phase" is the phase
+of the game after the request. Requests creating a game or a player also
+record the hashes of the game and player they redirected to
+("new_game"/"new_player"), which is how the replay_traffic management
+command links the following requests to the games and players it creates.
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+from django.utils.crypto import salted_hmac
+
+# form fields holding personal data, and how to anonymize them
+_NAME_FIELDS = ('name', 'player')
+_GAME_FIELDS = ('game',)
+_SKIP_FIELDS = ('csrfmiddlewaretoken',)
+
+
+def anonymize(kind, value):
+    if kind == 'game':
+        # access codes are case-insensitive
+        value = value.lower()
+    return salted_hmac('avalon-trace-' + kind, value).hexdigest()[:12]
+
+
+def _ids(kwargs):
+    game = kwargs.get('access_code')
+    player = kwargs.get('player_secret')
+    return (anonymize('game', game) if game else None,
+            anonymize('player', player) if player else None)
+
+
+def _anonymized_post(post):
+    data = {}
+    for key, value in post.items():
+        if key in _SKIP_FIELDS:
+            continue
+        elif key in _NAME_FIELDS:
+            value = anonymize('name', value) if value else value
+        elif key in _GAME_FIELDS:
+            value = anonymize('game', value) if value else value
+        data[key] = value
+    return data
+
+
+class TraceMiddleware(object):
+    def __init__(self, get_response):
+        if not settings.AVALON_TRACE_FILE:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.path = settings.AVALON_TRACE_FILE
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        start_time = time.time()
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None or match.url_name is None:
+            return response
+        kwargs = dict(match.kwargs)
+        game, player = _ids(kwargs)
+        kwargs.pop('access_code', None)
+        kwargs.pop('player_secret', None)
+        avalon_game = getattr(request, 'avalon_game', None)
+        record = {
+            't': round(start_time, 3),
+            'view': match.url_name,
+            'method': request.method,
+            'game': game,
+            'player': player,
+            'phase': avalon_game.game_phase_string()
+                     if avalon_game is not None else None,
+            'kwargs': kwargs,
+            'status': response.status_code,
+            'ms': round(duration * 1000, 1),
+        }
+        if request.method == 'POST':
+            record['post'] = _anonymized_post(request.POST)
+        if response.status_code == 302 and match.url_name in ('new_game',
+                                                              'enter_code'):
+            try:
+                target = resolve(response.url)
+            except Resolver404:
+                pass
+            else:
+                record['new_game'], record['new_player'] = _ids(target.kwargs)
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+        return response
@@ -1,25 +1,50 @@
+from django.conf import settings
 from django.conf.urls import include, url
 
 from . import views
 
+# the async versions and the long polls only pay off when served by
+#   avalon/asgi.py; under WSGI a long poll would hold a worker the whole time
+if settings.AVALON_ASYNC_POLLING:
+    status_view, observe_status_view = views.async_status,\
+                                       views.async_observe_status
+    observe_wait_urls = [
+        url(r'^status/wait/$', views.observe_status_wait,
+            name='observe_status_wait'),
+    ]
+    wait_urls = [
+        url(r'^status/wait/$', views.status_wait, name='status_wait'),
+    ]
+else:
+    status_view, observe_status_view = views.status, views.observe_status
+    observe_wait_urls = wait_urls = []
+
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^join/$', views.enter_code, name='enter_code'),
     url(r'^new/$', views.new_game, name='new_game'),
+    url(r'^stats/$', views.stats, name='stats'),
+    url(r'^export/(?P<export_format>(ndjson|csv))/$', views.export_history,
+        name='export_history'),
+    url(r'^analytics/latency/$', views.latency_analytics,
+        name='latency_analytics'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
     url(r'^(?P<access_code>[a-zA-Z]{6})/', include([
         url(r'^$', views.join_game, name='join_game'),
         url(r'^qr/$', views.qr_code, name='qr_code'),
         url(r'^results/$', views.game_results, name='game_results'),
         url(r'^observe/', include([
             url(r'^$', views.observe, name='observe'),
-            url(r'^status/$', views.observe_status, name='observe_status'),
+            url(r'^status/$', observe_status_view, name='observe_status'),
+        ] + observe_wait_urls + [
             url(r'^start/$', views.observe_start, name='observe_start'),
             url(r'^cancel_game/$', views.observe_cancel_game, name='observe_cancel_game'),
             url(r'^next_game/$', views.observe_next_game, name='observe_next_game'),
         ])),
         url(r'(?P<player_secret>[a-z]{8})/', include([
             url(r'^$', views.game, name='game'),
-            url(r'^status/$', views.status, name='status'),
+            url(r'^status/$', status_view, name='status'),
+        ] + wait_urls + [
             url(r'^start/$', views.start, name='start'),
             url(r'^leave/$', views.leave, name='leave'),
             url(r'^ready/$', views.ready, name='ready'),
@@ -30,6 +55,7 @@ urlpatterns = [
                 url(r'^choose/(?P<who>[0-9])/$', views.choose, name='choose'),
                 url(r'^unchoose/(?P<who>[0-9])/$', views.unchoose, name='unchoose'),
                 url(r'^finalize_team/$', views.finalize_team, name='finalize_team'),
+                url(r'^propose_team/$', views.propose_team, name='propose_team'),
                 url(r'^retract_team/$', views.retract_team, name='retract_team'),
             ])),
             url(r'^mission/(?P<round_num>[1-5])/(?P<mission_action>(success|fail))/$', views.mission, name='mission'),
@@ -1,44 +1,123 @@
+from functools import wraps
 from io import BytesIO
+from itertools import chain
 import json
 import math
-import random
-import qrcode
+import os
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.db import transaction
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest,\
+                        HttpResponseForbidden, HttpResponseNotAllowed,\
+                        Http404, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_etags
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.http import require_safe,\
                                          require_POST,\
                                          require_http_methods
 from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 
+from . import admission, livestate, longpoll
+from .analytics import decision_latency
+from .export import export_lines, exported_games, history_records,\
+                    parse_day
 from .forms import NewGameForm, JoinGameForm, StartGameForm
-from .helpers import mission_size, mission_size_string
-from .models import Game, GameRound, MissionAction,\
-                    Player, PlayerVote, VoteRound
+from .helpers import deterministic_random_boolean, mission_size,\
+                     mission_size_string, system_random
+from .metrics import REGISTRY, game_gauges
+from .models import Game, GameEvent, GameRound, GameStats, Player,\
+                    VoteRound, players_in_mask, popcount
+from .sharding import game_atomic, shard_for_code
 
 # helpers to interpret arguments
-def lookup_access_code(func):
+def lookup_access_code(func, load_game=get_object_or_404):
+    @wraps(func)
     def with_game(request, access_code, *args, **kwargs):
-        game = get_object_or_404(Game, access_code=access_code.lower())
-        return func(request, game, *args, **kwargs)
+        games = Game.objects.for_access_code(access_code)
+        # The request is only atomic on the game's database (see
+        #   sharding.py), so look up the game inside the transaction.
+        with game_atomic(games.db, func):
+            try:
+                game = load_game(games)
+            except Game.DoesNotExist:
+                raise Http404()
+            # for the metrics/profiling middleware
+            request.avalon_game = game
+            response = func(request, game, *args, **kwargs)
+            # still in the transaction of the change
+            materialize_status(game)
+            return response
 
     return with_game
 
+def lookup_live_game(func):
+    """lookup_access_code() for views which only display the game: they get
+    the game from the live-state store if it has it (see livestate.py)."""
+    from_database = lookup_access_code(func, livestate.fetch_game)
+
+    @wraps(func)
+    def with_live_game(request, access_code, *args, **kwargs):
+        game = livestate.cached_game(access_code)
+        if game is None:
+            return from_database(request, access_code, *args, **kwargs)
+        request.avalon_game = game
+        return func(request, game, *args, **kwargs)
+
+    return with_live_game
+
 def lookup_player_secret(func):
+    @wraps(func)
     def with_player(request, game, player_secret, *args, **kwargs):
-        player = get_object_or_404(Player, game=game, secret_id=player_secret)
-        return func(request, game, player, *args, **kwargs)
+        # .all() so it's free for games from the live-state store
+        for player in game.player_set.all():
+            if player.secret_id == player_secret:
+                return func(request, game, player, *args, **kwargs)
+        raise Http404()
 
     return with_player
 
 def nums_to_int(func):
+    @wraps(func)
     def with_int(request, game, player, round_num, vote_num, *args, **kwargs):
         return func(request, game, player, int(round_num), int(vote_num),
                     *args, **kwargs)
 
     return with_int
 
+def wants_json(request):
+    return 'application/json' in request.META.get('HTTP_ACCEPT', '')
+
+def json_action(func):
+    """For AJAX requests (see game.html), answer the action with the new
+    status of the game for the player instead of redirecting to the game
+    page, which saves a round-trip and rendering the whole page."""
+    @wraps(func)
+    def with_json(request, game, player, *args, **kwargs):
+        response = func(request, game, player, *args, **kwargs)
+        if response.status_code == 302 and wants_json(request):
+            materialize_status(game)
+            return game_status_response(request, game, player)
+        return response
+
+    return with_json
+
+def require_admin_token(func):
+    @wraps(func)
+    def with_admin_token(request, *args, **kwargs):
+        token = settings.AVALON_ADMIN_TOKEN
+        if not token:
+            raise Http404()
+        # only from the header: a query string would end up in access logs
+        given = request.META.get('HTTP_X_AVALON_ADMIN_TOKEN', '')
+        if not constant_time_compare(given, token):
+            return HttpResponseForbidden()
+        return func(request, *args, **kwargs)
+
+    return with_admin_token
+
 # views
 
 @require_safe
@@ -49,7 +128,11 @@ def index(request):
 def enter_code(request):
     if request.method == 'POST':
         form = JoinGameForm(request.POST)
-        if form.is_valid():
+        with game_atomic(shard_for_code(form.data.get('game', ''))):
+            valid = form.is_valid()
+            if valid:
+                materialize_status(form.cleaned_data.get('game'))
+        if valid:
             game = form.cleaned_data.get('game')
             player = form.cleaned_data.get('player')
             if player is None:
@@ -75,7 +158,10 @@ def new_game(request):
             name = form.cleaned_data.get('name')
             if name is None:
                 return redirect('observe', access_code=game.access_code)
-            player = Player.objects.create(game=game, name=name)
+            with game_atomic(game._state.db):
+                player = game.player_set.create(name=name)
+                game.log_event(GameEvent.EVENT_JOIN, player, name=name)
+                materialize_status(game)
             return redirect('game',
                             access_code=game.access_code,
                             player_secret=player.secret_id)
@@ -84,6 +170,11 @@ def new_game(request):
 
     return render(request, 'new_game.html', {'form': form})
 
+@require_safe
+def stats(request):
+    return render(request, 'stats.html',
+                  {'game_stats': GameStats.objects.all()})
+
 @lookup_access_code
 @require_safe
 def join_game(request, game):
@@ -97,6 +188,10 @@ def join_game(request, game):
 @lookup_access_code
 @require_safe
 def qr_code(request, game):
+    # only imported here (it imports PIL), so no other request and no worker
+    #   start has to pay for it
+    import qrcode
+
     join_url = reverse('join_game', kwargs={'access_code': game.access_code})
     join_url = request.build_absolute_uri(join_url)
     img = qrcode.make(join_url)
@@ -104,8 +199,9 @@ def qr_code(request, game):
     img.save(output, "PNG")
     return HttpResponse(output.getvalue(), content_type='image/png')
 
-@lookup_access_code
+@lookup_live_game
 @require_safe
+@transaction.non_atomic_requests
 def observe(request, game):
     if game.game_phase == game.GAME_PHASE_END and game.next_game is not None:
         return redirect('observe', access_code=game.next_game.access_code)
@@ -118,13 +214,41 @@ def game_results(request, game):
         raise Http404()
     return _game(request, game, None, {'results_only': True})
 
-def game_status_string(game, player):
+# The views which only display a game use .all() on related objects (and
+#   sort and filter in Python) so they don't need any queries for a game loaded
+#   by livestate.load_game().
+
+def _player_sort_key(player):
+    # same as order_by('order', 'joined', 'name') with NULLs first
+    return (player.order is not None, player.order, player.joined,
+            player.name)
+
+def sorted_players(players):
+    return sorted(players, key=_player_sort_key)
+
+def _vote_string(accept, none=None):
+    if accept is None:
+        return none
+    return 'accept' if accept else 'reject'
+
+def _mission_action_string(played_success):
+    if played_success is None:
+        return None
+    return 'Pass' if played_success else 'Fail'
+
+def game_status_parts(game):
+    """The status of game, split into the JSON shared by all players and
+    observers, and a map from each player's secret ('' for observers) to
+    {'pk': player pk, 'awaiting': whether the game waits on the player (see
+    poll_interval()), 'status': the player's own fields, as JSON members to
+    add to the shared object}."""
     game_status_object = {}
 
     game_status_object['game_phase'] = game.game_phase_string()
 
-    players = game.player_set.order_by('order', 'joined', 'name')
-    num_players = players.count()
+    players = sorted_players(game.player_set.all())
+    num_players = len(players)
+    vote_round = None
 
     if game.game_phase == Game.GAME_PHASE_LOBBY:
         game_status_object['players'] = [p.name for p in players]
@@ -137,7 +261,7 @@ def game_status_string(game, player):
         game_status_object['rounds'] = rounds
     elif game.game_phase == Game.GAME_PHASE_ROLE:
         game_status_object['times_started'] = game.times_started
-        ready_players = game.player_set.filter(ready=True).order_by('order')
+        ready_players = [p for p in players if p.ready]
         game_status_object['ready'] = [{'name': p.name, 'order': p.order}
                                        for p in ready_players]
     else:
@@ -146,47 +270,309 @@ def game_status_string(game, player):
         game_status_object['vote_num'] = vote_round.vote_num
     if game.game_phase == Game.GAME_PHASE_PICK\
             or game.game_phase == Game.GAME_PHASE_VOTE:
-        chosen = vote_round.chosen.order_by('order').all()
-        game_status_object['chosen'] = [p.name for p in chosen]
-        game_status_object['you_chosen'] = player in chosen
+        game_status_object['chosen'] = [p.name for p in
+                                        vote_round.chosen_players()]
     if game.game_phase == Game.GAME_PHASE_VOTE:
-        votes_cast = vote_round.playervote_set.count()
-        game_status_object['missing_votes_count'] = num_players - votes_cast
-        player_vote = vote_round.playervote_set.filter(player=player)
-        if player_vote:
-            if player_vote.get().accept:
-                game_status_object['player_vote'] = 'accept'
-            else:
-                game_status_object['player_vote'] = 'reject'
-        else:
-            game_status_object['player_vote'] = 'none'
-    if game.game_phase == Game.GAME_PHASE_END and game.next_game is not None:
-        game_status_object['next_game'] = game.next_game.access_code
+        game_status_object['missing_votes_count'] =\
+            num_players - vote_round.num_votes()
+    if game.game_phase == Game.GAME_PHASE_END\
+            and game.next_access_code is not None:
+        game_status_object['next_game'] = game.next_access_code
+
+    players_status = {}
+    for player in [None] + players:
+        player_status_object = {}
+        if game.game_phase == Game.GAME_PHASE_PICK\
+                or game.game_phase == Game.GAME_PHASE_VOTE:
+            player_status_object['you_chosen'] = vote_round.is_chosen(player)
+        if game.game_phase == Game.GAME_PHASE_VOTE:
+            player_status_object['player_vote'] =\
+                _vote_string(vote_round.vote_of(player), 'none')
+        if game.game_phase == Game.GAME_PHASE_MISSION and player is not None:
+            player_status_object['mission_action'] = _mission_action_string(
+                vote_round.game_round.mission_action_of(player))
+        players_status['' if player is None else player.secret_id] = {
+            'pk': None if player is None else player.pk,
+            'awaiting': _awaiting_player(game, player, vote_round),
+            'status': json.dumps(player_status_object)[1:-1],
+        }
+
+    return json.dumps(game_status_object), players_status
+
+def join_status(status_json, player_status):
+    """The status of a player from the parts from game_status_parts()."""
+    if not player_status:
+        return status_json
+    return status_json[:-1] + ', ' + player_status + '}'
 
-    return json.dumps(game_status_object)
+def game_status_string(game, player):
+    """The status of game for player (None for observers), computed from
+    the current state of the game."""
+    status_json, players_status = game_status_parts(game)
+    return join_status(
+        status_json,
+        players_status['' if player is None else player.secret_id]['status'])
+
+def materialize_status(game):
+    """Store the status of game on its row if it changed (see
+    Game.changed()), so the status views don't need to load the game. Called
+    in the transaction of the change."""
+    if not game.__dict__.pop('_status_changed', False) or game.pk is None:
+        return
+    status_json, players_status = game_status_parts(game)
+    game.status_json = status_json
+    game.status_players = json.dumps(players_status)
+    game.status_seq = game.event_seq
+    Game.objects.using(game._state.db).filter(pk=game.pk).update(
+        status_json=game.status_json, status_players=game.status_players,
+        status_seq=game.status_seq)
+
+def status_parts(game, player_secret, loaded=True):
+    """The game, the shared status JSON and the entry of the player with
+    player_secret (None for observers) for the status views. game may only
+    be the row of the game if not loaded: the materialized status is used
+    while it's up to date, otherwise the game is loaded and its status
+    computed (e.g. for games from before Game.status_json existed)."""
+    key = player_secret or ''
+    if game.status_seq == game.event_seq and game.status_json is not None:
+        entry = json.loads(game.status_players).get(key)
+        if entry is not None:
+            if settings.AVALON_VERIFY_STATUS:
+                _verify_status(game, key, entry)
+            return game, game.status_json, entry
+    if not loaded:
+        game = _load_live_game(game.access_code)
+    status_json, players_status = game_status_parts(game)
+    try:
+        return game, status_json, players_status[key]
+    except KeyError:
+        raise Http404()
+
+def _verify_status(game, key, entry):
+    """Check the materialized status of game against the status computed
+    from the game (see settings.AVALON_VERIFY_STATUS)."""
+    current = livestate.load_game(Game.objects.using(game._state.db)
+                                              .filter(pk=game.pk))
+    if current.event_seq != game.event_seq:
+        # changed since, so there's nothing to compare with
+        return
+    status_json, players_status = game_status_parts(current)
+    if status_json != game.status_json or players_status.get(key) != entry:
+        raise AssertionError(
+            "Materialized status of game %s at event %d is %s %r instead of "
+            "%s %r" % (game.access_code, game.event_seq, game.status_json,
+                       entry, status_json, players_status.get(key)))
+
+def status_etag(game, player):
+    return _status_etag(game, None if player is None else player.pk)
+
+def _status_etag(game, player_pk):
+    # The status only changes when an event is logged, so the event sequence
+    #   number lets clients skip re-downloading an unchanged status.
+    return '"%d-%s"' % (game.event_seq,
+                        'observer' if player_pk is None else player_pk)
+
+# Seconds until the next poll of the status, by phase. Players the game is
+#   waiting on get the shorter delay, since the others are likely to act
+#   soon after them; everyone else gets the longer one, as nothing can
+#   change for them until the players being waited on act (e.g. a
+#   non-leader while the leader picks the team).
+POLL_INTERVALS = {
+    #                     (awaiting the player, waiting on others)
+    Game.GAME_PHASE_LOBBY: (5, 5),
+    Game.GAME_PHASE_ROLE: (3, 10),
+    Game.GAME_PHASE_PICK: (5, 20),
+    Game.GAME_PHASE_VOTE: (3, 10),
+    Game.GAME_PHASE_MISSION: (4, 15),
+    Game.GAME_PHASE_ASSASSIN: (5, 30),
+    Game.GAME_PHASE_END: (30, 30),
+}
+
+def _server_load():
+    """Load average per CPU (1 if it isn't available)."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 1.0
+
+def _awaiting_player(game, player, vote_round=None):
+    """Whether the current phase of game is waiting on player's action."""
+    if player is None:
+        return False
+    if game.game_phase == Game.GAME_PHASE_ROLE:
+        return not player.ready
+    if game.game_phase == Game.GAME_PHASE_ASSASSIN:
+        return player.is_assassin()
+    if game.game_phase not in (Game.GAME_PHASE_PICK, Game.GAME_PHASE_VOTE,
+                               Game.GAME_PHASE_MISSION):
+        return False
+    if vote_round is None:
+        vote_round = VoteRound.objects.get_current_vote_round(game)
+    if game.game_phase == Game.GAME_PHASE_PICK:
+        return vote_round.leader_id == player.pk
+    elif game.game_phase == Game.GAME_PHASE_VOTE:
+        return vote_round.vote_of(player) is None
+    else:
+        return vote_round.is_chosen(player)\
+            and vote_round.game_round.mission_action_of(player) is None
+
+def poll_interval(game, player):
+    """Milliseconds the client should wait before polling the status
+    again, stretched while the server is overloaded."""
+    return _poll_interval(game, _awaiting_player(game, player))
+
+def _poll_interval(game, awaiting):
+    awaited, waiting = POLL_INTERVALS[game.game_phase]
+    seconds = awaited if awaiting else waiting
+    seconds = min(seconds * max(1.0, _server_load()),
+                  settings.AVALON_POLL_MAX_INTERVAL)
+    return int(seconds * 1000)
+
+def status_response(request, game, status_json, entry):
+    """The response of the status views for the parts from status_parts()."""
+    etag = _status_etag(game, entry['pk'])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(join_status(status_json, entry['status']),
+                                content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    # see game.html
+    response['X-Poll-Interval'] = _poll_interval(game, entry['awaiting'])
+    return response
+
+def game_status_response(request, game, player):
+    return status_response(request, *status_parts(
+        game, None if player is None else player.secret_id))
+
+def _status_game(access_code):
+    """The game for the status views: from the live-state store if it has it
+    (with everything loaded), otherwise only its row, which is all they need
+    while its status is materialized. Returns (game, loaded)."""
+    game = livestate.cached_game(access_code)
+    if game is not None:
+        return game, True
+    try:
+        return Game.objects.for_access_code(access_code).get(), False
+    except Game.DoesNotExist:
+        raise Http404()
+
+def _status(request, access_code, player_secret):
+    game, loaded = _status_game(access_code)
+    game, status_json, entry = status_parts(game, player_secret, loaded)
+    # for the metrics/profiling middleware
+    request.avalon_game = game
+    if entry['pk'] is not None:
+        livestate.touch_pk(game._state.db, entry['pk'])
+    return status_response(request, game, status_json, entry)
 
-@lookup_access_code
 @require_safe
 @transaction.non_atomic_requests
-def observe_status(request, game):
-    return HttpResponse(game_status_string(game, None))
+def observe_status(request, access_code):
+    return _status(request, access_code, None)
 
-@lookup_access_code
-@lookup_player_secret
 @require_safe
 @transaction.non_atomic_requests
-def status(request, game, player):
-    player.save()
+def status(request, access_code, player_secret):
+    return _status(request, access_code, player_secret)
+
+# Async versions of the polling views, used when served by avalon/asgi.py.
+#   Django's decorators (and ours) don't support coroutines, so these check
+#   the method themselves. The ORM is only used from a worker thread, and not
+#   at all for games in a LocalStore (see livestate.py).
+
+async def _async_status_parts(access_code, player_secret):
+    live_store = livestate.store()
+    if live_store is not None and not live_store.blocking\
+            and not settings.AVALON_VERIFY_STATUS:
+        game = livestate.cached_game(access_code)
+        if game is not None:
+            return status_parts(game, player_secret)
+    return await sync_to_async(_status_game_parts)(access_code, player_secret)
+
+def _status_game_parts(access_code, player_secret):
+    game, loaded = _status_game(access_code)
+    return status_parts(game, player_secret, loaded)
+
+def _load_live_game(access_code):
+    game = livestate.cached_game(access_code)
+    if game is None:
+        try:
+            game = livestate.fetch_game(
+                Game.objects.for_access_code(access_code))
+        except Game.DoesNotExist:
+            raise Http404()
+    return game
+
+async def _touch(game, entry):
+    if entry['pk'] is None:
+        return
+    if livestate.store() is None:
+        await sync_to_async(livestate.touch_pk)(game._state.db, entry['pk'])
+    else:
+        livestate.touch_pk(game._state.db, entry['pk'])
+
+async def _async_status(request, access_code, player_secret, wait):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    game, status_json, entry = await _async_status_parts(access_code,
+                                                         player_secret)
+    etag = _status_etag(game, entry['pk'])
+    if wait and etag in parse_etags(request.headers.get('If-None-Match',
+                                                        '')):
+        # long poll: only answer once there is something new (or time's up)
+        if await longpoll.wait_for_change(game.access_code, game.event_seq,
+                                          settings.AVALON_LONG_POLL_TIMEOUT):
+            game, status_json, entry = await _async_status_parts(
+                access_code, player_secret)
+    request.avalon_game = game
+    await _touch(game, entry)
+    return status_response(request, game, status_json, entry)
 
-    return HttpResponse(game_status_string(game, player))
+@transaction.non_atomic_requests
+async def async_observe_status(request, access_code):
+    return await _async_status(request, access_code, None, wait=False)
+
+@transaction.non_atomic_requests
+async def async_status(request, access_code, player_secret):
+    return await _async_status(request, access_code, player_secret,
+                               wait=False)
+
+@transaction.non_atomic_requests
+async def observe_status_wait(request, access_code):
+    return await _async_status(request, access_code, None, wait=True)
+
+@transaction.non_atomic_requests
+async def status_wait(request, access_code, player_secret):
+    return await _async_status(request, access_code, player_secret,
+                               wait=True)
+
+# Games started before Game.assign_knowledge() existed have no precomputed
+#   knowledge, so work it out from the roles for them.
+
+def visible_spies(players, player):
+    if player.visible_spies is None:
+        return [p for p in players if player.sees_as_spy(p)]
+    return players_in_mask(players, player.visible_spies)
+
+def possible_merlins(players, player):
+    if player.possible_merlins is None:
+        return [p for p in players if p.appears_as_merlin()]
+    return players_in_mask(players, player.possible_merlins)
 
 def game_base_context(game, player):
-    players = game.player_set.order_by('order', 'joined', 'name')
-    num_players = players.count()
+    players = sorted_players(game.player_set.all())
+    num_players = len(players)
 
     context = {}
 
-    context['status'] = game_status_string(game, player)
+    _, status_json, entry = status_parts(
+        game, None if player is None else player.secret_id)
+    context['status'] = join_status(status_json, entry['status'])
+    context['poll_interval'] = _poll_interval(game, entry['awaiting'])
+    # the client long-polls status/wait/ with this ETag (see urls.py)
+    context['long_poll'] = settings.AVALON_ASYNC_POLLING
+    context['status_etag'] = _status_etag(game, entry['pk'])
     context['access_code'] = game.access_code
     context['is_observer'] = player is None
     if player is not None:
@@ -194,20 +580,34 @@ def game_base_context(game, player):
         context['player'] = player
     context['players'] = players
     context['num_players'] = num_players
-    context['game_rounds'] = game.gameround_set.all().order_by('round_num')
-
-    context['num_spies'] = len([p for p in players if p.is_spy()])
-    spy_roles = [p.role_string() for p in players
-                 if p.is_spy() and p.role != Player.ROLE_SPY]
-    if spy_roles:
-        spy_roles.sort()
-        context['spy_roles'] = spy_roles
-    context['num_resistance'] = len([p for p in players if not p.is_spy()])
-    resistance_roles = [p.role_string() for p in players
-                        if not p.is_spy() and p.role != Player.ROLE_GOOD]
-    if resistance_roles and all(r is not None for r in resistance_roles):
-        resistance_roles.sort()
-        context['resistance_roles'] = resistance_roles
+    context['game_rounds'] = sorted(game.gameround_set.all(),
+                                    key=lambda r: r.round_num)
+
+    # fixed once the roles are assigned (see Game.assign_knowledge())
+    role_summary = None
+    if game.game_phase != Game.GAME_PHASE_LOBBY:
+        role_summary = game.role_summary_dict()
+    if role_summary is not None:
+        context['num_spies'] = role_summary['num_spies']
+        context['num_resistance'] = role_summary['num_resistance']
+        if role_summary['spy_roles']:
+            context['spy_roles'] = role_summary['spy_roles']
+        if role_summary['resistance_roles']:
+            context['resistance_roles'] = role_summary['resistance_roles']
+    else:
+        context['num_spies'] = len([p for p in players if p.is_spy()])
+        spy_roles = [p.role_string() for p in players
+                     if p.is_spy() and p.role != Player.ROLE_SPY]
+        if spy_roles:
+            spy_roles.sort()
+            context['spy_roles'] = spy_roles
+        context['num_resistance'] = len([p for p in players
+                                         if not p.is_spy()])
+        resistance_roles = [p.role_string() for p in players
+                            if not p.is_spy() and p.role != Player.ROLE_GOOD]
+        if resistance_roles and all(r is not None for r in resistance_roles):
+            resistance_roles.sort()
+            context['resistance_roles'] = resistance_roles
 
     if game.display_history is not None:
         context['display_history'] = game.display_history
@@ -225,32 +625,27 @@ def game_base_context(game, player):
         pass
 
     if game.game_phase != Game.GAME_PHASE_LOBBY:
-        context['game_has_mordred'] = players.filter(role=Player.ROLE_MORDRED)\
-                                             .exists()
+        if role_summary is not None:
+            context['game_has_mordred'] = role_summary['has_mordred']
+        else:
+            context['game_has_mordred'] = any(p.is_mordred()
+                                              for p in players)
         if player is None:
             context['visible_spies'] = []
         else:
-            context['visible_spies'] = [p for p in players
-                                        if player.sees_as_spy(p)]
+            context['visible_spies'] = visible_spies(players, player)
             if player.is_percival():
-                possible_merlins = " or ".join([p.name for p in players
-                                                if p.appears_as_merlin()])
-                context['possible_merlins'] = possible_merlins
+                context['possible_merlins'] = " or ".join(
+                    [p.name for p in possible_merlins(players, player)])
 
     return context
 
-def deterministic_random_boolean(seed):
-    r = random.getstate()
-    random.seed(seed)
-    res = random.choice([True, False])
-    random.setstate(r)
-    return res
-
-@lookup_access_code
+@lookup_live_game
 @lookup_player_secret
 @require_safe
+@transaction.non_atomic_requests
 def game(request, game, player):
-    player.save() # update last_accessed
+    livestate.touch(player) # update last_accessed
 
     return _game(request, game, player)
 
@@ -268,7 +663,7 @@ def _game(request, game, player, extra_context=None):
     elif game.game_phase == Game.GAME_PHASE_PICK:
         vote_round = VoteRound.objects.get_current_vote_round(game=game)
         assert vote_round.vote_status == VoteRound.VOTE_STATUS_WAITING
-        context['chosen'] = vote_round.chosen.order_by('order').all()
+        context['chosen'] = vote_round.chosen_players()
         vote_rejected = not vote_round.is_first_vote()
         context['vote_rejected'] = vote_rejected
         if vote_rejected:
@@ -284,21 +679,17 @@ def _game(request, game, player, extra_context=None):
     elif game.game_phase == Game.GAME_PHASE_VOTE:
         vote_round = VoteRound.objects.get_current_vote_round(game=game)
         assert vote_round.vote_status == VoteRound.VOTE_STATUS_VOTING
-        context['chosen'] = vote_round.chosen.order_by('order').all()
+        context['chosen'] = vote_round.chosen_players()
         context['leader'] = vote_round.leader
         round_num = vote_round.game_round.round_num
         context['round_num'] = round_num
         vote_num = vote_round.vote_num
         context['vote_num'] = vote_num
-        player_vote = vote_round.playervote_set.filter(player=player)
-        if player_vote:
-            if player_vote.get().accept:
-                context['player_vote'] = 'accept'
-            else:
-                context['player_vote'] = 'reject'
-        player_votes = vote_round.playervote_set.count()
+        player_vote = _vote_string(vote_round.vote_of(player))
+        if player_vote is not None:
+            context['player_vote'] = player_vote
         num_players = context['num_players']
-        context['missing_votes_count'] = num_players - player_votes
+        context['missing_votes_count'] = num_players - vote_round.num_votes()
         if player is not None:
             seed = "%s-%s-%d-%d" % (game.access_code, player.secret_id,
                                     round_num, vote_num)
@@ -307,22 +698,18 @@ def _game(request, game, player, extra_context=None):
     elif game.game_phase == Game.GAME_PHASE_MISSION:
         vote_round = VoteRound.objects.get_current_vote_round(game=game)
         assert vote_round.vote_status == VoteRound.VOTE_STATUS_VOTED
-        chosen = vote_round.chosen.order_by('order').all()
-        context['chosen'] = chosen
+        context['chosen'] = vote_round.chosen_players()
         context['leader'] = vote_round.leader
         round_num = vote_round.game_round.round_num
         context['round_num'] = round_num
         vote_num = vote_round.vote_num
         context['vote_num'] = vote_num
         context['vote'] = vote_round.vote_totals()
-        if player in chosen:
-            game_round = vote_round.game_round
-            mission_action = game_round.missionaction_set.filter(player=player)
-            if mission_action:
-                if mission_action.get().played_success:
-                    context['mission_action'] = 'Pass'
-                else:
-                    context['mission_action'] = 'Fail'
+        if vote_round.is_chosen(player):
+            mission_action = _mission_action_string(
+                vote_round.game_round.mission_action_of(player))
+            if mission_action is not None:
+                context['mission_action'] = mission_action
             seed = "%s-%s-%d-%d" % (game.access_code, player.secret_id,
                                     round_num, vote_num)
             context['swap_buttons'] = deterministic_random_boolean(seed)
@@ -331,28 +718,29 @@ def _game(request, game, player, extra_context=None):
             return render(request, 'mission_wait.html', context)
     elif game.game_phase == Game.GAME_PHASE_ASSASSIN:
         if player is not None and player.is_assassin():
+            seen = visible_spies(context['players'], player)
             context['targets'] = [p for p in context['players']
-                                  if p != player and not player.sees_as_spy(p)]
+                                  if p != player and p not in seen]
             return render(request, 'assassinate.html', context)
         else:
             return render(request, 'assassinate_wait.html', context)
     elif game.game_phase == Game.GAME_PHASE_END:
         context['game_over'] = True
-        res_wins = game.gameround_set.filter(mission_passed=True).count()
-        res_won = res_wins == 3 and not game.player_assassinated.is_merlin()
-        context['resistance_won'] = res_won
+        context['resistance_won'] = game.resistance_won()
 
         if game.player_assassinated:
             context['player_assassinated'] = game.player_assassinated
 
-        try:
+        if game.previous_game:
             context['previous_game'] = game.previous_game
-        except Game.DoesNotExist:
-            pass
         if game.next_game:
             if game.next_game.game_phase != Game.GAME_PHASE_END:
                 context['next_game_ongoing'] = True
             context['next_game'] = game.next_game
+        # only worth showing once the table played more than one game
+        series = game.series()
+        if series is not None and series.games > 1:
+            context['series'] = series
 
         return render(request, 'end.html', context)
 
@@ -360,6 +748,7 @@ def _game(request, game, player, extra_context=None):
 @lookup_player_secret
 @require_POST
 def leave(request, game, player):
+    game.log_event(GameEvent.EVENT_LEAVE, player)
     player.delete()
     num_players = game.player_set.count()
     if num_players == 0:
@@ -428,15 +817,21 @@ def _start(request, game, player):
             assert len(roles) == num_players
 
             play_order = list(range(num_players))
-            random.shuffle(play_order)
-            random.shuffle(roles)
+            system_random.shuffle(play_order)
+            system_random.shuffle(roles)
 
             for p, role, order in zip(players, roles, play_order):
                 p.role = role
                 p.order = order
+            game.assign_knowledge(players)
+            for p in players:
                 p.save()
 
             game.save()
+            game.log_event(GameEvent.EVENT_START, player,
+                           display_history=game.display_history,
+                           private_voting=game.private_voting,
+                           roles={p.pk: [p.role, p.order] for p in players})
             if player is None:
                 return redirect('observe', access_code=game.access_code)
             else:
@@ -453,6 +848,7 @@ def observe_cancel_game(request, game):
     if game.game_phase == Game.GAME_PHASE_ROLE:
         game.game_phase = Game.GAME_PHASE_LOBBY
         game.save()
+        game.log_event(GameEvent.EVENT_CANCEL)
 
     return redirect('observe', access_code=game.access_code)
 
@@ -466,32 +862,35 @@ def cancel_game(request, game, player):
 
         game.game_phase = Game.GAME_PHASE_LOBBY
         game.save()
+        game.log_event(GameEvent.EVENT_CANCEL, player)
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @require_POST
 def ready(request, game, player):
     if game.game_phase == Game.GAME_PHASE_ROLE:
         player.ready = True
         player.save()
+        game.log_event(GameEvent.EVENT_READY, player)
 
         if not game.player_set.filter(ready=False):
             game.game_phase = Game.GAME_PHASE_PICK
             game.save()
-            game_round = GameRound.objects.create(game=game, round_num=1)
-            first_leader = Player.objects.get(game=game, order=0)
-            vote_round = VoteRound.objects.create(game_round=game_round,
-                                                  vote_num=1,
-                                                  leader=first_leader)
+            game_round = game.gameround_set.create(round_num=1)
+            first_leader = game.player_set.get(order=0)
+            vote_round = game_round.voteround_set.create(vote_num=1,
+                                                         leader=first_leader)
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @nums_to_int
 @require_POST
 def choose(request, game, player, round_num, vote_num, who):
@@ -504,14 +903,16 @@ def choose(request, game, player, round_num, vote_num, who):
                 and vote_round.vote_num == vote_num\
                 and vote_round.leader == player:
             chosen_player = game.player_set.get(order=who)
-            vote_round.chosen.add(chosen_player)
+            vote_round.choose(chosen_player)
             vote_round.save()
+            game.log_event(GameEvent.EVENT_CHOOSE, player, who=int(who))
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @nums_to_int
 @require_POST
 def unchoose(request, game, player, round_num, vote_num, who):
@@ -524,14 +925,16 @@ def unchoose(request, game, player, round_num, vote_num, who):
                 and vote_round.vote_num == vote_num\
                 and vote_round.leader == player:
             chosen_player = game.player_set.get(order=who)
-            vote_round.chosen.remove(chosen_player)
+            vote_round.unchoose(chosen_player)
             vote_round.save()
+            game.log_event(GameEvent.EVENT_UNCHOOSE, player, who=int(who))
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @nums_to_int
 @require_POST
 def finalize_team(request, game, player, round_num, vote_num):
@@ -548,6 +951,50 @@ def finalize_team(request, game, player, round_num, vote_num):
             vote_round.save()
             game.game_phase = Game.GAME_PHASE_VOTE
             game.save()
+            game.log_event(GameEvent.EVENT_FINALIZE, player)
+
+    return redirect('game', access_code=game.access_code,
+                    player_secret=player.secret_id)
+
+@lookup_access_code
+@lookup_player_secret
+@json_action
+@nums_to_int
+@require_POST
+def propose_team(request, game, player, round_num, vote_num):
+    """Choose the whole team (the orders in the team field) at once, and
+    finalize it if the finalize field is set, instead of a choose request per
+    player and a finalize_team request (see pick.html)."""
+    player.save()
+
+    if game.game_phase == Game.GAME_PHASE_PICK:
+        vote_round = VoteRound.objects.get_current_vote_round(game=game)
+        if vote_round.vote_status == VoteRound.VOTE_STATUS_WAITING\
+                and vote_round.game_round.round_num == round_num\
+                and vote_round.vote_num == vote_num\
+                and vote_round.leader == player:
+            players = {p.order: p for p in game.player_set.all()}
+            try:
+                team = sorted(set(int(who)
+                                  for who in request.POST.getlist('team')))
+            except ValueError:
+                return HttpResponseBadRequest("Invalid team.")
+            finalize = bool(request.POST.get('finalize'))
+            team_size = vote_round.game_round.num_players_on_mission()
+            if any(who not in players for who in team)\
+                    or len(team) > team_size\
+                    or (finalize and len(team) != team_size):
+                return HttpResponseBadRequest(
+                    "The team must be %d players." % team_size)
+            vote_round.set_chosen([players[who] for who in team])
+            events = [(GameEvent.EVENT_PROPOSE, player, {'team': team})]
+            if finalize:
+                vote_round.vote_status = VoteRound.VOTE_STATUS_VOTING
+                vote_round.save()
+                game.game_phase = Game.GAME_PHASE_VOTE
+                game.save()
+                events.append((GameEvent.EVENT_FINALIZE, player, {}))
+            game.log_events(events)
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
@@ -569,13 +1016,15 @@ def retract_team(request, game, player, round_num, vote_num):
             vote_round.save()
             game.game_phase = Game.GAME_PHASE_PICK
             game.save()
-            vote_round.playervote_set.all().delete()
+            vote_round.clear_votes()
+            game.log_event(GameEvent.EVENT_RETRACT, player)
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @nums_to_int
 @require_POST
 def vote(request, game, player, round_num, vote_num, vote):
@@ -586,16 +1035,14 @@ def vote(request, game, player, round_num, vote_num, vote):
         if vote_round.vote_status == VoteRound.VOTE_STATUS_VOTING\
                 and vote_round.game_round.round_num == round_num\
                 and vote_round.vote_num == vote_num:
+            previous_vote = vote_round.vote_of(player)
             if vote == "cancel":
-                try:
-                    vote_round.playervote_set.get(player=player).delete()
-                except PlayerVote.DoesNotExist:
-                    pass
-            else:
-                accept = vote == "approve"
-                vote_round.playervote_set\
-                          .update_or_create(defaults={'accept': accept},
-                                            player=player)
+                if previous_vote is not None:
+                    vote_round.retract_vote(player)
+                    game.log_event(GameEvent.EVENT_VOTE, player, vote=vote)
+            elif previous_vote != (vote == "approve"):
+                vote_round.record_vote(player, vote == "approve")
+                game.log_event(GameEvent.EVENT_VOTE, player, vote=vote)
                 team_approved = vote_round.team_approved()
                 if team_approved is not None:
                     # All players voted, voting round is over.
@@ -610,10 +1057,9 @@ def vote(request, game, player, round_num, vote_num, vote):
                             game.game_phase = Game.GAME_PHASE_END
                         else:
                             game.game_phase = Game.GAME_PHASE_PICK
-                            VoteRound.objects\
-                                     .create(game_round=vote_round.game_round,
-                                             vote_num=vote_round.vote_num+1,
-                                             leader=vote_round.next_leader())
+                            vote_round.game_round.voteround_set\
+                                      .create(vote_num=vote_round.vote_num+1,
+                                              leader=vote_round.next_leader())
                 game.save()
 
     return redirect('game', access_code=game.access_code,
@@ -621,6 +1067,7 @@ def vote(request, game, player, round_num, vote_num, vote):
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @require_POST
 def mission(request, game, player, round_num, mission_action):
     round_num = int(round_num)
@@ -632,16 +1079,14 @@ def mission(request, game, player, round_num, mission_action):
         game_round = vote_round.game_round
         if vote_round.vote_status == VoteRound.VOTE_STATUS_VOTED\
                 and game_round.round_num == round_num\
-                and player in vote_round.chosen.all():
+                and vote_round.is_chosen(player):
             passed = mission_action == "success" or not player.is_spy()
-            game_round.missionaction_set\
-                      .update_or_create(defaults={'played_success': passed},
-                                        player=player)
+            game_round.record_mission_action(player, passed)
+            game.log_event(GameEvent.EVENT_MISSION, player, success=passed)
             num_on_mission = game_round.num_players_on_mission()
-            if game_round.missionaction_set.count() == num_on_mission:
+            if game_round.num_played() == num_on_mission:
                 num_fails_required = game_round.num_fails_required()
-                fails = game_round.missionaction_set\
-                                  .filter(played_success=False).count()
+                fails = popcount(game_round.failed_mask)
                 game_round.mission_passed = fails < num_fails_required
                 game_round.save()
                 res_wins = game.gameround_set.filter(mission_passed=True)\
@@ -661,20 +1106,19 @@ def mission(request, game, player, round_num, mission_action):
                     game.game_phase = Game.GAME_PHASE_PICK
                     game.save()
                     next_round_num = game_round.round_num+1
-                    game_round = GameRound.objects\
-                                          .create(game=game,
-                                                  round_num=next_round_num)
+                    game_round = game.gameround_set\
+                                     .create(round_num=next_round_num)
                     next_leader = vote_round.next_leader()
-                    vote_round = VoteRound.objects\
-                                          .create(game_round=game_round,
-                                                  vote_num=1,
-                                                  leader=next_leader)
+                    vote_round = game_round.voteround_set\
+                                           .create(vote_num=1,
+                                                   leader=next_leader)
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
 @lookup_access_code
 @lookup_player_secret
+@json_action
 @require_POST
 def assassinate(request, game, player, target):
     player.save()
@@ -685,35 +1129,101 @@ def assassinate(request, game, player, target):
         game.player_assassinated = target_player
         game.game_phase = Game.GAME_PHASE_END
         game.save()
+        game.log_event(GameEvent.EVENT_ASSASSINATE, player,
+                       target=target_player.order)
 
     return redirect('game', access_code=game.access_code,
                     player_secret=player.secret_id)
 
+def _rematch(game, player):
+    """The next game, which is created from this one by the first request
+    (see Game.rematch()); the rest of the table only have to read the
+    link."""
+    if game.game_phase != Game.GAME_PHASE_END:
+        raise Http404()
+    if game.next_access_code is not None:
+        return game.next_game
+    # the view isn't atomic so the cheap path above doesn't lock the database
+    with transaction.atomic(using=game._state.db):
+        next_game = game.rematch(player)
+        materialize_status(game)
+    if next_game.status_seq != next_game.event_seq:
+        with transaction.atomic(using=next_game._state.db):
+            next_game.changed()
+            materialize_status(next_game)
+    return next_game
+
 @lookup_access_code
 @lookup_player_secret
 @require_safe
+@transaction.non_atomic_requests
 def next_game(request, game, player):
-    if game.game_phase != Game.GAME_PHASE_END:
-        raise Http404()
-    next_game = game.create_or_get_next_game()
-    if next_game.game_phase == Game.GAME_PHASE_LOBBY:
-        try:
-            next_player = Player.objects.get(game=next_game,
-                                             name=player.name)
-            if not next_player.is_expired():
-                redirect('join_game', access_code=next_game.access_code)
-        except Player.DoesNotExist:
-            next_player = Player.objects.create(game=next_game,
-                                                name=player.name)
-        return redirect('game', access_code=next_game.access_code,
-                        player_secret=next_player.secret_id)
-    else:
-        raise Http404()
+    next_game = _rematch(game, player)
+    try:
+        # carried over by Game.rematch() or joined before; the name is
+        #   theirs as they're the player with that name in this game (see
+        #   JoinGameForm)
+        next_player = next_game.player_set.get(name=player.name)
+    except Player.DoesNotExist:
+        if next_game.game_phase != Game.GAME_PHASE_LOBBY:
+            raise Http404()
+        with transaction.atomic(using=next_game._state.db):
+            next_player = next_game.player_set.create(name=player.name)
+            next_game.log_event(GameEvent.EVENT_JOIN, next_player,
+                                name=next_player.name)
+            materialize_status(next_game)
+    return redirect('game', access_code=next_game.access_code,
+                    player_secret=next_player.secret_id)
 
 @lookup_access_code
 @require_safe
+@transaction.non_atomic_requests
 def observe_next_game(request, game):
-    if game.game_phase != Game.GAME_PHASE_END:
+    next_game = _rematch(game, None)
+    return redirect('observe', access_code=next_game.access_code)
+
+@require_admin_token
+@require_safe
+@transaction.non_atomic_requests
+def export_history(request, export_format):
+    try:
+        games = exported_games(
+            since=parse_day(request.GET.get('since')),
+            until=parse_day(request.GET.get('until'), end_of_day=True),
+            min_players=int(request.GET['min_players'])
+                        if request.GET.get('min_players') else None,
+            max_players=int(request.GET['max_players'])
+                        if request.GET.get('max_players') else None)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    lines = export_lines(export_format, history_records(games))
+    if export_format == 'csv':
+        response = StreamingHttpResponse(lines, content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(lines,
+                                         content_type='application/x-ndjson')
+    response['Content-Disposition'] =\
+        'attachment; filename="avalon-history.%s"' % export_format
+    return response
+
+@require_admin_token
+@require_safe
+@transaction.non_atomic_requests
+def latency_analytics(request):
+    try:
+        since = parse_day(request.GET.get('since'))
+        until = parse_day(request.GET.get('until'), end_of_day=True)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse({'latency': decision_latency(since=since,
+                                                     until=until)})
+
+@require_admin_token
+@require_safe
+@transaction.non_atomic_requests
+def metrics(request):
+    if not settings.AVALON_METRICS:
         raise Http404()
-    next_game = game.create_or_get_next_game()
-    redirect('observe_game', access_code=next_game.access_code)
+    return HttpResponse(REGISTRY.render(chain(game_gauges(),
+                                              admission.gauges())),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,36 @@
+"""Doing the per-process setup at process start instead of on first requests.
+
+A new server process compiles each template the first time it renders it (and
+keeps it if the cached template loader is used, see AVALON_PRODUCTION in
+settings.py) and builds the URL resolver on its first request, so the first
+players to reach a freshly started worker get slow responses. avalon/wsgi.py
+and avalon/asgi.py call warm_up() once the application is loaded, which does
+that work up front if settings.AVALON_WARM_UP is set. The bench_startup
+management command measures the difference.
+"""
+import os
+
+from django.conf import settings
+from django.template import engines
+from django.urls import get_resolver, resolve, reverse
+
+
+def template_names():
+    """The names of this app's templates."""
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'templates')
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith('.html'))
+
+
+def warm_up():
+    if not settings.AVALON_WARM_UP:
+        return
+    # imports the views and builds the tables used by resolve() and reverse()
+    get_resolver()
+    resolve(reverse('index'))
+    for engine in engines.all():
+        for name in template_names():
+            # compiles the template, and caches it with the cached loader
+            #   (including for the templates extending it)
+            engine.get_template(name)